@@ -5,6 +5,8 @@ bachi (japanese for ramen bowl) ... script for dataset creation, finalization an
 
 Manages the production dataset status table
 
+bachi is shipped on its own: it does not import slurp's modules (dbpool, dbstats,
+dbstatements) unless a stand-in backend is requested for testing.
 """
 
 import pyodbc
@@ -21,28 +23,60 @@ import hashlib
 import os
 import shutil
 
+# A local stand-in backend (see slurp's dbbackend) may be selected for offline testing.
+connect = pyodbc.connect
+if os.getenv( 'SLURP_DB_BACKEND', 'odbc' ) != 'odbc':
+    from dbbackend import connect
+
+# Per-query cost of this invocation, appended to bachi.stat.json by main
+querystats = []
+connecttime = time.monotonic()
+
+class TimedCursor:
+    """
+    Wraps a cursor, recording the wall time and rows of each execute in querystats.
+    """
+    def __init__( self, curs ):
+        self._curs = curs
+
+    def __getattr__( self, name ):
+        return getattr( self._curs, name )
+
+    def execute( self, query, *params ):
+        start = time.monotonic()
+        self._curs.execute( query, *params )
+        querystats.append( { 'query' : sys._getframe(1).f_code.co_name, 'wall' : time.monotonic() - start, 'rows' : self._curs.rowcount } )
+        return self
+
+    def fetchall( self ):
+        start = time.monotonic()
+        rows = self._curs.fetchall()
+        querystats[-1]['wall'] += time.monotonic() - start
+        querystats[-1]['rows']  = len(rows)
+        return rows
+
 try:
-    statusdb  = pyodbc.connect("DSN=ProductionStatusWrite")
+    statusdb  = connect("DSN=ProductionStatusWrite")
     statusdbc = statusdb.cursor()
 except pyodbc.InterfaceError:
     for s in [ 10*random.random(), 20*random.random(), 30*random.random(), 60*random.random(), 120*random.random() ]:
         print(f"Could not connect to DB... retry in {s}s")
         time.sleep(s)
         try:
-            statusdb  = pyodbc.connect("DSN=ProductionStatusWrite")
+            statusdb  = connect("DSN=ProductionStatusWrite")
             statusdbc = statusdb.cursor()
         except:
             pass
 
 try:
-    statusdbr_ = pyodbc.connect("DSN=ProductionStatus")
+    statusdbr_ = connect("DSN=ProductionStatus")
     statusdbr = statusdbr_.cursor()
 except pyodbc.InterfaceError:
     for s in [ 10*random.random(), 20*random.random(), 30*random.random(), 60*random.random(), 120*random.random() ]:
         print(f"Could not connect to DB... retry in {s}s")
         time.sleep(s)
         try:
-            statusdbr_ = pyodbc.connect("DSN=ProductionStatus")
+            statusdbr_ = connect("DSN=ProductionStatus")
             statusdbr = statusdbr_.cursor()
         except:
             pass
@@ -50,6 +84,10 @@ except pyodbc.Error as e:
     print(e)
     exit(1)
 
+connecttime = time.monotonic() - connecttime
+statusdbc = TimedCursor( statusdbc )
+statusdbr = TimedCursor( statusdbr )
+
 parser     = argparse.ArgumentParser(prog='bachi')
 subparsers = parser.add_subparsers(dest="subcommand")
 
@@ -72,15 +110,46 @@ def argument(*name_or_flags, **kwargs):
     return ([*name_or_flags], kwargs)
 
 
+#
+# Named statements.  Values are bound as parameters so that the statement text is fixed
+# and the server can reuse its plan.
+#
+statements = {
+    'latest'    : "select id,dstname from {table} where run=? order by id desc",
+    'created'   : """
+        insert into dataset_status (   dstname  ,  run ,  lastrun,  revision, created,  status,    blame )
+        values                     (         ?  ,    ? ,        ?,         1, cast(? as timestamp),  'created', ? )
+        on conflict
+        on constraint dataset_status_pkey
+        do update set
+               revision=dataset_status.revision+1,
+               created=EXCLUDED.created,
+               status=EXCLUDED.status,
+               blame=EXCLUDED.blame
+        """,
+    'created.parent' : """
+        insert into dataset_status (   dstname  ,  run ,  lastrun,  revision, created,  status,    blame,  parent )
+        values                     (         ?  ,    ? ,        ?,         1, cast(? as timestamp),  'created', ?, ? )
+        on conflict
+        on constraint dataset_status_pkey
+        do update set
+               revision=dataset_status.revision+1,
+               created=EXCLUDED.created,
+               status=EXCLUDED.status,
+               blame=EXCLUDED.blame
+        """,
+    'finalized' : "update dataset_status set finalized=cast(? as timestamp), status='finalized', blame=? where id=?",
+    'updated'   : "update dataset_status set updated=cast(? as timestamp), status='updated', nsegments=nsegments+1, blame=? where id=?",
+    'broken'    : "update dataset_status set broken=cast(? as timestamp), status='broken', blame=? where id=?",
+}
+
 def getLatestId( tablename, dstname, run ):
 
     cache="cups.cache"
 
     result  = 0
-    query=f"""
-    select id,dstname from {tablename} where run={run} order by id desc;
-    """
-    results = list( statusdbr.execute(query).fetchall() )
+    query=statements['latest'].format( table=tablename )
+    results = list( statusdbr.execute( query, run ).fetchall() )
 
     # Find the most recent ID with the given dstname
     for r in results:
@@ -111,37 +180,16 @@ def created(args):
 
     now = str( args.timestamp )
     
-    upsert=""
-
     if args.parent:
-        upsert=f"""
-        insert into dataset_status (   dstname  ,  run ,  lastrun,  revision, created,  status,    blame,  parent )
-        values                     ( '{dstname}', {run}, {lastrun},        1, '{now}',  'created', '{blame}', '{args.parent}' )
-        on conflict
-        on constraint dataset_status_pkey
-        do update set
-               revision=dataset_status.revision+1,
-               created=EXCLUDED.created,
-               status=EXCLUDED.status,
-               blame=EXCLUDED.blame
-        """
+        upsert = statements['created.parent']
+        values = ( dstname, run, lastrun, now, blame, args.parent )
     else:
-        upsert=f"""
-        insert into dataset_status (   dstname  ,  run ,  lastrun,  revision, created,  status,    blame )
-        values                     ( '{dstname}', {run}, {lastrun},        1, '{now}',  'created', '{blame}' )
-        on conflict
-        on constraint dataset_status_pkey
-        do update set
-               revision=dataset_status.revision+1,
-               created=EXCLUDED.created,
-               status=EXCLUDED.status,
-               blame=EXCLUDED.blame
-        """
+        upsert = statements['created']
+        values = ( dstname, run, lastrun, now, blame )
 
+    print(upsert, values)
 
-    print(upsert)
-
-    statusdbc.execute( upsert )
+    statusdbc.execute( upsert, values )
     statusdbc.commit()
 
 
@@ -165,15 +213,8 @@ def finalized(args):
     now = str( args.timestamp )
 
     id_ = getLatestId('dataset_status',dstname,run)
-    upsert=f"""
-    update dataset_status
-        set finalized='{now}',
-            status='finalized',
-            blame='{blame}'
-    where id={id_};
-    """
     
-    statusdbc.execute( upsert )
+    statusdbc.execute( statements['finalized'], ( now, blame, id_ ) )
     statusdbc.commit()
 
 @subcommand([
@@ -196,16 +237,8 @@ def updated(args):
     now = str( args.timestamp )
 
     id_ = getLatestId('dataset_status',dstname,run)
-    upsert=f"""
-    update dataset_status
-        set updated='{now}',
-            status='updated',
-            nsegments=nsegments+1,
-            blame='{blame}'
-    where id={id_};
-    """    
-
-    statusdbc.execute( upsert )
+
+    statusdbc.execute( statements['updated'], ( now, blame, id_ ) )
     statusdbc.commit()
 
 
@@ -228,16 +261,8 @@ def broken(args):
 
     now = str( args.timestamp )
     id_ = getLatestId('dataset_status',dstname,run)
-
-    upsert=f"""
-    update dataset_status
-        set broken='{now}',
-            status='broken',
-            blame='{blame}'
-    where id={id_};
-    """
     
-    statusdbc.execute( upsert )
+    statusdbc.execute( statements['broken'], ( now, blame, id_ ) )
     statusdbc.commit()
 
 
@@ -252,5 +277,9 @@ def main():
     else:
         args.func(args)        
 
+        with open( 'bachi.stat.json', 'a' ) as stats:
+            stats.write( json.dumps( { 'subcommand' : args.subcommand, 'dstname' : args.DSTNAME, 'run' : args.RUN,
+                                       'connect' : connecttime, 'queries' : querystats } ) + "\n" )
+
 if __name__ == '__main__':
     main()
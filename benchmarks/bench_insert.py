@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the insert of the production status rows of a submission.
+
+Compares, for each number of rows (10k and 50k by default):
+
+    statement  a single insert ... values (...),(...) returning id with the values
+               formatted into the text, as submit() used to send it
+    blocks     insert_production_status in prepared blocks of INSERTBLOCK rows
+    staged     insert_production_status through the staging table (--bulkload)
+
+Each insert runs in a transaction which is rolled back, on the database selected by
+SLURP_DB_BACKEND (a scratch sqlite database by default).  The best of --repeat passes
+is reported.  The staged ids are checked against the dstfile of each row.
+
+sqlite runs in process, so the round trips to a database server are not paid.  With
+--latency each statement sent to sqlite (an execute, or an array bound executemany)
+is delayed by the given number of seconds.
+
+    $ source setup
+    $ python benchmarks/bench_insert.py --rows 10000 50000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser( prog='bench_insert' )
+parser.add_argument( '--rows',   type=int, nargs='+', default=[ 10000, 50000 ], help="Numbers of rows inserted" )
+parser.add_argument( '--repeat', type=int, default=3, help="Timed passes (the best is reported)" )
+parser.add_argument( '--latency', type=float, default=0.0, help="Seconds added to each statement sent to the sqlite database (a server round trip)" )
+
+SETUP = SimpleNamespace( id=1, name='DST_RESULT_$(streamname)_run2pp', build='ana.450', dbtag='2024p009', version='v001' )
+
+def matches( n ):
+    for i in range( n ):
+        run, seg, stream = 60000 + i // 200, ( i // 8 ) % 25, i % 8
+        yield { 'name' : SETUP.name, 'streamname' : f'SEB{stream:02d}', 'run' : str(run), 'seg' : str(seg + 25 * ( i // 5000 )), 'version' : SETUP.version,
+                'lfn' : f'DST_RESULT_SEB{stream:02d}_run2pp_ana450_2024p009_v001-{run:08d}-{seg:05d}.root',
+                'inputs' : f'/sphenix/lustre01/sphnxpro/physics/DST_SEB{stream:02d}-{run:08d}-{seg:05d}.root,/sphenix/lustre01/sphnxpro/physics/DST_GL1-{run:08d}-{seg:05d}.root',
+                'ranges' : 'unset' }
+
+def statement( slurp, matching, cursor ):
+    """
+    The formatted multi-row insert (one statement for all rows).
+    """
+    from dbstatements import _production_status_columns
+    rows = slurp.production_status_rows( matching, SETUP )
+    def literal( x ):
+        return "'" + x.replace( "'", "''" ) + "'" if isinstance( x, str ) else str(x)
+    values = ','.join( [ "({},{},{},{},{},0,{},{},{},{},{},'submitting',{},0,{})".format( *[ literal(x) for x in row ] ) for row in rows ] )
+    insert = f"insert into production_status ({_production_status_columns}) values {values} returning id"
+    return [ int(r.id) for r in cursor.execute( insert ).fetchall() ]
+
+def blocks( slurp, matching, cursor ):
+    return slurp.insert_production_status( matching, SETUP, cursor, stagerows=None )
+
+def staged( slurp, matching, cursor ):
+    return slurp.insert_production_status( matching, SETUP, cursor, stagerows=0 )
+
+def main():
+    args = parser.parse_args()
+
+    os.chdir( tempfile.mkdtemp( prefix='bench_insert' ) )
+    os.environ.setdefault( 'SLURP_DB_BACKEND', f'sqlite:{os.getcwd()}/db' )
+    import slurp
+    import dbbackend
+    if args.latency > 0:
+        for method in ( 'execute', 'executemany' ):
+            def delayed( self, *a, _method=getattr( dbbackend.SQLiteCursor, method ) ):
+                time.sleep( args.latency )
+                return _method( self, *a )
+            setattr( dbbackend.SQLiteCursor, method, delayed )
+
+    print( f"{'rows':>8} " + ' '.join( [ f'{m.__name__+"[s]":>13}' for m in ( statement, blocks, staged ) ] ) + f" {'staged/blocks':>14}" )
+    for n in args.rows:
+        matching = list( matches( n ) )
+        best = {}
+        for method in ( statement, blocks, staged ):
+            for i in range( args.repeat ):
+                cursor = slurp.dbQuery( slurp.cnxn_string_map['statusw'], 'select id from production_status where false;', name='status.insert' )
+                start  = time.perf_counter()
+                ids    = method( slurp, matching, cursor )
+                wall   = time.perf_counter() - start
+                best[method] = min( best.get( method, wall ), wall )
+                assert len( ids ) == n
+                if method is staged and i == 0:
+                    rows = slurp.production_status_rows( matching, SETUP )
+                    dstfiles = { r.id : r.dstfile for r in cursor.execute( "select id,dstfile from production_status" ).fetchall() }
+                    assert [ dstfiles[i_] for i_ in ids ] == [ row[2] for row in rows ]
+                cursor.rollback()
+                cursor.close()
+        print( f"{n:>8} " + ' '.join( [ f'{w:>13.3f}' for w in best.values() ] ) + f" {best[staged] / best[blocks]:>14.2f}" )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the matching engine (slurp.matches) at production scale.
+
+Synthetic input DSTs, their file catalog entries (lfn -> pfn), already produced
+outputs and production status entries are seeded into the local sqlite stand-in
+backend (see dbbackend), one database directory per scale.  matches() is then run
+against them for a rule with $(streamname) expansion, so that every candidate is a
+(run, segment, stream) tuple.  Seeded databases are kept and reused by later runs.
+
+The wall time and peak traced memory of each phase of matches() (see stagetimer)
+
+    candidates  input query and candidate outputs
+    exists      existing outputs in the file catalog
+    lfn2pfn     lfn to pfn map
+    pfnlists    pfn lists per candidate
+    git         payload git checks
+    setup       production setup
+    status      production status map
+    loop        the final match loop
+
+together with the per query statistics (see dbstats) are printed, and appended as one
+line of JSON per scale to matches.jsonl, keyed by the git commit of the slurp checkout.  Each result is compared with the latest result for the same scale
+and parameters from a different commit.
+
+The seeded databases, the payload clone and the results live outside of the checkout,
+in the directory given by SLURP_BENCH_DIR ($TMPDIR/slurp-bench by default).
+
+    $ source setup
+    $ python benchmarks/bench_matches.py --scales 1000 100000 1000000
+
+Peak memory is measured with tracemalloc, which slows python down by a factor of a
+few.  Use --no-memory to measure the timing alone.
+
+With --incremental the measured pass is a steady state pass of incremental matching
+(see matchstate), made after an unmeasured full pass over the same data.  With
+--chunk N the matches are streamed from the MatchPipeline in chunks of N candidates
+and dropped chunk by chunk, as submit --chunk does.  With --rules N the input query is
+matched by N rules (with different output names), and with --share the rules share
+the evaluation of the input query and the lfn2pfn map (as kaedama --rules does).
+"""
+
+import os
+import json
+import random
+import shutil
+import logging
+import pathlib
+import argparse
+import platform
+import datetime
+import tempfile
+import tracemalloc
+import subprocess
+
+REPO    = pathlib.Path( __file__ ).resolve().parent.parent
+BENCH   = pathlib.Path( os.getenv( 'SLURP_BENCH_DIR', pathlib.Path( tempfile.gettempdir() ) / 'slurp-bench' ) ).resolve()
+RESULTS = BENCH / 'matches.jsonl'
+
+# Generator version ... bump when the seeded data changes so that stale databases are rebuilt
+SEEDVERSION = 2
+
+NAME    = 'DST_RESULT_$(streamname)_run2pp'
+BUILD   = 'ana.450'
+TAG     = '2024p009'
+VERSION = 'v001'
+INPUTDS = 'ana450_2024p009'
+
+INPUTQUERY = """
+select 'filecatalog/datasets' as source, runnumber, segment,
+       string_agg( filename, ' ' ) as files,
+       'NA' as fileranges,
+       replace( replace( dsttype, 'DST_BENCH_', '' ), '_run2pp', '' ) as streamname
+from datasets
+where dataset='{dataset}' and dsttype like 'DST_BENCH_%' and runnumber>={first} and runnumber<={last}
+group by runnumber, segment, dsttype
+order by runnumber, segment, dsttype
+"""
+
+parser = argparse.ArgumentParser( prog='bench_matches' )
+parser.add_argument( '--scales',    nargs='+', type=int, default=[1000,100000,1000000], help="Numbers of candidate (run, segment, stream) tuples" )
+parser.add_argument( '--streams',   type=int,   default=8,   help="Streams per run and segment" )
+parser.add_argument( '--segments',  type=int,   default=25,  help="Segments per run" )
+parser.add_argument( '--files',     type=int,   default=2,   help="Input files per candidate" )
+parser.add_argument( '--produced',  type=float, default=0.5, help="Fraction of candidates already produced" )
+parser.add_argument( '--status',    type=float, default=0.2, help="Fraction of candidates with a production status entry" )
+parser.add_argument( '--seed',      type=int,   default=1 )
+parser.add_argument( '--no-memory', dest='memory', default=True, action='store_false', help="Do not trace memory allocations" )
+parser.add_argument( '--antijoin',  default=False, action='store_true', help="Use the anti-join strategy for the existence and status lookups" )
+parser.add_argument( '--lfn2pfn-cache', dest='lfn2pfn_cache', default=False, action='store_true', help="Use the lfn2pfn cache (measured after an unmeasured pass which fills it)" )
+parser.add_argument( '--chunk',     type=int,   default=None, help="Stream the matches in chunks of this many candidates (as submit --chunk does)" )
+parser.add_argument( '--rules',     type=int,   default=1,   help="Number of rules (differing in their output names) matched against the same input query" )
+parser.add_argument( '--share',     default=False, action='store_true', help="Share the evaluation of the input query between the rules (as kaedama --rules does)" )
+parser.add_argument( '--incremental', default=False, action='store_true', help="Measure a steady state incremental pass (after an unmeasured full pass)" )
+parser.add_argument( '--output',    default=str(RESULTS), help="File to which results are appended" )
+parser.add_argument( '--verbose',   default=False, action='store_true', help="Show the slurp log" )
+
+def git( *args, cwd=REPO ):
+    return subprocess.run( [ 'git', *args ], cwd=cwd, capture_output=True, text=True ).stdout.strip()
+
+def commit():
+    """
+    Returns the commit of the slurp checkout and whether the tree has local changes.
+    """
+    return git( 'rev-parse', 'HEAD' ), git( 'status', '--porcelain', '--untracked-files=no' ) != ''
+
+def payload():
+    """
+    matches() checks the payload repository against its remote, so provide a clone.
+    """
+    origin = BENCH / 'payload.git'
+    clone  = BENCH / 'payload'
+    if not ( clone / '.git' ).is_dir():
+        origin.mkdir( parents=True, exist_ok=True )
+        git( 'init', '-q', str(origin) )
+        git( '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '--allow-empty', '-m', 'payload', cwd=origin )
+        git( 'clone', '-q', str(origin), str(clone) )
+    return str(clone)
+
+def layout( scale, args ):
+    """
+    Returns the runs, segments and streams which make up (at least) scale candidates.
+    """
+    per_run = args.segments * args.streams
+    nruns   = max( 1, -( -scale // per_run ) )
+    runs    = range( 60000, 60000 + nruns )
+    streams = [ f"SEB{s:02d}" for s in range( args.streams ) ]
+    return runs, range( args.segments ), streams
+
+def outputname( stream, run, seg ):
+    return f"{NAME.replace('$(streamname)',stream)}_{BUILD.replace('.','')}_{TAG}_{VERSION}-{run:08d}-{seg:05d}"
+
+def seed( directory, scale, args ):
+    """
+    Seeds the stand-in databases for the given scale (once).
+    """
+    done = pathlib.Path( directory ) / 'seeded'
+    if done.is_file():
+        return
+
+    import dbbackend
+    shutil.rmtree( directory, ignore_errors=True )
+
+    random.seed( args.seed )
+    runs, segments, streams = layout( scale, args )
+    fc     = dbbackend.sqlite_connect( 'DSN=FileCatalog', directory )
+    status = dbbackend.sqlite_connect( 'DSN=ProductionStatusWrite', directory )
+
+    def inputs():
+        for run in runs:
+            for seg in segments:
+                for stream in streams:
+                    for i in range( args.files ):
+                        yield f"DST_BENCH_{stream}_run2pp_{INPUTDS}-{run:08d}-{seg:05d}-{i}.root", run, seg, stream
+
+    # Files are catalogued as their run is produced, one minute apart
+    catalogued = lambda run: str( datetime.datetime(2024,6,1) + datetime.timedelta( minutes=run-runs[0] ) )
+    fc.cursor().executemany( "insert into files (lfn,full_host_name,full_file_path,size,md5,time) values (?,?,?,0,'unset',?)",
+                             ( ( lfn, 'lustre', f"/sphenix/lustre01/sphnxpro/bench/{stream}/{lfn}", catalogued(run) ) for lfn, run, seg, stream in inputs() ) )
+    fc.cursor().executemany( "insert into datasets (filename,runnumber,segment,size,dataset,dsttype,events) values (?,?,?,0,?,?,1000)",
+                             ( ( lfn, run, seg, INPUTDS, f"DST_BENCH_{stream}_run2pp" ) for lfn, run, seg, stream in inputs() ) )
+
+    candidates = [ ( stream, run, seg ) for run in runs for seg in segments for stream in streams ]
+    produced   = random.sample( candidates, int( len(candidates) * args.produced ) )
+    fc.cursor().executemany( "insert into datasets (filename,runnumber,segment,size,dataset,dsttype,events) values (?,?,?,0,?,?,1000)",
+                             ( ( outputname( stream, run, seg ) + '.root', run, seg, f"{BUILD.replace('.','')}_{TAG}", NAME.replace('$(streamname)',stream) )
+                               for stream, run, seg in produced ) )
+    fc.commit()
+
+    states = [ 'submitted', 'running', 'finished', 'failed' ]
+    status.cursor().executemany(
+        "insert into production_status (dsttype,dstname,dstfile,run,segment,nsegments,inputs,ranges,prod_id,cluster,process,status,submitting,nevents,submission_host) values (?,?,?,?,?,0,'unset','unset',0,0,0,?,'2024-01-01 00:00:00',0,'bench')",
+        ( ( NAME.replace('$(streamname)',stream), NAME.replace('$(streamname)',stream), outputname( stream, run, seg ), run, seg, random.choice( states ) )
+          for stream, run, seg in random.sample( candidates, int( len(candidates) * args.status ) ) ) )
+    status.commit()
+
+    fc.close()
+    status.close()
+    done.write_text( f"{len(candidates)}\n" )
+
+def compare( result, filename ):
+    """
+    Prints the ratio of each phase to the latest result for the same scale and
+    parameters from another commit.
+    """
+    previous = None
+    if pathlib.Path( filename ).is_file():
+        for line in open( filename ):
+            r = json.loads( line )
+            if r['run']['commit'] != result['run']['commit'] and r['params'] == result['params'] and r['scale'] == result['scale']:
+                previous = r
+    if previous is None:
+        return
+    print(f"  compared with {previous['run']['commit'][:10]} ({previous['run']['timestamp']})")
+    for k, s in result['stages'].items():
+        p = previous['stages'].get( k, None )
+        if p and p['wall'] > 0:
+            print(f"    {k:<24} {p['wall']:>9.3f}s -> {s['wall']:>9.3f}s  x{s['wall']/p['wall']:.2f}")
+
+def main():
+
+    args = parser.parse_args()
+    scales = args.scales
+
+    BENCH.mkdir( parents=True, exist_ok=True )
+    output = pathlib.Path( args.output ).resolve()
+
+    # matches() is run from a testbed area (not production mode)
+    workdir = BENCH / 'testbed'
+    ( workdir / '.slurp' ).mkdir( parents=True, exist_ok=True )
+    ( workdir / '.slurp' / 'testbed' ).touch()
+    os.chdir( workdir )
+
+    import slurp
+    import dbbackend
+    from dbpool import pool as dbpool
+    from dbstats import stats as dbstats
+    from stagetimer import stages
+    from sharedinputs import shared
+
+    if not args.verbose:
+        logging.getLogger( 'slurp' ).setLevel( logging.WARNING )
+
+    options = [ '--batch' ] + [ f"--{k.replace('_','-')}" for k in ( 'incremental', 'antijoin', 'lfn2pfn_cache' ) if getattr( args, k ) ]
+    slurp.args, _ = slurp.arg_parser.parse_known_args( options )
+
+    sha, dirty = commit()
+    params = { k: getattr( args, k ) for k in ( 'streams', 'segments', 'files', 'produced', 'status', 'seed', 'memory', 'incremental', 'antijoin', 'lfn2pfn_cache', 'chunk', 'rules', 'share' ) }
+    params['seedversion'] = SEEDVERSION
+
+    for scale in scales:
+
+        directory = str( BENCH / 'data' / f"{scale}-{args.streams}-{args.segments}-{args.files}-{args.produced}-{args.status}-{args.seed}-{SEEDVERSION}" )
+        seed( directory, scale, args )
+        os.environ['SLURP_DB_BACKEND'] = f"sqlite:{directory}"
+
+        runs, segments, streams = layout( scale, args )
+        rules = [ slurp.SPhnxRule( name=NAME.replace( 'RESULT', f"RESULT{k or ''}" ), script='bench.sh', build=BUILD, tag=TAG, version=VERSION,
+                                   files=INPUTQUERY.format( dataset=INPUTDS, first=runs[0], last=runs[-1] ),
+                                   filesdb='fccro', payload=payload() ) for k in range( args.rules ) ]
+        rule  = rules[0]
+
+        dbpool.clear()
+        if args.incremental or args.lfn2pfn_cache:
+            for db in [ '.slurp/matchstate.db', '.slurp/lfn2pfn.db' ]:
+                for f in pathlib.Path( '.slurp' ).glob( pathlib.Path( db ).name + '*' ):   # with the wal and shm files
+                    f.unlink()
+            slurp.matches( rule, {} )
+        dbstats.clear()
+        stages.clear()
+        slurp.input_datasets.clear()
+
+        if args.memory:
+            tracemalloc.start()
+        shared.active = args.share
+        matched = 0
+        with stages.stage( 'matches' ):
+            for rule in rules:
+                if args.chunk:
+                    # The matches are dropped chunk by chunk, as they would be once submitted
+                    pipeline = slurp.MatchPipeline( rule, {}, chunk=args.chunk )
+                    matched += sum( [ len(chunk) for chunk in pipeline.chunks( args.chunk ) ] )
+                else:
+                    matched += len( slurp.matches( rule, {} )[0] )
+        tracemalloc.stop()
+        shared.clear()
+        shared.active = False
+
+        result = {
+            'run'        : {
+                'commit'    : sha,
+                'dirty'     : dirty,
+                'timestamp' : str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) ),
+                'host'      : platform.node(),
+                'python'    : platform.python_version(),
+            },
+            'scale'      : scale,
+            'params'     : params,
+            'candidates' : len(runs) * len(segments) * len(streams),
+            'matched'    : matched,
+            'peak'       : stages.stats()['matches']['peak'],
+            'stages'     : stages.stats(),
+            'queries'    : dbstats.stats(),
+        }
+
+        print(f"scale={scale} candidates={result['candidates']} matched={result['matched']} commit={sha[:10]}{'+' if dirty else ''}")
+        stages.report( log=print )
+        dbstats.report( log=print )
+        compare( result, output )
+
+        with open( output, 'a' ) as f:
+            f.write( json.dumps( result ) + '\n' )
+
+if __name__ == '__main__':
+    main()
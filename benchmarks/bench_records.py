@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark of the match records and of the itemdata handed to the schedd.
+
+Compares, for N synthetic matches (100k by default):
+
+    before  SPhnxMatch(...).dict() updated with the rule kwargs for each match, and
+            a second dictionary per match holding its itemdata (kept in a list until
+            the submission, as submit() used to)
+    after   SPhnxMatchRecord for each match (the kwargs shared between all records),
+            and the SPhnxItemData view consumed as schedd.submit consumes it
+
+The time per match of building the matches and of producing the itemdata is the best
+of --repeat passes.  The memory per match (retained once built, and peak while the
+itemdata is produced) is measured with tracemalloc in a separate pass.
+
+    $ source setup
+    $ python benchmarks/bench_records.py --matches 100000
+"""
+
+import time
+import argparse
+import tracemalloc
+
+from types import SimpleNamespace
+
+from slurp import SPhnxMatch, SPhnxMatchRecord, SPhnxItemData
+
+RULE   = SimpleNamespace( name='DST_RESULT_$(streamname)_run2pp', runname='run2pp', build='ana450', tag='2024p009', version='v001' )
+KWARGS = { 'mem':'2048MB', 'disk':'10GB', 'nevents':0, 'neventsper':10000,
+           'outdir':'/sphenix/lustre01/sphnxpro/production/run2pp/physics/ana450_2024p009_v001/{leafdir}/run_$(rungroup)/dst',
+           'logdir':'file:///sphenix/data/data02/sphnxpro/production/run2pp/physics/ana450_2024p009_v001/{leafdir}/run_$(rungroup)/log',
+           'histdir':'/sphenix/data/data02/sphnxpro/production/run2pp/physics/ana450_2024p009_v001/{leafdir}/run_$(rungroup)/hist',
+           'condor':'/tmp/production/run2pp/physics/ana450_2024p009_v001/{leafdir}/run_$(rungroup)/log' }
+
+# The submit description, as far as the itemdata keys named in it are concerned
+SUBMIT = ( "executable = jobwrapper.sh\n"
+           "arguments = run.sh $(nevents) $(run) $(seg) $(lfn) $(indir) $(dst) $(outdir) $(buildarg) $(tag) $(inputs) $(ranges) $(neventsper) $(logdir) $(histdir) $(ClusterId) $(ProcId) $(cupsid)\n"
+           "output = $(condor)/$(name)_$(build)_$(tag)-$INT(run,%08i)-$INT(seg,%05i).out\n"
+           "request_memory = $(mem)\n" )
+
+parser = argparse.ArgumentParser( prog='bench_records' )
+parser.add_argument( '--matches', type=int, default=100000, help="Number of matches" )
+parser.add_argument( '--repeat',  type=int, default=3,      help="Timed passes (the best is reported)" )
+
+def candidates( n ):
+    for i in range( n ):
+        run, seg, stream = 60000 + i // 200, ( i // 8 ) % 25, i % 8
+        yield ( str(run), str(seg), f'SEB{stream:02d}',
+                f'DST_RESULT_SEB{stream:02d}_run2pp_ana450_2024p009_v001-{run:08d}-{seg:05d}.root',
+                f'/sphenix/lustre01/sphnxpro/physics/DST_SEB{stream:02d}-{run:08d}-{seg:05d}.root /sphenix/lustre01/sphnxpro/physics/DST_GL1-{run:08d}-{seg:05d}.root' )
+
+def build_before( n ):
+    result = []
+    for run, seg, stream, dst, inputs in candidates( n ):
+        match = SPhnxMatch( RULE.name, 'run.sh', 'filecatalog/datasets', dst, run, seg, 'ana.450', RULE.tag, "4096MB", "10GB", '/payload',
+                            inputs=inputs, streamname=stream, version=RULE.version ).dict()
+        for k,v in KWARGS.items():
+            match[k]=str(v)
+        result.append( match )
+    return result
+
+def itemdata_before( matching ):
+    result = []
+    for m in matching:
+        d = { 'runtype':'physics', 'runname':RULE.runname }
+        d['+sPHENIX_DSTTYPE']  ='"'+ m['name'].replace("$(streamname)",m['streamname']) +'"'
+        d['+sPHENIX_DATASET']  ='"'+RULE.build+"_"+RULE.tag+"_"+RULE.version+'"'
+        d['+sPHENIX_RUNNUMBER']=str(m['run'])
+        d['+sPHENIX_SEGMENT']  =str(m['seg'])
+        for k,v in m.items():
+            if k in SUBMIT or k=='streamname':
+                d[k] = m[k]
+        d['cupsid']=d['+sPHENIX_SLURP_CUPSID']='1'
+        result.append( d )
+    for d in result:   # the schedd reads the list
+        pass
+    return result
+
+def build_after( n ):
+    shared = { k: str(v) for k, v in KWARGS.items() }
+    result = []
+    for run, seg, stream, dst, inputs in candidates( n ):
+        match = SPhnxMatchRecord( shared, RULE.name, 'run.sh', 'filecatalog/datasets', dst, run, seg, 'ana.450', RULE.tag, "4096MB", "10GB", '/payload',
+                                  inputs=inputs, streamname=stream, version=RULE.version )
+        match.runtype = 'physics'
+        match.cupsid  = 1
+        result.append( match )
+    return result
+
+def itemdata_after( matching ):
+    for d in SPhnxItemData( matching, RULE, SUBMIT ):   # as the schedd reads the view
+        pass
+    return None
+
+def measure( n, repeat, build, itemdata ):
+    best = [ float('inf'), float('inf') ]
+    for i in range( repeat ):
+        start    = time.perf_counter()
+        matching = build( n )
+        built    = time.perf_counter()
+        items    = itemdata( matching )
+        best     = [ min( best[0], built - start ), min( best[1], time.perf_counter() - built ) ]
+        del matching, items
+
+    tracemalloc.start()
+    base     = tracemalloc.get_traced_memory()[0]
+    matching = build( n )
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.reset_peak()
+    items    = itemdata( matching )
+    peak     = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    del matching, items
+
+    return { 'build[us]' : 1E6 * best[0] / n, 'itemdata[us]' : 1E6 * best[1] / n, 'retained[B]' : retained / n, 'peak[B]' : peak / n }
+
+def main():
+    args = parser.parse_args()
+
+    # Both paths must produce the same matches and itemdata
+    for old, new in zip( build_before( 100 ), build_after( 100 ) ):
+        assert old == dict( new ), ( old, dict( new ) )
+    assert itemdata_before( build_before( 100 ) ) == list( SPhnxItemData( build_after( 100 ), RULE, SUBMIT ) )
+
+    results = { 'before' : measure( args.matches, args.repeat, build_before, itemdata_before ),
+                'after'  : measure( args.matches, args.repeat, build_after,  itemdata_after  ) }
+
+    print( f"{args.matches} matches, per match:" )
+    print( f"{'':<8} " + ' '.join( [ f'{k:>13}' for k in results['before'] ] ) )
+    for name, r in results.items():
+        print( f"{name:<8} " + ' '.join( [ f'{v:>13.2f}' for v in r.values() ] ) )
+    print( f"{'ratio':<8} " + ' '.join( [ f"{results['after'][k] / results['before'][k]:>13.2f}" for k in results['before'] ] ) )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+dashi (the stock under the ramen) ... seeds the local stand-in databases (see dbbackend)
+with realistic run / segment volumes, so that kaedama, cups and ramenya2 can be
+exercised and timed without the production DSNs.
+
+For each run the DAQ filelist receives one file per host and raw segment, and the
+file catalog receives the matching lfn / pfn entries.  A fraction of the outputs of
+the given DST type are registered as already produced (datasets table), and a
+fraction are given an entry in the production status table in a random state.
+
+    $ export SLURP_DB_BACKEND=sqlite
+    $ dashi.py --runs 50000 1000 --hosts 8 --segments 20 --produced 0.5 --status 0.2
+
+An input query usable with the sqlite backend (one job per run) is
+
+    select 'daqdb/filelist' as source, runnumber, 0 as segment,
+           string_agg( split_part(filename,'/',-1), ' ' ) as files,
+           string_agg( firstevent || ':' || lastevent || ':' || split_part(filename,'/',-1), ' ' ) as fileranges
+    from filelist where runnumber>=50000 and runnumber<=50999
+    group by runnumber order by runnumber
+"""
+
+import os
+import sys
+import random
+import shutil
+import pathlib
+import argparse
+import datetime
+
+parser = argparse.ArgumentParser( prog='dashi' )
+parser.add_argument( '--backend',    default=None, help="Backend to seed (default: SLURP_DB_BACKEND, or sqlite)" )
+parser.add_argument( '--runs',       nargs=2, type=int, default=[50000,100], metavar=('FIRST','N'), help="First run and number of runs" )
+parser.add_argument( '--hosts',      type=int, default=8,     help="Number of DAQ hosts writing files in each run" )
+parser.add_argument( '--segments',   type=int, default=10,    help="Number of raw data segments per host and run" )
+parser.add_argument( '--events',     type=int, default=10000, help="Number of events per raw data segment" )
+parser.add_argument( '--outsegments',type=int, default=1,     help="Number of output segments per run" )
+parser.add_argument( '--dsttype',    default='DST_TRIGGERED_EVENT_run2pp', help="DST type of the outputs" )
+parser.add_argument( '--build',      default='ana.437',  help="Build of the outputs" )
+parser.add_argument( '--dbtag',      default='2024p007', help="Database tag of the outputs" )
+parser.add_argument( '--produced',   type=float, default=0.5, help="Fraction of outputs registered in the file catalog" )
+parser.add_argument( '--status',     type=float, default=0.2, help="Fraction of outputs with a production status entry" )
+parser.add_argument( '--seed',       type=int, default=1 )
+parser.add_argument( '--clean',      default=False, action='store_true', help="Remove the existing databases first" )
+
+def main():
+
+    args = parser.parse_args()
+
+    if args.backend:
+        os.environ['SLURP_DB_BACKEND'] = args.backend
+    os.environ.setdefault( 'SLURP_DB_BACKEND', 'sqlite' )
+
+    import dbbackend
+
+    selected = dbbackend.backend()
+    if not selected.startswith( 'sqlite' ):
+        print(f"dashi only seeds the local stand-in backend, not {selected}")
+        sys.exit(1)
+
+    directory = selected.partition(':')[2] or dbbackend.SQLITEDIR
+    if args.clean and pathlib.Path( directory ).is_dir():
+        shutil.rmtree( directory )
+
+    random.seed( args.seed )
+
+    daq    = dbbackend.connect( 'DSN=daq' )
+    fc     = dbbackend.connect( 'DSN=FileCatalog' )
+    status = dbbackend.connect( 'DSN=ProductionStatusWrite' )
+
+    first, nruns = args.runs
+    runs  = range( first, first + nruns )
+    hosts = [ f"ebdc{h:02d}" for h in range( args.hosts ) ]
+
+    #
+    # Raw data in the DAQ filelist and the file catalog
+    #
+    filelist = []
+    files    = []
+    datasets = []
+    for run in runs:
+        for h, host in enumerate( hosts ):
+            for seg in range( args.segments ):
+                lfn   = f"{host}_physics-{run:08d}-{seg:04d}.prdf"
+                firstevent = seg * args.events
+                lastevent  = firstevent + args.events - 1
+                filelist.append( ( f"/bbox/bbox{h%4}/{host}/physics/{lfn}", run, seg, firstevent, lastevent, args.events, True ) )
+                files   .append( ( lfn, 'lustre', f"/sphenix/lustre01/sphnxpro/physics/{host}/{lfn}", 0, 'unset' ) )
+                datasets.append( ( lfn, run, seg, 0, 'physics', host, args.events ) )
+
+    daq.cursor().executemany( "insert or replace into filelist (filename,runnumber,segment,firstevent,lastevent,events,transferred_to_sdcc) values (?,?,?,?,?,?,?)", filelist )
+    daq.commit()
+    print(f"filelist: {len(filelist)} raw files in {nruns} runs")
+
+    #
+    # Outputs already produced
+    #
+    dataset  = f"{args.build.replace('.','')}_{args.dbtag}"
+    outputs  = [ ( run, seg, f"{args.dsttype}_{dataset}-{run:08d}-{seg:05d}" ) for run in runs for seg in range( args.outsegments ) ]
+    produced = random.sample( outputs, int( len(outputs) * args.produced ) )
+    for run, seg, dstfile in produced:
+        files   .append( ( f"{dstfile}.root", 'lustre', f"/sphenix/lustre01/sphnxpro/production/{dstfile}.root", 0, 'unset' ) )
+        datasets.append( ( f"{dstfile}.root", run, seg, 0, dataset, args.dsttype, args.events ) )
+
+    fc.cursor().executemany( "insert or replace into files (lfn,full_host_name,full_file_path,size,md5,time) values (?,?,?,?,?,current_timestamp)", files )
+    fc.cursor().executemany( "insert or replace into datasets (filename,runnumber,segment,size,dataset,dsttype,events) values (?,?,?,?,?,?,?)", datasets )
+    fc.commit()
+    print(f"file catalog: {len(files)} files, {len(produced)} produced outputs of {args.dsttype}_{dataset}")
+
+    #
+    # Production setup and status
+    #
+    curs = status.cursor()
+    curs.execute( "insert or ignore into production_setup (name,build,dbtag,repo,dir,hash) values (?,?,?,?,?,?)", ( args.dsttype, args.build, args.dbtag, 'local', '.', 'dashi' ) )
+    prod_id = curs.execute( "select id from production_setup where name=? and build=? and dbtag=? and hash=?", ( args.dsttype, args.build, args.dbtag, 'dashi' ) ).fetchone().id
+
+    now  = str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) )
+    rows = []
+    for run, seg, dstfile in random.sample( outputs, int( len(outputs) * args.status ) ):
+        state = random.choice( dbbackend.PRODSTATES )
+        rows.append( ( args.dsttype, f"{args.dsttype}_{dataset}", dstfile, run, seg, 0, 'unset', 'unset', prod_id, 0, 0, state, now, 0, 'dashi' ) )
+    curs.executemany( "insert into production_status (dsttype,dstname,dstfile,run,segment,nsegments,inputs,ranges,prod_id,cluster,process,status,submitting,nevents,submission_host) values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows )
+    status.commit()
+    print(f"production status: {len(rows)} entries")
+
+if __name__ == '__main__':
+    main()
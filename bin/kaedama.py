@@ -1,6 +1,8 @@
 #!/usr/bin/env python 
 
 import cProfile
+import pstats
+import tracemalloc
 #import slurp
 import yaml
 import datetime
@@ -21,11 +23,20 @@ from slurp import SEGFMT as SEGFMT_
 
 from slurp import PRODUCTION_MODE
 from slurp import get_production_cursor
+from slurp import dbrouter
+
+from dbpool import pool as dbpool
+from dbstats import stats as dbstats
+from stagetimer import stages
+from sharedinputs import shared
+from gitcache import payloads
 
 import sh
 import sys
 import re
 import os
+import io
+import copy
 
 import platform
 
@@ -33,12 +44,14 @@ import platform
 
 import logging
 from logging.handlers import RotatingFileHandler
+from contextlib import redirect_stdout, redirect_stderr
 
 import pprint
 
 # Extend the command line arguments
 arg_parser.add_argument( '-n', '--nevents', default=0, dest='nevents', help='Number of events to process.  0=all.', type=int)
 arg_parser.add_argument( '--rule', help="Submit against specified rule", default="DST_EVENT" )
+arg_parser.add_argument( '--rules', nargs='+', default=None, help="Submit against each of the specified rules in turn.  Rules with the same input query share its evaluation" )
 arg_parser.add_argument( '--limit', help="Maximum number of jobs to submit", default=0, type=int )
 arg_parser.add_argument( '--submit',help="Job will be submitted", dest="submit", default="True", action="store_true")
 arg_parser.add_argument( '--no-submit', help="Job will not be submitted... print things", dest="submit", action="store_false")
@@ -58,6 +71,8 @@ arg_parser.add_argument( '--print-query',dest='printquery',help="Print the query
 arg_parser.add_argument( '--append-to-rsync', dest='append2rsync', default=None,help="Appends the argument to the list of rsync files to copy to the worker node" )
 
 arg_parser.add_argument( '--logdir', dest='logdir', default=None, help="Directory for kaedama logging (defaults under /tmp)" )
+arg_parser.add_argument( '--dbstats', dest='dbstats', default=None, help="File to which per-query DB statistics are appended as JSON lines (defaults to dbstats.jsonl in the log directory)" )
+arg_parser.add_argument( '--profile', dest='profile', nargs='*', default=None, choices=['memory','cprofile'], help="Writes the time spent in each phase to a report next to the log.  Optionally traces the peak memory of each phase and/or dumps cProfile statistics" )
 
 arg_parser.add_argument( '--advance-cursor', dest='advance_cursor', default=False, action="store_true", help="Advances the production run cursor to the last run submitted (sticks to last running job)")
 arg_parser.add_argument( '--ratchet-cursor', dest='ratchet_cursor', default=False, action="store_true", help="Advances the production run cursor to the last run submitted")
@@ -144,6 +159,28 @@ def sanity_checks( params, inputq ):
 #        logging.warn( "Read and write instance of status db are out of sync / or could not connect to one or both." )
 #    return (idr,idw)
 
+# Parsed yaml configurations keyed on path, with the mtime they were read at
+_configs = {}
+
+def load_config( path ):
+    """
+    Returns the parsed yaml configuration.  The parsed file is kept for later invocations
+    in the same process (see ramenya2 submit) and read again once its mtime changes.  As
+    dispatch_rule modifies the rule blocks, each caller receives its own copy.
+    """
+    mtime  = os.stat( path ).st_mtime_ns
+    cached = _configs.get( path, None )
+    if cached is None or cached[0] != mtime:
+        config = {}
+        with open(path,"r") as stream:
+            try:
+                config = yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                print(f"Could not open {path}")
+                print(exc)
+        cached = _configs[ path ] = ( mtime, config )
+    return copy.deepcopy( cached[1] )
+
 def checkRequiredParams( params ):
 
     fatal=False
@@ -157,10 +194,17 @@ def checkRequiredParams( params ):
         
     
 
-def main():
+def main( argv=None ):
+    """
+    Runs kaedama with the given command line arguments (defaults to sys.argv).  May be
+    called repeatedly from a long lived process, which then reuses the pooled database
+    connections and parsed configuration files between calls.  Returns the number of
+    jobs dispatched.
+    """
 
     # parse command line options
-    args, userargs = parse_command_line()
+    argv = sys.argv[1:] if argv is None else [ str(a) for a in argv ]
+    args, userargs = parse_command_line( argv )
 
     mycwd = pathlib.Path(".")
     if 'testbed' in str(mycwd.absolute()).lower() or pathlib.Path(".slurp/testbed").is_file():
@@ -171,10 +215,14 @@ def main():
         args.mangle_dirpath = 'production-testbed'
         
 
+    if args.rules:
+        args.rule = ' '.join( args.rules )
+    logname = args.rule if not args.rules else 'rules'
+
     if args.test_mode:
-        mylogdir=f"/tmp/testbed/kaedama/{args.rule}"; #{str(datetime.datetime.today().date())}.log",
+        mylogdir=f"/tmp/testbed/kaedama/{logname}"; #{str(datetime.datetime.today().date())}.log",
     else:
-        mylogdir=f"/tmp/kaedama/kaedama/{args.rule}"; #{str(datetime.datetime.today().date())}.log",
+        mylogdir=f"/tmp/kaedama/kaedama/{logname}"; #{str(datetime.datetime.today().date())}.log",
     pathlib.Path(mylogdir).mkdir( parents=True, exist_ok=True )
 
     if args.logdir:
@@ -191,8 +239,10 @@ def main():
         delay=0
     )
 
-    # n.b. Adding the stream handler will echo to stdout
+    # n.b. Adding the stream handler will echo to stdout.  The handlers of a previous call
+    #      in the same process are closed and replaced (force).
     logging.basicConfig(
+        force=True,
         level=logging.INFO,
         format="%(asctime)s [%(levelname)s] %(message)s",
         handlers=[
@@ -202,6 +252,16 @@ def main():
         ]
     )
 
+    profiler = None
+    if args.profile is not None:
+        if 'memory' in args.profile:
+            tracemalloc.start()
+        if 'cprofile' in args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+    # Time spent in each phase of the invocation is accounted in stagetimer as kaedama.<phase>
+    laps = stages.laps( 'kaedama' )
 
 #    # require consistent database
 #    (idr, idw) = dbconsistency()
@@ -218,14 +278,68 @@ def main():
 #    logging.info(f"Executing kaedama on {platform.node()} pid {os.getpid()}")
 #    logging.info(f"DB consistency.  Master at {idw} replica at {idr}.")
 
-    config={}
-    with open(args.config,"r") as stream:
-        try:
-            config = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(f"Could not open {args.config}")
-            print(exc)
-
+    config = load_config( args.config )
+    laps.lap( 'yaml' )
+
+    # Rules reading the same inputs evaluate them once (see sharedinputs)
+    rulenames = args.rules or [ args.rule ]
+    shared.active = len(rulenames) > 1
+
+    ndispatched = 0
+    for rulename in rulenames:
+        ndispatched += dispatch_rule( args, config, rulename, laps ) or 0
+
+    if shared.active:
+        shared.report( logging.info )
+        shared.clear()
+        shared.active = False
+
+    # Connection reuse and per-query cost for this invocation
+    dbpool.report( logging.info )
+    dbrouter.report( logging.info )
+    dbstats.report( logging.info )
+    payloads.report( logging.info )
+    dbstats.dump( args.dbstats or f"{mylogdir}/dbstats.jsonl", rule=args.rule, config=args.config )
+    dbstats.clear()
+
+    if args.profile is not None:
+        profile_report( args, argv, mylogdir, profiler )
+    stages.clear()
+
+    return ndispatched
+
+def run( argv, verbose=False, maxjobs=None ):
+    """
+    Runs main() on the given arguments, for callers which run kaedama in their own
+    process (see ramenya2 submit).  Output is discarded unless verbose, as for a kaedama
+    subprocess, and maxjobs (if given) overrides the --maxjobs argument.  Returns the
+    number of jobs dispatched, or None if kaedama exited early.  A nonzero exit raises
+    RuntimeError with the tail of the discarded output.
+    """
+    argv = list( argv )
+    if maxjobs is not None:
+        argv += [ "--maxjobs", str(maxjobs) ]
+
+    output  = io.StringIO()
+    streams = []
+    try:
+        with redirect_stdout( sys.stdout if verbose else output ), redirect_stderr( sys.stderr if verbose else output ):
+            if not verbose:
+                streams = [ ( h, h.setStream( output ) ) for h in logging.getLogger('slurp').handlers if type(h) == logging.StreamHandler ]
+            return main( argv )
+    except SystemExit as e:
+        if e.code not in ( None, 0 ):
+            raise RuntimeError( f"kaedama exited with status {e.code}\n{output.getvalue()[-2000:]}" )
+        return None
+    finally:
+        for h, stream in streams:
+            h.setStream( stream )
+
+def dispatch_rule( args, config, rulename, laps ):
+    """
+    Builds the named rule from the configuration and submits its matches.  Returns the
+    number of jobs dispatched.
+    """
     run_condition = ""
     if len(args.runs)==1 and args.runs[0] != 'cursor':
         run_condition = f"and runnumber={args.runs[0]} "
@@ -270,13 +384,13 @@ def main():
         
     # Reduce configuration to this rule
     try:
-        config = config[ args.rule ]
+        config = config[ rulename ]
     except KeyError:
-        logging.error(f"Could not locate '{args.rule}' in configuration file")
+        logging.error(f"Could not locate '{rulename}' in configuration file")
         pprint.pprint( config.keys() )
         return
 
-    logging.info( f"Executing rule {args.rule} where ... {run_condition} {seg_condition} {limit_condition}" )
+    logging.info( f"Executing rule {rulename} where ... {run_condition} {seg_condition} {limit_condition}" )
 
     #
     # Get  the user parameters and append additional payload if specified on the command line.
@@ -309,6 +423,7 @@ def main():
         print( params.get('version',None) )
         runcursor=get_production_cursor( params['name'], params['build_name'], params['dbtag'], params['version'] )
         run_condition=run_condition.replace('cursor',str(runcursor))
+    laps.lap( 'cursor' )
 
     if params:
 
@@ -362,7 +477,7 @@ def main():
                 
 
     # Default filesystem.  Override with vaules specified in the workflow.
-    filesystem   = _default_filesystem
+    filesystem   = dict( _default_filesystem )
     filesystem_  = config.get('filesystem',{} )
     for k,v in filesystem_.items():
         filesystem[k] = v
@@ -482,7 +597,9 @@ def main():
         #
         submitkw = { kw : val for kw,val in params.items() if kw in ["mem","disk","dump", "neventsper"] }
 
+        laps.lap( 'rule' )
         dispatched = submit (dst_rule, args.maxjobs, nevents=args.nevents, **submitkw, **filesystem ) 
+        laps.lap( 'submit' )
 
         batch="batch"
         if args.batch==False:
@@ -499,15 +616,41 @@ def main():
                 arr.append( tup[1] )
 
 
-        logging.info( f"Dispatched ({batch} {args.runs}) {args.rule}: {params['name']} {ndisp} dispatched" )
+        logging.info( f"Dispatched ({batch} {args.runs}) {rulename}: {params['name']} {ndisp} dispatched" )
         logging.info( f"  with {args}" )        
         keys = runcount.keys()
         for k in keys:
             logging.info( f"Dispatched run {k} segments: {','.join(runcount[k])}" )
 
+        return ndisp
+
+def profile_report( args, argv, mylogdir, profiler ):
+    """
+    Appends the time (and memory) spent in each phase to <date>.profile next to the
+    rotating log, and the phase statistics to profile.jsonl.  With cprofile the
+    profile is dumped to <date>-<time>.pstats and the top functions are added to the
+    report.
+    """
+    now    = datetime.datetime.today()
+    report = f"{mylogdir}/{str(now.date())}.profile"
+    with open( report, 'a' ) as f:
+        f.write( f"# {now.replace(microsecond=0)} {platform.node()} pid {os.getpid()} rule {args.rule} config {args.config}\n" )
+        f.write( f"# kaedama.py {' '.join(argv)}\n" )
+        stages.report( log=lambda line: f.write( line + '\n' ) )
+        if profiler:
+            profiler.disable()
+            dump = f"{mylogdir}/{str(now.date())}-{now.strftime('%H%M%S')}.pstats"
+            profiler.dump_stats( dump )
+            f.write( f"# cProfile statistics in {dump}\n" )
+            pstats.Stats( profiler, stream=f ).sort_stats( 'cumulative' ).print_stats( 30 )
+        f.write( '\n' )
+    stages.dump( f"{mylogdir}/profile.jsonl", rule=args.rule, config=args.config )
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    logging.info( f"Profile of {args.rule} written to {report}" )
+
             
 
 
 if __name__ == '__main__': 
-    #cProfile.run('main()')
     main()
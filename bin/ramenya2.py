@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import sh
 from time import sleep
 from contextlib import redirect_stdout
 import sys
@@ -17,11 +16,18 @@ from tqdm import tqdm
 import pydoc
 import datetime
 import traceback
+import random
 import yaml
 
 import htcondor
+from condorschedd import Schedd
 import classad
 
+from dbstats import stats as dbstats, InstrumentedCursor
+from dbbackend import connect as dbconnect
+from dbstatements import bulk_blocks
+from dispatcher import RuleDispatcher, SPhnxRuleTask
+
 import signal
 import select 
 
@@ -36,10 +42,6 @@ def OnCTRLC(sn,fr):
         else:
             pass
 
-signal.signal(signal.SIGINT, OnCTRLC)
-
-init()
-
 import fcntl
 import os
 
@@ -137,25 +139,41 @@ def apply_colorization(row,default_color=(Back.RESET,Fore.GREEN),fail_color=(Bac
 colorize=apply_colorization
 tablefmt="psql"
 
-statusdbr_ = pyodbc.connect("DSN=ProductionStatus")
-statusdbr = statusdbr_.cursor()
+# Set up by startup().  n.b. the workers of the rule dispatcher are spawned, and import this
+# module again (as __mp_main__), so nothing is connected or installed on import.
+statusdbr_ = None
+statusdbr  = None
+timestart  = None
 
-try:
-    statusdbr_ = pyodbc.connect("DSN=ProductionStatus")
-    statusdbr = statusdbr_.cursor()
-except pyodbc.InterfaceError:
-    for s in [ 10*random.random(), 20*random.random(), 30*random.random() ]:
-        print(f"Could not connect to DB... retry in {s}s")
-        time.sleep(s)
-        try:
-            statusdbr_ = pyodbc.connect("DSN=ProductionStatus")
-            statusdbr = statusdbr_.cursor()
-        except:
-            exit(0)
+def startup():
+    """
+    Installs the ctrl-c handler, opens the read connection to the production status and
+    marks the start of this invocation.
+    """
+    global statusdbr_
+    global statusdbr
+    global timestart
 
+    signal.signal(signal.SIGINT, OnCTRLC)
 
-timestart=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
-time.sleep(1)
+    init()
+
+    try:
+        statusdbr_ = dbconnect("DSN=ProductionStatus")
+        statusdbr = InstrumentedCursor( statusdbr_.cursor() )
+    except pyodbc.InterfaceError:
+        for s in [ 10*random.random(), 20*random.random(), 30*random.random() ]:
+            print(f"Could not connect to DB... retry in {s}s")
+            time.sleep(s)
+            try:
+                statusdbr_ = dbconnect("DSN=ProductionStatus")
+                statusdbr = InstrumentedCursor( statusdbr_.cursor() )
+                break
+            except:
+                exit(0)
+
+    timestart=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+    time.sleep(1)
 
 # https://mike.depalatis.net/blog/simplifying-argparse
 
@@ -164,6 +182,7 @@ subparsers = parser.add_subparsers(dest="subcommand")
 
 parser.add_argument( "-v", "--verbose",dest="verbose"   , default=False, action="store_true", help="Sets verbose output")
 parser.add_argument(       "--html",dest="html"   , default=False, action="store_true", help="Sets html output")
+parser.add_argument(       "--dbstats",dest="dbstats", default=None, help="Prints per-query DB statistics and appends them as JSON lines to the given file")
 #parser.add_argument( '--runs', nargs='+', help="One argument for a specific run.  Two arguments an inclusive range.  Three or more, a list", default=[0,999999] )
 #parser.add_argument( '--config',help="Specifies the configuration file used by kaedama to specify workflows", default='sphenix_auau23.yaml')
 #parser.add_argument( '--rules', nargs='+', default="['all']" )
@@ -405,8 +424,8 @@ def query_jobs_by_run(conditions="", title="Summary of jobs by run" ):
 def query_jobs_held_by_condor(conditions="true", title="Summary of jobs by with condor state",  ):
     # Write connection to DB
     try:
-        statusdbw_ = pyodbc.connect("DSN=ProductionStatusWrite")
-        statusdbw = statusdbw_.cursor()
+        statusdbw_ = dbconnect("DSN=ProductionStatusWrite")
+        statusdbw = InstrumentedCursor( statusdbw_.cursor() )
     except (pyodbc.InterfaceError, pyodbc.Error,pyodbc.ProgrammingError) as e:
         print("... could not query the db ... skipping report")
         return
@@ -420,7 +439,7 @@ def query_jobs_held_by_condor(conditions="true", title="Summary of jobs by with
         del statusdbw
         return
 
-    schedd = htcondor.Schedd() 
+    schedd = Schedd()
 
     # Query held jobs
     try:
@@ -465,23 +484,19 @@ def query_jobs_held_by_condor(conditions="true", title="Summary of jobs by with
         except KeyError:
             pass
 
+    updates = []
     for i,cq in c2cq.items():
 
         # First 512 characters of the message
         message=str(cq['HoldReason']).replace("'"," ") [:512]
         enteredcurrentstatus=str(cq['EnteredCurrentStatus'])
-        update = f"""
-        update production_status
-        set status='failed', 
-            flags=5,
-            message='{message}',
-            ended='{enteredcurrentstatus}'
-        where id={i};
-        """
-        print(update)
-
-        statusdbw.execute(update)
-        statusdbw.commit()
+        print(f"id={i} failed: {message}")
+        updates.append( ( message, enteredcurrentstatus, i ) )
+
+    # A single set based update per block of held jobs
+    for update, params in bulk_blocks( 'status.held.failed', updates ):
+        statusdbw.execute( update, params, name='status.held.failed' )
+    statusdbw.commit()
 
     # Delete (and drop connection) to the DB
     del statusdbw
@@ -515,7 +530,7 @@ def query_jobs_by_condor(conditions="", title="Summary of jobs by with condor st
         print("... could not query the db ... skipping report")
         return
 
-    schedd = htcondor.Schedd() 
+    schedd = Schedd()
     condor_job_status_map = {
         1:"Idle",
         2:"Running",
@@ -608,6 +623,10 @@ def getArgsForRule( yaml, r ):
     # Transform into a list of arguments
     for k,v in ruleargs.items():
 
+        # ramenya options, not passed to kaedama
+        if k in [ 'isolate', 'timeout' ]:
+            continue
+
         flag=k.replace("_","-")
         result.append(f"--{flag}")
         
@@ -622,6 +641,28 @@ def getArgsForRule( yaml, r ):
             
     return result
 
+def isolateRule( yaml, r ):
+    """
+    True if the rule requests (isolate: true) to run in a kaedama process of its own.
+    """
+    return bool( ( yaml.get(r, None) or {} ).get( 'isolate', False ) )
+
+def timeoutForRule( yaml, r ):
+    """
+    Returns the timeout (in seconds) requested by the rule, or None.
+    """
+    return ( yaml.get(r, None) or {} ).get( 'timeout', None )
+
+def maxjobsInArgs( argv ):
+    """
+    Returns the value of the last --maxjobs in the kaedama arguments, or None.
+    """
+    result = None
+    for flag, value in zip( argv, argv[1:] ):
+        if flag == "--maxjobs":
+            result = int(value)
+    return result
+
 
 @subcommand([
     argument( '--nevents', help="Specifies number of events to submit (defaults to all)", default=0 ),
@@ -630,11 +671,16 @@ def getArgsForRule( yaml, r ):
     argument( "--delay", default=300, help="Set the loop delay",type=int),
     argument( "--rules", default=[], nargs="?", help="Sets the name of the rule to be used"),
     argument( "--rules-file", dest="rules_file", default=None, help="If specified, read the list of active rules from the given file on each pass of the loop" ),
-    argument( "--rules-yaml", dest="rules_yaml", default=None, help="If specified, executes each rule in turn setting kaedama arguments specific to each rule" ),
+    argument( "--rules-yaml", dest="rules_yaml", default=None, help="If specified, executes each rule in turn setting kaedama arguments specific to each rule.  A rule with isolate: true runs in a kaedama process of its own, and timeout: <seconds> overrides --rule-timeout" ),
     argument( "--timestart",default=datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0),help="Specifies UTC timestamp (in ISO format, e.g. YYYY-MM-DD) for query.", type=dateutil.parser.parse),
     argument( "--test",default=False,help=argparse.SUPPRESS,action="store_true"), # kaedama will be submitted in batch mode
     argument( "--experiment-mode", default=None, help="Sets experiment-mode for kaedama", dest="mode" ),
     argument( "--resubmit", default=False, action="store_true", help="Adds the -r option to kaedama" ),
+    argument( "--incremental", default=False, action="store_true", help="Adds the --incremental option to kaedama (only new candidates are evaluated between full reconciliations)" ),
+    argument( "--isolate", default=False, action="store_true", help="Runs each rule in a kaedama process of its own rather than in a reused worker" ),
+    argument( "--parallel", default=1, type=int, help="Number of rules run concurrently (each in a kaedama worker process)" ),
+    argument( "--rule-timeout", dest="rule_timeout", default=None, type=float, help="Kills a rule which runs for longer than the given number of seconds" ),
+    argument( "--share-inputs", dest="share_inputs", default=False, action="store_true", help="Runs the rules with the same kaedama arguments in a single kaedama invocation, which evaluates shared input queries once" ),
     argument( "--maxjobs", default=10000, help="Maximum number of jobs to submit in one cycle of the loop" ),
     argument( "--maxcondor",default=75000, help="Do not submit if more than maxcondor jobs are in the system.  Terminate the loop if we exceed 150%% of this value.",type=int),
     argument( "--watermark",default=1.05,help="Watermark expressed as a multiple of max condor.  When we exceed this value we exit or cycle the loop depending on the next option" ),
@@ -655,7 +701,7 @@ def submit(args):
 
     global timestart
     timestart=str(args.timestart)
-    kaedama  = sh.Command("kaedama.py" )
+    kaedama_args = []
 
     # If provided read in yaml rules file.  The rules_yaml will be an empty dictionary... the args.rules_yaml
     # determines whether or not the file is loaded.
@@ -668,30 +714,37 @@ def submit(args):
     else:
         
         if args.dbinput:
-            kaedama = kaedama.bake( "submit", "--config", args.SLURPFILE, "--nevents", args.nevents, "--maxjobs", int(args.maxjobs), "--dbinput" )
+            kaedama_args += [ "submit", "--config", args.SLURPFILE, "--nevents", args.nevents, "--maxjobs", int(args.maxjobs), "--dbinput" ]
         else:
-            kaedama = kaedama.bake( "submit", "--config", args.SLURPFILE, "--nevents", args.nevents, "--maxjobs", int(args.maxjobs), "--no-dbinput" )
+            kaedama_args += [ "submit", "--config", args.SLURPFILE, "--nevents", args.nevents, "--maxjobs", int(args.maxjobs), "--no-dbinput" ]
 
         if args.test:
-            kaedama = kaedama.bake( "--batch" )
+            kaedama_args += [ "--batch" ]
         if args.mode is not None:
-            kaedama = kaedama.bake( "--experiment-mode", args.mode )
+            kaedama_args += [ "--experiment-mode", args.mode ]
         if args.resubmit:
-            kaedama.bake( "-r ")
+            pass # "-r" is not passed on (kaedama asks for confirmation of a resubmission)
+        if args.incremental:
+            kaedama_args += [ "--incremental" ]
 
         if   len(args.runs)==1: 
-            kaedama = kaedama.bake( runs=args.runs[0] )
+            kaedama_args += [ f"--runs={args.runs[0]}" ]
             runreport = f"runs: {args.runs[0]}"
         elif len(args.runs)==2: 
-            kaedama = kaedama.bake( "--runs", args.runs[0], args.runs[1] )
+            kaedama_args += [ "--runs", args.runs[0], args.runs[1] ]
             runreport = f"runs: {args.runs[0]} to {args.runs[1]}"
         elif len(args.runs)==3: 
-            kaedama = kaedama.bake( "--runs", args.runs[0], args.runs[1], args.runs[2] )
+            kaedama_args += [ "--runs", args.runs[0], args.runs[1], args.runs[2] ]
             runreport = f"runs: {args.runs}"
         else:                   
-            kaedama = kaedama.bake( "--runs", "0", "999999" )
+            kaedama_args += [ "--runs", "0", "999999" ]
             runreport = f"runs: 0 to 999999"
 
+    # Rules run in a pool of kaedama worker processes, which are reused from cycle to cycle
+    # (unless isolated).  A crashed or timed out worker is replaced.
+    import kaedama
+    dispatcher = RuleDispatcher( kaedama.run, width=args.parallel )
+
     tracebacks = []
     successes  = []
 
@@ -730,7 +783,7 @@ def submit(args):
         tracebacks = []
 
         # Verify that there is enough room on condor to submit
-        schedd = htcondor.Schedd() 
+        schedd = Schedd()
         ncondor = 1E9
 
         with mutex:
@@ -778,24 +831,47 @@ def submit(args):
 
             else:
 
+                # Each rule is passed to its own kaedama, or rules sharing the same arguments to a single one
+                groups = {}
                 for r in list_of_active_rules:
-                    print( f"{Fore.GREEN}Trying rule ... {r} {datetime.datetime.now().replace(microsecond=0)}{Fore.RESET}" )
-
-                    try:
-                        myargs = getArgsForRule( rules_yaml, r )
-                        if args.verbose:
-                            kaedama( myargs, "--batch", "--rule", r, _out=sys.stdout )
-                        else:
-                            kaedama( myargs, "--batch", "--rule", r )
-                        successes.append(r)
-                    except sh.ErrorReturnCode_1:
-                        print(traceback.format_exc())
-                        tracebacks.append( r )
-            
+                    myargs = getArgsForRule( rules_yaml, r )
+                    key = tuple(myargs) if args.share_inputs else r
+                    groups.setdefault( key, ( myargs, [] ) )[1].append( r )
+
+                tasks = []
+                for myargs, rs in groups.values():
+                    print( f"{Fore.GREEN}Trying rule ... {' '.join(rs)} {datetime.datetime.now().replace(microsecond=0)}{Fore.RESET}" )
+
+                    selection = [ "--rule", rs[0] ] if len(rs)==1 else [ "--rules", *rs ]
+                    argv      = [ *kaedama_args, *myargs, "--batch", *selection ]
+                    timeouts  = [ t for t in [ timeoutForRule( rules_yaml, r ) for r in rs ] if t ]
+                    tasks.append( SPhnxRuleTask( name    = ' '.join(rs),
+                                                 args    = ( argv, args.verbose ),
+                                                 maxjobs = maxjobsInArgs( [ str(a) for a in argv ] ),
+                                                 timeout = min( timeouts, default=None ),
+                                                 isolate = args.isolate or any( [ isolateRule( rules_yaml, r ) for r in rs ] ) ) )
+
+                # Rules may not take the schedd past maxcondor between them
+                capacity = int(args.maxcondor) - ncondor
+                start    = time.monotonic()
+                results  = dispatcher.dispatch( tasks, capacity=capacity, timeout=args.rule_timeout )
+
+                for ( myargs, rs ), result in zip( groups.values(), results ):
+                    if result.status == 'ok':
+                        successes.extend(rs)
+                    else:
+                        if result.error: print( result.error )
+                        tracebacks.extend( rs )
+
+                print( f"Cycle of {len(tasks)} rules over {dispatcher.width} workers took {time.monotonic()-start:.1f}s (capacity {capacity})" )
+                print( tabulate( [ [ r.name, r.status, r.jobs, r.budget, f"{r.wall:.1f}", r.pid ] for r in results ],
+                                 [ 'rule', 'status', 'jobs', 'budget', 'wall [s]', 'pid' ], tablefmt=tablefmt ) )
 
         if args.loop==False: break
         countdown( args.delay )
 
+    dispatcher.close()
+
 query_choices=[
     "submitted",
     "started",
@@ -856,10 +932,10 @@ def query(args):
 def remove(args):
     """
     """
-    statusdbw_ = pyodbc.connect("DSN=ProductionStatusWrite")
+    statusdbw_ = dbconnect("DSN=ProductionStatusWrite")
     statusdbw  = statusdbw_.cursor()
 
-    filecatw_  = pyodbc.connect("DSN=FileCatalogWrite;UID=phnxrc")
+    filecatw_  = dbconnect("DSN=FileCatalogWrite;UID=phnxrc")
     filecatw   = filecatw_.cursor()
 
     segment_condition = ""
@@ -932,11 +1008,18 @@ def noodles( args_=None ):
     if args.html:
         colorize = no_colorization
         tablefmt = "html"
+
+    startup()
+
     if args.subcommand is None:
         parser.print_help()
     else:
         args.func(args)        
 
+    if args.dbstats:
+        dbstats.report( print )
+        dbstats.dump( args.dbstats, subcommand=args.subcommand )
+
 
 if __name__ == '__main__':
     noodles()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""
+Selects the condor schedd used by slurp and ramenya2.
+
+By default Schedd() returns htcondor.Schedd().  An in-process fake schedd may be
+selected with the SLURP_SCHEDD environment variable, or by the contents of the file
+.slurp/schedd (the environment takes precedence), for offline measurements of the
+dispatch throughput:
+
+    SLURP_SCHEDD=fake
+    SLURP_SCHEDD=fake:latency=0.2,perjob=0.0001,state=.slurp/fakeschedd.ads
+
+The fake schedd accepts htcondor.Submit descriptions with itemdata, assigns ClusterId
+and ProcId, expands the $(var) and $INT(var,fmt) macros, and stores one job ad per
+item (including the +sPHENIX_* attributes).  query() and act() evaluate their
+constraints with the classad library, so the sPHENIX_* constraints used by slurp
+behave as they would against the real schedd.  Every call sleeps for latency
+seconds (plus perjob seconds for each job submitted).  If a state file is given
+the job ads are kept there between invocations (e.g. kaedama runs started by
+ramenya2).  The state file is a journal: each call appends the ads it creates or
+changes (and a marker for each job removed), so that the cost of a call does not
+grow with the number of jobs held.  The journal is compacted when it is loaded.
+
+Several processes may share a state file (ramenya2 and the kaedama runs it starts).
+Each call holds an exclusive lock (fcntl) on the state file's .lock companion, and
+first replays the records appended by the other processes since its previous call,
+so that ClusterIds are allocated from the shared state and queries see every job.
+"""
+
+import os
+import re
+import time
+import fcntl
+import pathlib
+import threading
+import contextlib
+
+import htcondor
+import classad
+
+SCHEDDFILE = '.slurp/schedd'
+
+# Attribute of the journal records marking a removed job
+_REMOVED = 'FakeScheddRemoved'
+
+# Job attributes set from the submit commands
+_attributes = {
+    'executable'     : 'Cmd',
+    'arguments'      : 'Args',
+    'output'         : 'Out',
+    'error'          : 'Err',
+    'log'            : 'UserLog',
+    'batch_name'     : 'JobBatchName',
+    'request_memory' : 'RequestMemory',
+    'request_disk'   : 'RequestDisk',
+    'request_cpus'   : 'RequestCpus',
+    'priority'       : 'JobPrio',
+    'accounting_group' : 'AcctGroup',
+}
+
+_macro    = re.compile( r"\$\((\w+)\)" )
+_intmacro = re.compile( r"\$INT\((\w+)(?:,([^)]*))?\)" )
+
+def _value( text ):
+    """
+    Converts the text of a classad expression into a value.
+    """
+    text = str(text).strip()
+    if len(text)>1 and text[0]=='"' and text[-1]=='"':
+        return text[1:-1]
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return classad.ExprTree( text ).eval()
+    except Exception:
+        return text
+
+class FakeSubmitResult:
+    def __init__( self, cluster, first, count ):
+        self._cluster = cluster
+        self._first   = first
+        self._count   = count
+
+    def cluster( self ):
+        return self._cluster
+
+    def first_proc( self ):
+        return self._first
+
+    def num_procs( self ):
+        return self._count
+
+    def __str__( self ):
+        return f"{self._count} job(s) submitted to cluster {self._cluster}."
+
+class FakeSchedd:
+    """
+    In-process stand in for htcondor.Schedd (query, submit and act).
+    """
+    def __init__( self, latency=0.0, perjob=0.0, state=None ):
+        self.latency  = float(latency)
+        self.perjob   = float(perjob)
+        self.state    = state
+        self.jobs     = {}    # (cluster, proc) -> job ad
+        self.cluster  = 0
+        self._lock    = threading.Lock()
+        self._inode   = None  # journal replayed so far: inode, bytes and records
+        self._offset  = 0
+        self._records = 0
+        if state:
+            with self._locked():
+                if self._records > len(self.jobs) + 1:
+                    self._compact()
+
+    #
+    # Persistence of the job ads between invocations
+    #
+    @contextlib.contextmanager
+    def _locked( self ):
+        """
+        Serializes a call with the other threads and, given a state file, with the
+        other processes sharing it.  The journal is replayed up to date on entry.
+        """
+        with self._lock:
+            if not self.state:
+                yield
+                return
+            pathlib.Path( self.state ).parent.mkdir( parents=True, exist_ok=True )
+            with open( f"{self.state}.lock", 'a' ) as lock:
+                fcntl.flock( lock, fcntl.LOCK_EX )   # released when closed
+                self._replay()
+                yield
+
+    def _replay( self ):
+        """
+        Applies the journal records appended since the last call.
+        """
+        path = pathlib.Path( self.state )
+        if not path.is_file():
+            return
+        stat = path.stat()
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # new, or compacted by another process: replayed from the start
+            self.jobs, self._inode, self._offset, self._records = {}, stat.st_ino, 0, 0
+        if stat.st_size == self._offset:
+            return
+        with open( path, 'rb' ) as f:
+            f.seek( self._offset )
+            text = f.read()
+        self._offset += len(text)
+        for ad in classad.parseAds( text.decode() ):
+            self._records += 1
+            if 'ClusterId' not in ad:
+                self.cluster = max( self.cluster, int( ad.get( 'LastClusterId', 0 ) ) )
+                continue
+            key = ( int(ad['ClusterId']), int(ad['ProcId']) )
+            self.cluster = max( self.cluster, key[0] )
+            if ad.get( _REMOVED, False ):
+                self.jobs.pop( key, None )
+            else:
+                self.jobs[key] = ad
+
+    def _compact( self ):
+        """
+        Rewrites the journal with the current ads.
+        """
+        header = classad.ClassAd( { 'LastClusterId' : self.cluster } )
+        tmp = f"{self.state}.tmp"
+        with open( tmp, 'w' ) as f:
+            f.write( str(header) )
+            for ad in self.jobs.values():
+                f.write( str(ad) )
+        os.replace( tmp, self.state )
+        stat = os.stat( self.state )
+        self._inode, self._offset, self._records = stat.st_ino, stat.st_size, len(self.jobs) + 1
+
+    def _save( self, ads=(), removed=() ):
+        """
+        Appends the ads created or changed, and the keys of the jobs removed, to the journal.
+        """
+        if not self.state:
+            return
+        records = [ str(ad) for ad in ads ]
+        records += [ str( classad.ClassAd( { 'ClusterId' : cluster, 'ProcId' : proc, _REMOVED : True } ) ) for cluster, proc in removed ]
+        with open( self.state, 'ab' ) as f:
+            f.write( ''.join( records ).encode() )
+            stat = os.fstat( f.fileno() )
+        # the journal was replayed on entry and is locked, so it now ends with our records
+        self._inode, self._offset = stat.st_ino, stat.st_size
+        self._records += len(records)
+
+    def _sleep( self, njobs=0 ):
+        delay = self.latency + self.perjob * njobs
+        if delay > 0:
+            time.sleep( delay )
+
+    #
+    # Macro expansion
+    #
+    def _expand( self, text, item, description, depth=0 ):
+        def lookup( name ):
+            for source in ( item, description ):
+                if name in source:
+                    return str( source[name] )
+            lname = name.lower()
+            for source in ( item, description ):
+                for k, v in source.items():
+                    if k.lower() == lname:
+                        return str(v)
+            return ''
+        def intmacro( m ):
+            value = lookup( m.group(1) )
+            if depth < 5: value = self._expand( value, item, description, depth+1 )
+            fmt = m.group(2) or '%d'
+            return fmt % int(value)
+        def macro( m ):
+            value = lookup( m.group(1) )
+            if depth < 5: value = self._expand( value, item, description, depth+1 )
+            return value
+        text = _intmacro.sub( intmacro, text )
+        return _macro.sub( macro, text )
+
+    def _jobad( self, description, item, cluster, proc, now ):
+        variables = dict( item )
+        variables.update( { 'ClusterId' : cluster, 'Cluster' : cluster, 'ProcId' : proc, 'Process' : proc } )
+
+        ad = classad.ClassAd()
+        ad['ClusterId']            = cluster
+        ad['ProcId']               = proc
+        ad['JobStatus']            = 1
+        ad['QDate']                = now
+        ad['EnteredCurrentStatus'] = now
+        ad['ExecutableSize']       = 0
+        ad['Owner']                = os.getenv( 'USER', 'nobody' )
+
+        for k, v in description.items():
+            if k.startswith( 'MY.' ):
+                ad[ k[3:] ] = _value( self._expand( str(v), variables, description ) )
+            elif k.startswith( '+' ):
+                ad[ k[1:] ] = _value( self._expand( str(v), variables, description ) )
+            elif k.lower() in _attributes:
+                ad[ _attributes[ k.lower() ] ] = self._expand( str(v), variables, description )
+        for k, v in item.items():
+            if k.startswith( '+' ):
+                ad[ k[1:] ] = _value( v )
+        return ad
+
+    #
+    # htcondor.Schedd interface
+    #
+    def submit( self, description, count=0, spool=False, ad_results=None, itemdata=None ):
+        if isinstance( description, htcondor.Submit ):
+            description = dict( description )
+        items = list( itemdata ) if itemdata is not None else [ {} ] * max( count, 1 )
+        now = int( time.time() )
+        with self._locked():
+            self.cluster += 1
+            cluster = self.cluster
+            ads = [ self._jobad( description, item, cluster, proc, now ) for proc, item in enumerate( items ) ]
+            for proc, ad in enumerate( ads ):
+                self.jobs[ (cluster, proc) ] = ad
+            self._save( ads )
+        self._sleep( len(items) )
+        return FakeSubmitResult( cluster, 0, len(items) )
+
+    def _select( self, constraint ):
+        if constraint is None or constraint == '' or constraint is True:
+            return list( self.jobs.values() )
+        expr = classad.ExprTree( str(constraint) )
+        result = []
+        for ad in self.jobs.values():
+            try:
+                if expr.eval( ad ) is True:
+                    result.append( ad )
+            except Exception:
+                pass
+        return result
+
+    def query( self, constraint='true', projection=[], limit=-1, opts=None ):
+        with self._locked():
+            ads = self._select( constraint )
+        if limit is not None and limit >= 0:
+            ads = ads[:limit]
+        if projection:
+            ads = [ classad.ClassAd( { k : ad[k] for k in projection if k in ad } ) for ad in ads ]
+        else:
+            ads = [ classad.ClassAd( dict( ad ) ) for ad in ads ]
+        self._sleep()
+        return ads
+
+    def _jobspec( self, job_spec ):
+        if isinstance( job_spec, (list,tuple) ):
+            keys = set()
+            for spec in job_spec:
+                cluster, _, proc = str(spec).partition('.')
+                keys.add( ( int(cluster), int(proc) ) )
+            return [ self.jobs[k] for k in keys if k in self.jobs ]
+        return self._select( job_spec )
+
+    def act( self, action, job_spec, reason=None ):
+        with self._locked():
+            ads = self._jobspec( job_spec )
+            now = int( time.time() )
+            removed = []
+            for ad in ads:
+                key = ( int(ad['ClusterId']), int(ad['ProcId']) )
+                if action == htcondor.JobAction.Remove:
+                    del self.jobs[key]
+                    removed.append( key )
+                elif action == htcondor.JobAction.Hold:
+                    ad['JobStatus'] = 5
+                    ad['HoldReason'] = reason or 'held by fake schedd'
+                    ad['HoldReasonCode'] = 1
+                    ad['HoldReasonSubcode'] = 0
+                    ad['EnteredCurrentStatus'] = now
+                elif action == htcondor.JobAction.Release:
+                    ad['JobStatus'] = 1
+                    ad['EnteredCurrentStatus'] = now
+            if removed:
+                self._save( removed=removed )
+            else:
+                self._save( ads )
+        self._sleep()
+        return classad.ClassAd( { 'TotalSuccess' : len(ads), 'TotalJobAds' : len(ads) } )
+
+    def edit( self, job_spec, attr, value ):
+        """
+        Sets an attribute (e.g. JobStatus=2 to mark jobs running) on the selected jobs.
+        """
+        with self._locked():
+            ads = self._jobspec( job_spec )
+            for ad in ads:
+                ad[attr] = _value( value )
+            self._save( ads )
+        self._sleep()
+
+def _options( spec ):
+    result = {}
+    for item in spec.split(','):
+        k, _, v = item.partition('=')
+        if k.strip():
+            result[ k.strip() ] = v.strip()
+    return result
+
+def schedd():
+    """
+    Returns the selected schedd, e.g. 'condor' or 'fake:latency=0.2'
+    """
+    result = os.getenv( 'SLURP_SCHEDD', None )
+    if result is None and pathlib.Path( SCHEDDFILE ).is_file():
+        result = pathlib.Path( SCHEDDFILE ).read_text().strip()
+    return result or 'condor'
+
+_fake = None
+
+def Schedd():
+    """
+    Returns the selected schedd (the local htcondor schedd by default).  The fake
+    schedd is shared within the process.
+    """
+    global _fake
+    selected = schedd()
+    if not selected.startswith( 'fake' ):
+        return htcondor.Schedd()
+    if _fake is None:
+        _fake = FakeSchedd( **_options( selected.partition(':')[2] ) )
+    return _fake
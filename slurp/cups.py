@@ -2,6 +2,9 @@
 
 """
 Common User Production Script
+
+cups.py is copied to the worker node on its own: it does not import slurp's modules
+(dbpool, dbstats, dbstatements) unless a stand-in backend is requested for testing.
 """
 
 import pyodbc
@@ -22,6 +25,11 @@ from pathlib import Path
 
 MAXDSTNAMES = 100
 
+# A local stand-in backend (see slurp's dbbackend) may be selected for offline testing.
+connect = pyodbc.connect
+if os.getenv( 'SLURP_DB_BACKEND', 'odbc' ) != 'odbc':
+    from dbbackend import connect
+
 prod_mode = Path("CUPS_PRODUCTION_MODE").is_file()
 test_mode = Path("CUPS_TESTBED_MODE").is_file()
 if ( prod_mode ):
@@ -56,7 +64,53 @@ cnxn_string_map = {
     'statw'       : f'DSN={dsnprodw};UID=argouser',
 }    
 
-def dbQuery( cnxn_string, query, ntries=10 ):
+#
+# Named statements.  Values are bound as parameters rather than formatted into the text,
+# so each statement text is fixed (for a given table and state) and can be prepared once
+# by the server.
+#
+statements = {
+    'started'              : "update {table} set status='started',started=cast(? as timestamp),execution_node=? where id=?",
+    'running'              : "update {table} set status='running',running=cast(? as timestamp),nsegments=? where id=?",
+    'finished'             : "update {table} set status='{state}',ended=cast(? as timestamp),nsegments=?,exit_code=?,nevents=? where id=?",
+    'finished.inc'         : "update {table} set status='{state}',ended=cast(? as timestamp),nsegments=?,exit_code=?,nevents=nevents+? where id=?",
+    'exitcode'             : "update {table} set status='{state}',exit_code=? where id=?",
+    'nevents'              : "update {table} set nevents=? where id=?",
+    'nevents.inc'          : "update {table} set nevents=nevents+? where id=?",
+    'getinputs'            : "select inputs from {table} where id=? limit 1",
+    'getranges'            : "select ranges from {table} where id=? limit 1",
+    'inputs'               : "update {table} set inputs=? where id=?",
+    'message'              : "update {table} set message=?,flags=flags+?,logsize=? where id=?",
+    'stageout.files'       : """
+    insert into files (lfn,full_host_name,full_file_path,time,size,md5) 
+    values (?,?,?,'now',?,?)
+    on conflict
+    on constraint files_pkey
+    do update set 
+    time=EXCLUDED.time,
+    size=EXCLUDED.size,
+    md5=EXCLUDED.md5
+    """,
+    'stageout.datasets'    : """
+    insert into datasets (filename,runnumber,segment,size,dataset,dsttype,events)
+    values (?,?,?,?,?,?,?)
+    on conflict
+    on constraint datasets_pkey
+    do update set
+    runnumber=EXCLUDED.runnumber,
+    segment=EXCLUDED.segment,
+    size=EXCLUDED.size,
+    dsttype=EXCLUDED.dsttype,
+    events=EXCLUDED.events
+    """,
+    'stageout.nevents'     : "update {table} set nevents=?,nsegments=nsegments+1,message=? where id=?",
+    'stageout.nevents.inc' : "update {table} set nevents=nevents+?,nsegments=nsegments+1,message=? where id=?",
+}
+
+# Per-query cost of this invocation, appended to cups.stat.json by main
+querystats = []
+
+def dbQuery( cnxn_string, query, ntries=10, params=(), tag=None ):
 
     # Some guard rails
     assert( 'delete' not in query.lower() )    
@@ -74,11 +128,21 @@ def dbQuery( cnxn_string, query, ntries=10 ):
     serv = "noconnection" # cnxn.getinfo(pyodbc.SQL_SERVER_NAME)
     conn = None
 
+    tconnect = 0.0
+    wall     = 0.0
+
     for itry in range(0,ntries):
         try:
-            conn = pyodbc.connect( cnxn_string )
+            t0 = time.monotonic()
+            conn = connect( cnxn_string )
+            t1 = time.monotonic()
+            tconnect += t1 - t0
             curs = conn.cursor()
-            curs.execute( query )
+            if params:
+                curs.execute( query, params )
+            else:
+                curs.execute( query )
+            wall = time.monotonic() - t1
             break
                 
         except Exception as E:
@@ -93,8 +157,25 @@ def dbQuery( cnxn_string, query, ntries=10 ):
         
 
     finish = datetime.datetime.now(datetime.timezone.utc)        
+
+    querystats.append( {
+        'query'   : tag or query.split()[0],
+        'wall'    : wall,
+        'connect' : tconnect,
+        'rows'    : curs.rowcount if curs else 0,
+        'bytes'   : sum( [ len(p) if isinstance(p,str) else 8 for p in params ] ),
+        'retries' : ntries - 1,
+        'error'   : None if lastException=="noexception" else lastException,
+    } )
             
     return curs, ntries, start, finish, lastException, name, serv
+
+def dbStatement( cnxn_string, name, params, **identifiers ):
+    """
+    Executes the named statement, binding the given parameters.  Identifiers (the table
+    name and the production state) are formatted into the statement text.
+    """
+    return dbQuery( cnxn_string, statements[name].format( **identifiers ), params=params, tag=name )
             
 
 def md5sum( filename ):
@@ -222,17 +303,8 @@ def started(args):
     seg=int(args.segment)
     id_ = getLatestId( tablename, dstname, run, seg )
     node=platform.node()
-    update = f"""
-    update {tablename}
-    set 
-         status='started',
-         started='{timestamp}',
-         execution_node='{node}'
-    where id={id_}
-
-    """
 
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'started', ( timestamp, node, int(id_) ), table=tablename )
     if curs:
         curs.commit()
 
@@ -253,14 +325,8 @@ def running(args):
     seg=int(args.segment)
     nsegments=int(args.nsegments)
     id_ = getLatestId( tablename, dstname, run, seg )
-    update = f"""
-    update {tablename}
-    set status='running',running='{timestamp}',nsegments={nsegments}
-    where id={id_}
-    """
-
 
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'running', ( timestamp, nsegments, int(id_) ), table=tablename )
     if curs:
         curs.commit()
 
@@ -291,21 +357,11 @@ def finished(args):
     state='finished'
     if ec>0:
         state='failed'
-    update = None
+    statement = 'finished'
     if args.inc:
-        update = f"""
-        update {tablename}
-        set status='{state}',ended='{timestamp}',nsegments={ns},exit_code={ec},nevents=nevents+{ne}
-        where id={id_}
-        """
-    else:
-        update = f"""
-        update {tablename}
-        set status='{state}',ended='{timestamp}',nsegments={ns},exit_code={ec},nevents={ne}
-        where id={id_}
-        """
-
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+        statement = 'finished.inc'
+
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], statement, ( timestamp, ns, ec, ne, int(id_) ), table=tablename, state=state )
     if curs:
         curs.commit()
 
@@ -329,13 +385,8 @@ def exitcode(args):
     state='finished'
     if ec>0:
         state='failed'
-    update = f"""
-    update {tablename}
-    set status='{state}',exit_code={ec}
-    where id={id_}
-    """
 
-    conn, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'exitcode', ( ec, int(id_) ), table=tablename, state=state )
     if curs:
         curs.commit()
 
@@ -357,21 +408,11 @@ def nevents(args):
     seg=int(args.segment)
     id_ = getLatestId( tablename, dstname, run, seg )
     ne=int(args.nevents)
-    update=None
+    statement = 'nevents'
     if args.inc:
-        update = f"""
-        update {tablename}
-        set nevents=nevents+{ne}
-        where id={id_}
-        """
-    else:
-        update = f"""
-        update {tablename}
-        set nevents={ne}
-        where id={id_}
-        """
-
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+        statement = 'nevents.inc'
+
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], statement, ( ne, int(id_) ), table=tablename )
     if curs:
         curs.commit()
 
@@ -388,10 +429,7 @@ def getinputs(args):
     run=int(args.run)
     seg=int(args.segment)
     id_ = getLatestId( tablename, dstname, run, seg )
-    query = f"""
-    select inputs from {tablename} where id={id_} limit 1
-    """
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], query )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'getinputs', ( int(id_), ), table=tablename )
     if curs:
         for result in curs:
             flist = str(result[0]).split(',')
@@ -412,10 +450,7 @@ def getranges(args):
     run=int(args.run)
     seg=int(args.segment)
     id_ = getLatestId( tablename, dstname, run, seg )
-    query = f"""
-    select ranges from {tablename} where id={id_} limit 1
-    """
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], query )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'getranges', ( int(id_), ), table=tablename )
     if curs:
         for result in curs:
             flist = str(result[0]).split(',')
@@ -441,13 +476,8 @@ def inputs(args):
     inputs = 'unset'
     if len(args.files)>0:
         inputs=' '.join(args.files)
-    update = f"""
-    update {tablename}
-    set inputs='{inputs}'
-    where id={id_}
-    """
 
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'inputs', ( inputs, int(id_) ), table=tablename )
     if curs:
         curs.commit()
 
@@ -519,10 +549,7 @@ def message(args):
         flaginc=_error_messages[args.error]
         
     id_ = getLatestId( args.table, args.dstname, int(args.run), int(args.segment) )
-    update = f"""
-       update {args.table} set message='{args.message}',flags=flags+{flaginc},logsize={args.logsize}  where id={id_};
-    """
-    curs, ntries, start, finish, ex, nm, sv = dbQuery( cnxn_string_map[ 'statw' ], update )
+    curs, ntries, start, finish, ex, nm, sv = dbStatement( cnxn_string_map[ 'statw' ], 'message', ( args.message, flaginc, int(args.logsize), int(id_) ), table=args.table )
     if curs:
         curs.commit()
 
@@ -590,43 +617,21 @@ def stageout(args):
     # Insert into files primary key: (lfn,full_host_name,full_file_path)
     if args.verbose:        print("Insert into files")
 
-    insert=f"""
-    insert into files (lfn,full_host_name,full_file_path,time,size,md5) 
-    values ('{filename}','{host}','{args.outdir}/{filename}','now',{sz},'{md5}')
-    on conflict
-    on constraint files_pkey
-    do update set 
-    time=EXCLUDED.time,
-    size=EXCLUDED.size,
-    md5=EXCLUDED.md5
-    ;
-    """
-    if args.verbose:        print(insert)
+    values=( filename, host, f"{args.outdir}/{filename}", sz, md5 )
+    if args.verbose:        print(statements['stageout.files'],values)
 
 
     # insert into files ...
-    insfiles, ntries_files, start_files, finish_files, ex_files, nm_files, sv_files = dbQuery( cnxn_string_map[ 'fcw' ], insert )
+    insfiles, ntries_files, start_files, finish_files, ex_files, nm_files, sv_files = dbStatement( cnxn_string_map[ 'fcw' ], 'stageout.files', values )
     
 
     # Insert into datasets primary key: (filename,dataset)
     if args.verbose:        print("Insert into datasets")
-    insert=f"""
-    insert into datasets (filename,runnumber,segment,size,dataset,dsttype,events)
-    values ('{filename}',{run},{seg},{sz},'{args.dataset}','{dsttype}',{args.nevents})
-    on conflict
-    on constraint datasets_pkey
-    do update set
-    runnumber=EXCLUDED.runnumber,
-    segment=EXCLUDED.segment,
-    size=EXCLUDED.size,
-    dsttype=EXCLUDED.dsttype,
-    events=EXCLUDED.events
-    ;
-    """
-    if args.verbose:        print(insert)
+    values=( filename, run, seg, sz, args.dataset, dsttype, int(args.nevents) )
+    if args.verbose:        print(statements['stageout.datasets'],values)
 
     # insert into datasets
-    insdsets, ntries_dsets, start_dsets, finish_dsets, ex_dsets, nm_dsets, sv_dsets = dbQuery( cnxn_string_map[ 'fcw' ], insert )    
+    insdsets, ntries_dsets, start_dsets, finish_dsets, ex_dsets, nm_dsets, sv_dsets = dbStatement( cnxn_string_map[ 'fcw' ], 'stageout.datasets', values )    
             
     print(".... insert into datasets executed ....")
     
@@ -645,24 +650,11 @@ def stageout(args):
     seg=int(args.segment)
     if args.prodtype=="many": seg=0
     id_ = getLatestId( tablename, dstname, run, seg )
-    update=None
-
+    statement = 'stageout.nevents'
     if args.inc:
-        update = f"""
-        update {tablename}
-        set nevents=nevents+{args.nevents},nsegments=nsegments+1,message='last stageout {filename}'
-        where id={id_}
-        """
-        #            where dstname='{dstname}' and id={id_} and run={run} and segment={seg};
-    else:
-        update = f"""
-        update {tablename}
-        set nevents={args.nevents},nsegments=nsegments+1,message='last stageout {filename}'
-        where id={id_}
-        """
-        #            where dstname='{dstname}' and id={id_} and run={run} and segment={seg};
-
-    curs, ntries_stat, start_stat, finish_stat, ex_stat, nm_stat, sv_stat = dbQuery( cnxn_string_map[ 'statw' ], update )
+        statement = 'stageout.nevents.inc'
+
+    curs, ntries_stat, start_stat, finish_stat, ex_stat, nm_stat, sv_stat = dbStatement( cnxn_string_map[ 'statw' ], statement, ( int(args.nevents), f'last stageout {filename}', int(id_) ), table=tablename )
     if curs:
         curs.commit()
         
@@ -732,5 +724,11 @@ def main():
                 stats.write(str(x))
             stats.write("\n")
 
+    # Per-query wall time, connection time, rows affected, bytes bound and retries
+    with open( 'cups.stat.json', 'a' ) as stats:
+        stats.write( json.dumps( { 'subcommand' : args.subcommand, 'cupsid' : cupsid, 'dstname' : args.dstname,
+                                   'run' : args.run, 'segment' : args.segment, 'node' : platform.node(),
+                                   'queries' : querystats }, default=str ) + "\n" )
+
 if __name__ == '__main__':
     main()
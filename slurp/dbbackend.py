@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+"""
+Selects the database backend used for the slurp DSNs.
+
+By default connections are made through ODBC (pyodbc.connect).  A local stand-in
+backend may be selected with the SLURP_DB_BACKEND environment variable, or by the
+contents of the file .slurp/backend (the environment takes precedence):
+
+    SLURP_DB_BACKEND=sqlite                  # databases under .slurp/sqlite/
+    SLURP_DB_BACKEND=sqlite:/path/to/dir     # databases under the given directory
+
+The sqlite backend keeps one database file per server (production status, file
+catalog, daq, raw data catalog), chosen from the DSN in the connection string.  The
+tables are created from the definitions in slurptables on first use, and the
+Postgres dialect used by slurp, cups and bachi is translated on the fly:
+
+    - ::type casts are dropped and cast(? as timestamp) binds the string as is
+    - on conflict on constraint <table>_pkey becomes on conflict (<primary key>)
+    - split_part, string_agg, every and to_timestamp are provided as functions
+    - the production status column compares in prodstate (enum) order
+
+Rows support attribute access (row.id) as pyodbc rows do.  Postgres features with no
+sqlite equivalent (e.g. set returning functions in the select list, ordered
+aggregates) are not translated, so input queries must be written accordingly.
+"""
+
+import os
+import re
+import sqlite3
+import pathlib
+import datetime
+import threading
+
+from collections import namedtuple
+
+import pyodbc
+
+import slurptables
+
+BACKENDFILE = '.slurp/backend'
+SQLITEDIR   = '.slurp/sqlite'
+
+# Database (file) which holds the tables behind each DSN
+DATABASES = {
+    'ProductionStatus'      : 'status',
+    'ProductionStatusWrite' : 'status',
+    'Production_read'       : 'status',
+    'Production_write'      : 'status',
+    'FileCatalog'           : 'filecatalog',
+    'FileCatalogWrite'      : 'filecatalog',
+    'daq'                   : 'daq',
+    'RawdataCatalog_read'   : 'raw',
+}
+
+# Tables created in each database
+SCHEMAS = {
+    'status'      : [ slurptables.sphnx_production_setup_table_def,
+                      slurptables.sphnx_production_status_table_def,
+                      slurptables.sphnx_production_cursor_table_def,
+                      slurptables.sphnx_production_dataset ],
+    'filecatalog' : [ slurptables.sphnx_filecatalog_files_table_def,
+                      slurptables.sphnx_filecatalog_datasets_table_def ],
+    'daq'         : [ slurptables.sphnx_daq_filelist_table_def ],
+    'raw'         : [ slurptables.sphnx_daq_filelist_table_def ],
+}
+
+# Ordering of the prodstate enum.  n.b. status<'started' style comparisons rely on it.
+PRODSTATES = [ 'submitting', 'submitted', 'started', 'running', 'held', 'evicted', 'failed', 'finished' ]
+
+def backend():
+    """
+    Returns the selected backend, e.g. 'odbc' or 'sqlite:.slurp/sqlite'
+    """
+    result = os.getenv( 'SLURP_DB_BACKEND', None )
+    if result is None and pathlib.Path( BACKENDFILE ).is_file():
+        result = pathlib.Path( BACKENDFILE ).read_text().strip()
+    return result or 'odbc'
+
+def concurrent_writes():
+    """
+    Whether several connections may hold write transactions open at the same time.
+    sqlite allows a single writer per database.
+    """
+    return not backend().startswith( 'sqlite' )
+
+def dsn( cnxn_string ):
+    """
+    Extracts the data source name from an ODBC connection string.
+    """
+    for item in cnxn_string.split(';'):
+        k, _, v = item.partition('=')
+        if k.strip().upper() == 'DSN':
+            return v.strip()
+    return cnxn_string
+
+#
+# Translation of the Postgres dialect
+#
+_translations = [
+    ( re.compile( r"cast\(\s*\?\s+as\s+timestamp\s*\)", re.I ), "?"                 ),
+    ( re.compile( r"::\s*[a-z_]+(\[\])?",               re.I ), ""                  ),
+    ( re.compile( r"\bnow\(\)",                         re.I ), "current_timestamp" ),
+    ( re.compile( r"\bilike\b",                         re.I ), "like"              ),
+]
+_onconstraint = re.compile( r"on\s+conflict\s+on\s+constraint\s+(\w+)", re.I )
+
+_ddl_translations = [
+    ( re.compile( r"CREATE TYPE .*?\);",                re.I | re.S ), ""                                  ),
+    ( re.compile( r"primary\s+key\s*\(",                re.I ), "unique ("                                 ),
+    ( re.compile( r"\bserial\s+unique\b",               re.I ), "integer primary key autoincrement"        ),
+    ( re.compile( r"\bprodstate\b",                     re.I ), "text collate prodstate"                   ),
+    ( re.compile( r"\bjsonb\b",                         re.I ), "text"                                     ),
+    ( re.compile( r"\(\s*(.*?)\s+at time zone 'utc'\s*\)", re.I ), r"(\1)"                                 ),
+    ( re.compile( r"\bnow\(\)",                         re.I ), "current_timestamp"                        ),
+]
+_pkey = re.compile( r"CREATE TABLE if not exists (\w+).*primary\s+key\s*\(([^)]*)\)", re.I | re.S )
+
+_constraints = {}   # constraint name -> conflict target
+
+def translate_ddl( ddl ):
+    """
+    Translates a table definition from slurptables to sqlite.  The primary key is
+    recorded so that on conflict on constraint <table>_pkey can be translated.
+    """
+    m = _pkey.search( ddl )
+    if m:
+        _constraints[ f"{m.group(1).lower()}_pkey" ] = m.group(2).strip()
+    for regex, repl in _ddl_translations:
+        ddl = regex.sub( repl, ddl )
+    return ddl
+
+_translated = {}
+
+def translate( sql ):
+    """
+    Translates a statement from the Postgres dialect to sqlite (cached on the text).
+    """
+    result = _translated.get( sql, None )
+    if result is None:
+        result = sql
+        for regex, repl in _translations:
+            result = regex.sub( repl, result )
+        result = _onconstraint.sub( lambda m: f"on conflict ({_constraints.get( m.group(1).lower(), 'rowid' )})", result )
+        _translated[sql] = result
+    return result
+
+#
+# Functions and collations provided to sqlite
+#
+def _split_part( string, delimiter, n ):
+    if string is None: return None
+    parts = string.split( delimiter )
+    if n < 0:
+        n = len(parts) + n + 1
+    if n < 1 or n > len(parts):
+        return ''
+    return parts[n-1]
+
+def _to_timestamp( seconds ):
+    if seconds is None: return None
+    return str( datetime.datetime.fromtimestamp( float(seconds), datetime.timezone.utc ).replace( tzinfo=None ) )
+
+class _StringAgg:
+    def __init__( self ):
+        self.values    = []
+        self.delimiter = ''
+    def step( self, value, delimiter ):
+        if value is not None:
+            self.values.append( str(value) )
+        self.delimiter = delimiter
+    def finalize( self ):
+        return self.delimiter.join( self.values ) if self.values else None
+
+class _Every:
+    def __init__( self ):
+        self.result = None
+    def step( self, value ):
+        if value is not None:
+            self.result = bool(value) and ( self.result is None or self.result )
+    def finalize( self ):
+        return self.result
+
+_prodorder = { s: i for i, s in enumerate( PRODSTATES ) }
+
+def _prodstate( a, b ):
+    a = _prodorder.get( a, len(PRODSTATES) )
+    b = _prodorder.get( b, len(PRODSTATES) )
+    return (a > b) - (a < b)
+
+#
+# DB-API wrappers presenting the parts of the pyodbc interface used by slurp
+#
+_errors = [
+    ( sqlite3.IntegrityError,   pyodbc.IntegrityError   ),
+    ( sqlite3.OperationalError, pyodbc.OperationalError ),
+    ( sqlite3.ProgrammingError, pyodbc.ProgrammingError ),
+    ( sqlite3.Error,            pyodbc.Error            ),
+]
+
+def _reraise( E ):
+    for sqlerr, odbcerr in _errors:
+        if isinstance( E, sqlerr ):
+            raise odbcerr( str(E) ) from E
+    raise E
+
+_rowtypes = {}
+
+def _rowtype( description ):
+    names = tuple( d[0] for d in description )
+    result = _rowtypes.get( names, None )
+    if result is None:
+        result = _rowtypes[names] = namedtuple( 'Row', names, rename=True )
+    return result
+
+def _params( params ):
+    if len(params) == 1 and isinstance( params[0], (list,tuple) ):
+        return tuple( params[0] )
+    return params
+
+class SQLiteCursor:
+    def __init__( self, conn ):
+        self.connection = conn
+        self._curs      = conn._db.cursor()
+        self._row       = None
+
+    @property
+    def description( self ):
+        return self._curs.description
+
+    @property
+    def rowcount( self ):
+        return self._curs.rowcount
+
+    def _wrap( self, rows ):
+        if self._row is None:
+            return rows
+        return [ self._row._make( r ) for r in rows ]
+
+    def execute( self, sql, *params ):
+        try:
+            self._curs.execute( translate( sql ), _params( params ) )
+        except sqlite3.Error as E:
+            _reraise( E )
+        self._row = _rowtype( self._curs.description ) if self._curs.description else None
+        return self
+
+    def executemany( self, sql, params ):
+        try:
+            self._curs.executemany( translate( sql ), [ tuple(p) for p in params ] )
+        except sqlite3.Error as E:
+            _reraise( E )
+        self._row = None
+        return self
+
+    def fetchone( self ):
+        row = self._curs.fetchone()
+        if row is None or self._row is None:
+            return row
+        return self._row._make( row )
+
+    def fetchmany( self, size=1 ):
+        return self._wrap( self._curs.fetchmany( size ) )
+
+    def fetchall( self ):
+        return self._wrap( self._curs.fetchall() )
+
+    def __iter__( self ):
+        while True:
+            rows = self.fetchmany( 1000 )
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def commit( self ):
+        self.connection.commit()
+
+    def rollback( self ):
+        self.connection.rollback()
+
+    def close( self ):
+        self._curs.close()
+
+class SQLiteConnection:
+    def __init__( self, path, name ):
+        self.path = path
+        self.name = name
+        self._db  = sqlite3.connect( path, timeout=60, check_same_thread=False )
+        self._db.create_collation( 'prodstate', _prodstate )
+        self._db.create_function( 'split_part',   3, _split_part,   deterministic=True )
+        self._db.create_function( 'to_timestamp', 1, _to_timestamp, deterministic=True )
+        self._db.create_aggregate( 'string_agg',  2, _StringAgg )
+        self._db.create_aggregate( 'every',       1, _Every )
+        self._db.execute( 'pragma journal_mode=wal' )
+
+    def cursor( self ):
+        return SQLiteCursor( self )
+
+    def execute( self, sql, *params ):
+        return self.cursor().execute( sql, *params )
+
+    def commit( self ):
+        self._db.commit()
+
+    def rollback( self ):
+        self._db.rollback()
+
+    def close( self ):
+        self._db.close()
+
+    def getinfo( self, what ):
+        return {
+            pyodbc.SQL_DBMS_NAME        : 'SQLite',
+            pyodbc.SQL_DATA_SOURCE_NAME : self.name,
+            pyodbc.SQL_SERVER_NAME      : self.path,
+        }.get( what, None )
+
+_created = set()
+_lock    = threading.Lock()
+
+def sqlite_connect( cnxn_string, directory=SQLITEDIR ):
+    """
+    Opens the sqlite database behind the DSN in cnxn_string, creating the tables
+    on first use.
+    """
+    name = dsn( cnxn_string )
+    db   = DATABASES.get( name, name.lower() )
+    pathlib.Path( directory ).mkdir( parents=True, exist_ok=True )
+    path = str( pathlib.Path( directory ) / f"{db}.db" )
+
+    conn = SQLiteConnection( path, name )
+    with _lock:
+        if path not in _created:
+            for tabledef in SCHEMAS.get( db, [] ):
+                conn._db.executescript( translate_ddl( tabledef() ) )
+            _created.add( path )
+    return conn
+
+def connect( cnxn_string, **kwargs ):
+    """
+    Connects to the given connection string with the selected backend.
+    """
+    selected = backend()
+    if selected.startswith( 'sqlite' ):
+        _, _, directory = selected.partition( ':' )
+        return sqlite_connect( cnxn_string, directory or SQLITEDIR )
+    return pyodbc.connect( cnxn_string, **kwargs )
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+"""
+Connection pool for the ODBC data sources used by slurp.
+
+Connections are keyed on the connection string (i.e. the entries of the
+cnxn_string_map) and are reused between calls to dbQuery.  An idle
+connection is pinged before it is handed out again, and a broken connection
+is discarded and reopened.  A failed connection attempt is raised to the caller,
+whose retry loop (e.g. in dbQuery) spaces out the attempts.
+"""
+
+import pyodbc
+import threading
+import time
+import uuid
+
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+import dbbackend
+
+# Maximum number of idle connections kept open per connection string
+POOLSIZE  = 4
+
+# Seconds a connection may sit idle before it is pinged on checkout
+PINGAFTER = 30.0
+
+# Seconds to wait for a connection to be returned before opening an overflow connection
+WAITMAX   = 5.0
+
+# Default number of rows fetched per round trip when streaming a result
+FETCHBATCH = 5000
+
+# Database products which support DECLARE ... CURSOR / FETCH FORWARD
+NAMEDCURSORS = [ 'PostgreSQL' ]
+
+@dataclass
+class SPhnxPoolStats:
+    """
+    Counters accumulated for a single connection string.
+    """
+    hits:         int   = 0    # checkout served by an idle connection
+    misses:       int   = 0    # checkout required a new connection
+    overflows:    int   = 0    # new connection opened beyond the pool size
+    reconnects:   int   = 0    # idle connection failed the health check and was replaced
+    failures:     int   = 0    # connection attempts which raised
+    discards:     int   = 0    # connections dropped after an error
+    waits:        int   = 0    # checkouts which had to wait for a connection
+    wait_time:    float = 0.0  # seconds spent waiting on the pool
+    connect_time: float = 0.0  # seconds spent in connect
+
+    def dict(self):
+        return asdict(self)
+
+class PooledCursor:
+    """
+    Wraps a cursor drawn from the pool.  Behaves as the underlying cursor.  The
+    connection is returned to the pool when the cursor is closed or garbage
+    collected.  Any transaction left open at that point is rolled back.
+    """
+    def __init__( self, pool, key, conn ):
+        self._pool  = pool
+        self._key   = key
+        self._conn  = conn
+        self._curs  = conn.cursor()
+        self._probe = None
+
+    def prepare( self, sql ):
+        """
+        Switches to the cursor which holds the statement sql on this connection.  pyodbc
+        prepares a statement only when the text executed on a cursor changes, so the
+        statement is prepared once per connection and afterwards only rebound.
+        """
+        self._curs = self._pool.statement( self._conn, sql )
+        return self
+
+    def instrument( self, probe ):
+        """
+        Accounts the time spent executing and fetching (and the rows fetched) to the
+        given probe (see dbstats).
+        """
+        self._probe = probe
+        return self
+
+    def _executed( self, start ):
+        if self._probe is not None:
+            self._probe.executed( time.monotonic() - start )
+
+    def _fetched( self, rows, start ):
+        if self._probe is not None:
+            self._probe.fetched( rows, time.monotonic() - start )
+        return rows
+
+    def __getattr__( self, name ):
+        return getattr( self._curs, name )
+
+    #
+    # n.b. The methods below are defined explicitly (rather than forwarded through __getattr__)
+    # so that expressions such as dbQuery(...).commit() hold a reference to the pooled cursor
+    # until the call completes.  Otherwise the connection would be returned to the pool (and
+    # rolled back) before the commit / fetch is executed.
+    #
+    def __iter__( self ):
+        while True:
+            start = time.monotonic()
+            rows = self._fetched( self._curs.fetchmany( FETCHBATCH ), start )
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def execute( self, *args ):
+        start = time.monotonic()
+        self._curs.execute( *args )
+        self._executed( start )
+        return self
+
+    def executemany( self, sql, params, fast=False ):
+        """
+        If fast is set and the driver supports it, the parameters are bound as arrays and
+        sent in a single round trip (pyodbc fast_executemany).
+        """
+        start = time.monotonic()
+        if fast and hasattr( self._curs, 'fast_executemany' ):
+            self._curs.fast_executemany = True
+            try:
+                self._curs.executemany( sql, params )
+            finally:
+                self._curs.fast_executemany = False
+        else:
+            self._curs.executemany( sql, params )
+        self._executed( start )
+        return self
+
+    def fetchone( self ):
+        start = time.monotonic()
+        row = self._curs.fetchone()
+        self._fetched( [ row ] if row is not None else [], start )
+        return row
+
+    def fetchmany( self, size ):
+        start = time.monotonic()
+        return self._fetched( self._curs.fetchmany( size ), start )
+
+    def fetchall( self ):
+        start = time.monotonic()
+        return self._fetched( self._curs.fetchall(), start )
+
+    def commit( self ):
+        start = time.monotonic()
+        self._conn.commit()
+        self._executed( start )
+
+    def rollback( self ):
+        self._conn.rollback()
+
+    @property
+    def connection( self ):
+        return self._conn
+
+    def stream( self, query, batchsize=FETCHBATCH, named=True ):
+        """
+        Executes query and returns an iterator over the result which fetches batchsize
+        rows per round trip.  If the backend supports it (and named is set) the query is
+        run through a server-side named cursor, so that the client never holds more than
+        batchsize rows.  Otherwise the rows are pulled from the ODBC cursor with fetchmany.
+        The query is executed immediately (so that errors are raised here).  The connection
+        is returned to the pool once the iterator is exhausted or discarded.
+        """
+        name  = None
+        start = time.monotonic()
+        if named and self._pool.dbms( self._key, self._conn ) in NAMEDCURSORS:
+            name = f"slurp_{uuid.uuid4().hex[:12]}"
+            self._curs.execute( f"declare {name} no scroll cursor for {query.strip().rstrip(';')}" )
+        else:
+            self._curs.execute( query )
+        self._executed( start )
+        return self._stream( name, batchsize )
+
+    def _stream( self, name, batchsize ):
+        try:
+            while True:
+                start = time.monotonic()
+                if name:
+                    rows = self._curs.execute( f"fetch forward {batchsize} from {name}" ).fetchall()
+                else:
+                    rows = self._curs.fetchmany( batchsize )
+                self._fetched( rows, start )
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            if name:
+                self._curs.execute( f"close {name}" )
+        finally:
+            self.close()
+
+    def close( self ):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.checkin( self._key, conn )
+
+    def discard( self ):
+        """
+        Drop the connection rather than returning it to the pool (e.g. after an error).
+        """
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.discard( self._key, conn )
+
+    def __del__( self ):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """
+    Pool of ODBC connections keyed on the connection string.
+    """
+    def __init__( self, connect=dbbackend.connect, poolsize=POOLSIZE, pingafter=PINGAFTER, waitmax=WAITMAX ):
+        self.connect   = connect
+        self.poolsize  = poolsize
+        self.pingafter = pingafter
+        self.waitmax   = waitmax
+        self._idle     = {}   # key -> list of (connection, time returned)
+        self._prepared = {}   # id(connection) -> { statement text : cursor }
+        self._dbms     = {}   # key -> database product name
+        self._nopen    = {}   # key -> number of connections currently open
+        self._stats    = {}
+        self._lock     = threading.Condition()
+
+    def _stat( self, key ):
+        if key not in self._stats:
+            self._stats[key] = SPhnxPoolStats()
+        return self._stats[key]
+
+    def _open( self, key ):
+        """
+        Opens a new connection.  A failed attempt is counted and raised: the callers
+        (dbQuery, dbStatement, ...) hold the retry loop.
+        """
+        start = time.monotonic()
+        try:
+            return self.connect( key )
+        except Exception:
+            with self._lock:
+                self._stat(key).failures += 1
+            raise
+        finally:
+            with self._lock:
+                self._stat(key).connect_time += time.monotonic() - start
+
+    def _healthy( self, conn ):
+        try:
+            curs = conn.cursor()
+            curs.execute( "select 1" )
+            curs.fetchall()
+            curs.close()
+            return True
+        except Exception:
+            return False
+
+    def checkout( self, key ):
+        """
+        Returns a connection for the given connection string.  Idle connections are
+        reused (and pinged if they have been idle for a while).  If the pool is
+        exhausted we wait up to waitmax seconds for a connection to be returned
+        before opening an overflow connection.
+        """
+        conn    = None
+        stale   = False
+        waited  = 0.0
+        with self._lock:
+            stat  = self._stat(key)
+            idle  = self._idle.setdefault( key, [] )
+            nopen = self._nopen.get( key, 0 )
+            if not idle and nopen >= self.poolsize:
+                stat.waits += 1
+                start = time.monotonic()
+                self._lock.wait_for( lambda: len(idle)>0, timeout=self.waitmax )
+                waited = time.monotonic() - start
+                stat.wait_time += waited
+            if idle:
+                conn, returned = idle.pop()
+                stale = ( time.monotonic() - returned ) > self.pingafter
+                stat.hits += 1
+            else:
+                if self._nopen.get( key, 0 ) >= self.poolsize:
+                    stat.overflows += 1
+                stat.misses += 1
+                self._nopen[key] = self._nopen.get( key, 0 ) + 1
+
+        if conn is not None and stale and not self._healthy( conn ):
+            self._close( conn )
+            conn = None
+            with self._lock:
+                stat.reconnects += 1
+
+        if conn is None:
+            try:
+                conn = self._open( key )
+            except Exception:
+                with self._lock:
+                    self._nopen[key] -= 1
+                raise
+
+        return conn
+
+    def checkin( self, key, conn ):
+        """
+        Returns a connection to the pool.  Any open transaction is rolled back.
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard( key, conn )
+            return
+        with self._lock:
+            idle = self._idle.setdefault( key, [] )
+            if len(idle) < self.poolsize:
+                idle.append( (conn, time.monotonic()) )
+                conn = None
+            else:
+                self._nopen[key] -= 1
+            self._lock.notify()
+        if conn is not None:
+            self._close( conn )
+
+    def discard( self, key, conn ):
+        with self._lock:
+            self._nopen[key] = self._nopen.get( key, 1 ) - 1
+            self._stat(key).discards += 1
+            self._lock.notify()
+        self._close( conn )
+
+    def _close( self, conn ):
+        with self._lock:
+            self._prepared.pop( id(conn), None )
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def dbms( self, key, conn ):
+        """
+        Returns the name of the database product behind the given connection string.
+        """
+        if key not in self._dbms:
+            try:
+                self._dbms[key] = conn.getinfo( pyodbc.SQL_DBMS_NAME )
+            except Exception:
+                self._dbms[key] = None
+        return self._dbms[key]
+
+    def statement( self, conn, sql ):
+        """
+        Returns the cursor dedicated to the given statement text on this connection.
+        """
+        with self._lock:
+            cursors = self._prepared.setdefault( id(conn), {} )
+            curs = cursors.get( sql, None )
+        if curs is None:
+            curs = conn.cursor()
+            with self._lock:
+                cursors[sql] = curs
+        return curs
+
+    def cursor( self, key ):
+        """
+        Returns a PooledCursor for the given connection string.
+        """
+        return PooledCursor( self, key, self.checkout( key ) )
+
+    def stats( self ):
+        """
+        Returns a dictionary of the pool counters keyed on connection string.
+        """
+        with self._lock:
+            return { k: s.dict() for k, s in self._stats.items() }
+
+    def clear( self ):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            for key, conns in idle.items():
+                self._nopen[key] = self._nopen.get( key, 0 ) - len(conns)
+        for conns in idle.values():
+            for conn, returned in conns:
+                self._close( conn )
+
+    def report( self, log=INFO ):
+        for key, s in self.stats().items():
+            dsn = key.split(';')[0]
+            log( f"Pool {dsn}: hits={s['hits']} misses={s['misses']} overflows={s['overflows']} reconnects={s['reconnects']} failures={s['failures']} waits={s['waits']} wait_time={s['wait_time']:.3f}s connect_time={s['connect_time']:.3f}s" )
+
+# The pool shared by all callers of slurp.dbQuery
+pool = ConnectionPool()
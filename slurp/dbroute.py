@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Read/write routing between a primary DSN and its read replica.
+
+Pure reads against a primary which has a replica are sent to the replica, provided
+the replica has caught up.  The replica is considered current when the largest id
+in the probe table (production_status) is the same on both servers, the check
+intended by kaedama's dbconsistency().  The result of the check is reused for
+RECHECK seconds.
+
+Reads issued within PINWINDOW seconds of a write through this process stay pinned to
+the primary (read-your-writes), as do all reads if the lag check fails.
+"""
+
+import time
+import threading
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+# Seconds for which the result of a lag check is reused
+RECHECK   = 30.0
+
+# Seconds after a write during which reads stay on the primary
+PINWINDOW = 60.0
+
+# Maximum number of rows by which the replica may trail the primary
+LAGMAX    = 0
+
+# Query used to compare the primary and the replica
+LAGQUERY  = "select max(id) as id from production_status"
+
+class ReadRouter:
+    """
+    Chooses the connection string for a query given the primary it was addressed to.
+    """
+    def __init__( self, pool, replicas={}, recheck=RECHECK, pinwindow=PINWINDOW, lagmax=LAGMAX, lagquery=LAGQUERY ):
+        self.pool      = pool
+        self.replicas  = dict( replicas )   # primary connection string -> replica connection string
+        self.recheck   = recheck
+        self.pinwindow = pinwindow
+        self.lagmax    = lagmax
+        self.lagquery  = lagquery
+        self._checked  = {}   # primary -> (time of check, replica is current)
+        self._written  = {}   # primary -> time of last write
+        self._counts   = {}   # primary -> number of reads sent to the replica / pinned / lagged
+        self._lock     = threading.Lock()
+
+    def _count( self, primary, what ):
+        with self._lock:
+            counts = self._counts.setdefault( primary, { 'replica':0, 'pinned':0, 'lagged':0 } )
+            counts[what] += 1
+
+    def _maxid( self, cnxn_string ):
+        curs = self.pool.cursor( cnxn_string )
+        try:
+            row = curs.execute( self.lagquery ).fetchone()
+            return int(row[0] or 0)
+        finally:
+            curs.close()
+
+    def lag( self, primary ):
+        """
+        Returns the number of rows by which the replica trails the primary.  The
+        replica is read first, so that rows inserted between the two reads count
+        against the replica.
+        """
+        idr = self._maxid( self.replicas[primary] )
+        idw = self._maxid( primary )
+        return idw - idr
+
+    def current( self, primary ):
+        """
+        True if the replica of the given primary has caught up (cached for recheck seconds).
+        """
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get( primary, None )
+        if checked and now - checked[0] < self.recheck:
+            return checked[1]
+        try:
+            lag = self.lag( primary )
+            ok  = lag <= self.lagmax
+            if not ok:
+                WARN(f"Read replica of {primary.split(';')[0]} trails the primary by {lag} rows, reading from the primary")
+        except Exception as E:
+            WARN(f"Could not compare read replica of {primary.split(';')[0]} with the primary [{E}]")
+            ok = False
+        with self._lock:
+            self._checked[primary] = ( now, ok )
+        return ok
+
+    def wrote( self, primary ):
+        """
+        Records a write to the primary.  Reads stay pinned to the primary for pinwindow
+        seconds, and the replica is rechecked afterwards.
+        """
+        with self._lock:
+            self._written[primary] = time.monotonic()
+            self._checked.pop( primary, None )
+
+    def route( self, cnxn_string, read, pinned=False ):
+        """
+        Returns the connection string to which the query should be sent.  Reads which
+        must observe this process's own writes should set pinned.
+        """
+        replica = self.replicas.get( cnxn_string, None )
+        if not read:
+            if replica: self.wrote( cnxn_string )
+            return cnxn_string
+        if replica is None:
+            return cnxn_string
+        with self._lock:
+            written = self._written.get( cnxn_string, None )
+        if pinned or ( written is not None and time.monotonic() - written < self.pinwindow ):
+            self._count( cnxn_string, 'pinned' )
+            return cnxn_string
+        if not self.current( cnxn_string ):
+            self._count( cnxn_string, 'lagged' )
+            return cnxn_string
+        self._count( cnxn_string, 'replica' )
+        return replica
+
+    def report( self, log=INFO ):
+        with self._lock:
+            counts = { k: dict(v) for k, v in self._counts.items() }
+        for key, c in counts.items():
+            dsn = key.split(';')[0]
+            log( f"Reads addressed to {dsn}: replica={c['replica']} pinned={c['pinned']} lagged={c['lagged']}" )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Named, parameterized SQL statements used by slurp.
+
+Statements use ODBC parameter markers (?) and are executed with slurp.dbStatement
+(bulk updates with slurp.dbBulkUpdate).  Each pooled connection keeps one cursor per
+statement text.  pyodbc only re-prepares a statement when the text executed on a
+cursor changes, so a statement is prepared once per connection and subsequent calls
+only bind new parameter values.
+
+Literal values (e.g. the production state) which are fixed for a given statement
+are part of the statement text.  Timestamps are passed as strings and cast on the
+server.
+"""
+
+import itertools
+
+# Multi-row inserts are sent in blocks of at most INSERTBLOCK rows.  Any remainder is
+# decomposed into power-of-two blocks so that only a handful of distinct statements
+# are ever prepared.
+INSERTBLOCK = 128
+
+# With --bulkload, inserts of at least STAGEROWS production status rows are bulk loaded: the
+# rows are array bound into a temporary staging table and moved with a single insert ... select.
+STAGEROWS = 1024
+
+# Bulk updates join the table against a VALUES list of at most UPDATEBLOCK rows (one
+# row of parameters per updated row), decomposed in the same way.
+UPDATEBLOCK = 512
+
+# Candidates shipped to the server for an anti-join are sent as a VALUES list of at most
+# ANTIJOINBLOCK rows (one parameter per row), decomposed in the same way.
+ANTIJOINBLOCK = 1024
+
+_production_status_columns = "dsttype, dstname, dstfile, run, segment, nsegments, inputs, ranges, prod_id, cluster, process, status, submitting, nevents, submission_host"
+_production_status_values  = "(?,?,?,?,?,0,?,?,?,?,?,'submitting',cast(? as timestamp),0,?)"
+
+statements = {
+
+    #
+    # production_status
+    #
+    'status.fetch'            : "select id,dstfile,status from production_status where run>=? and run<=?",
+    'status.fetch.from'       : "select id,dstfile,status from production_status where run>=?",
+    'status.latest'           : "select id,dstname from {table} where run=? and segment=? order by id desc limit ?",
+    'status.unblock'          : "delete from production_status where id=?",
+
+    #
+    # Bulk load of production_status through a temporary staging table (one per connection).  Rows bind
+    # their position (seq) followed by the parameters of a row of the multi-row insert.
+    #
+    'status.stage.create'     : "create temporary table if not exists production_status_stage ( seq int, dsttype varchar(32), dstname varchar(64), dstfile varchar(128), "
+                                "run int, segment int, inputs text, ranges text, prod_id int, cluster int, process int, submitting timestamp, submission_host varchar(16) )",
+    'status.stage.load'       : "insert into production_status_stage values (?,?,?,?,?,?,?,?,?,?,?,cast(? as timestamp),?)",
+    'status.stage.insert'     : f"insert into production_status ({_production_status_columns}) "
+                                 "select dsttype, dstname, dstfile, run, segment, 0, inputs, ranges, prod_id, cluster, process, 'submitting'::prodstate, submitting, 0, submission_host "
+                                 "from production_status_stage order by seq returning id,dstfile",
+    'status.stage.clear'      : "delete from production_status_stage",
+
+    #
+    # Bulk updates of production_status (a VALUES list of bulkrows[name] formatted in as {values}, see bulk_blocks)
+    #
+    # ... jobs accepted by condor: ( submitted, cluster, process, id )
+    'status.submitted'        : "with v(submitted,cluster,process,id) as ( values {values} ) "
+                                "update production_status set status='submitted',submitted=v.submitted,cluster=v.cluster,process=v.process "
+                                "from v where production_status.id=v.id and production_status.status<'started'",
+    # ... jobs held by condor: ( message, ended [epoch seconds], id )
+    'status.held'             : "with v(message,ended,id) as ( values {values} ) "
+                                "update production_status set status='held',message=v.message,ended=to_timestamp(v.ended) "
+                                "from v where production_status.id=v.id",
+    # ... held jobs failed by ramenya: ( message, ended, id )
+    'status.held.failed'      : "with v(message,ended,id) as ( values {values} ) "
+                                "update production_status set status='failed',flags=5,message=v.message,ended=v.ended "
+                                "from v where production_status.id=v.id",
+
+    #
+    # production_cursor
+    #
+    'cursor.get'              : "select lastrun from production_cursor where dsttype=? and build like ? and tag like ? and version=? order by id desc",
+    'cursor.get.anytag'       : "select lastrun,tag from production_cursor where dsttype=? and build like ? and version=? order by id desc",
+    'cursor.set'              : "update production_cursor set lastrun=? where dsttype=? and build=? and tag=? and version=?",
+
+    #
+    # production_setup
+    #
+    'setup.fetch'             : "select id,hash from production_setup where name=? and build=? and dbtag=? and hash=? limit 1",
+    'setup.fetch.revision'    : "select id,hash from production_setup where name=? and build=? and dbtag=? and hash=? and revision=? limit 1",
+    'setup.insert'            : "insert into production_setup(name,build,dbtag,repo,dir,hash) values(?,?,?,?,?,?)",
+    'setup.insert.revision'   : "insert into production_setup(name,build,dbtag,repo,dir,hash,revision) values(?,?,?,?,?,?,?)",
+
+    #
+    # Anti-joins of candidate outputs (a VALUES list formatted in as {values}, see values_sql)
+    #
+    # ... candidates which are not registered in the file catalog
+    'datasets.unproduced'     : "with c(filename) as ( values {values} ) select c.filename from c where not exists ( select 1 from datasets d where d.filename=c.filename )",
+    # ... candidates without a production status entry in one of the {blocking} states, with any other entry
+    'status.unblocked'        : "with c(dstfile) as ( values {values} ) select c.dstfile,s.id,s.status from c left join production_status s on s.dstfile=c.dstfile "
+                                "where not exists ( select 1 from production_status b where b.dstfile=c.dstfile and b.status in ({blocking}) )",
+
+}
+
+# The VALUES row bound for each updated row of the bulk updates
+bulkrows = {
+    'status.submitted'        : "(cast(? as timestamp),?,?,?)",
+    'status.held'             : "(?,?,?)",
+    'status.held.failed'      : "(?,cast(? as timestamp),?)",
+}
+
+def insert_production_status_sql( nrows ):
+    """
+    Returns the text of a multi-row insert into the production status table.  Each
+    row binds the parameters listed in production_status_row.
+    """
+    values = ','.join( [ _production_status_values ] * nrows )
+    return f"insert into production_status ({_production_status_columns}) values {values} returning id"
+
+def insert_blocks( nrows, blocksize=INSERTBLOCK ):
+    """
+    Splits nrows into full blocks of blocksize followed by power-of-two blocks.
+    """
+    result = [ blocksize ] * ( nrows // blocksize )
+    remainder = nrows % blocksize
+    size = blocksize
+    while remainder > 0:
+        while size > remainder:
+            size = size // 2
+        result.append( size )
+        remainder = remainder - size
+    return result
+
+def values_sql( nrows ):
+    """
+    Returns a VALUES list of nrows single parameter rows.
+    """
+    return ','.join( [ '(?)' ] * nrows )
+
+def value_blocks( items, blocksize=ANTIJOINBLOCK ):
+    """
+    Splits items into the blocks given by insert_blocks, each a tuple of parameters.
+    """
+    start = 0
+    for size in insert_blocks( len(items), blocksize ):
+        yield tuple( items[start:start+size] )
+        start += size
+
+def bulk_blocks( name, rows, blocksize=UPDATEBLOCK ):
+    """
+    Splits the rows (parameter tuples) of the named bulk update into the blocks given by
+    insert_blocks.  Yields the statement text and the parameters of each block.
+    """
+    start = 0
+    for size in insert_blocks( len(rows), blocksize ):
+        block  = rows[start:start+size]
+        start += size
+        yield statements[name].format( values=','.join( [ bulkrows[name] ] * size ) ), tuple( itertools.chain.from_iterable( block ) )
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Per-query instrumentation for the database layer.
+
+Every query executed through slurp.dbQuery / slurp.dbStatement (and through cursors
+wrapped in an InstrumentedCursor) is accounted against a name: the statement name,
+the name passed by the caller, or else the name of the calling function.  For each
+name we accumulate the wall time spent executing and fetching (time spent by the
+caller processing the rows is excluded), the rows and (approximate) bytes returned,
+the number of retries and the time spent obtaining a connection.
+
+The accumulated statistics are printed as a summary table by report() and appended
+as a line of JSON by dump(), so that they can be compared between runs.
+"""
+
+import sys
+import time
+import json
+import datetime
+import platform
+import threading
+
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+# Number of rows pulled per fetch when iterating over an instrumented cursor
+FETCHBATCH = 1000
+
+@dataclass
+class SPhnxQueryStats:
+    """
+    Counters accumulated for a single named query.
+    """
+    calls:   int   = 0    # number of times the query was executed
+    rows:    int   = 0    # rows fetched
+    bytes:   int   = 0    # approximate size of the fetched rows
+    retries: int   = 0    # failed attempts before the query succeeded
+    wall:    float = 0.0  # seconds spent executing and fetching
+    maxwall: float = 0.0  # longest single execution
+    connect: float = 0.0  # seconds spent obtaining a connection
+
+    def dict(self):
+        return asdict(self)
+
+def rowbytes( rows ):
+    """
+    Approximate size of a list of rows.  Strings and buffers count their length,
+    everything else counts as eight bytes.
+    """
+    result = 0
+    for row in rows:
+        for v in row:
+            if isinstance( v, (str,bytes,bytearray) ):
+                result += len(v)
+            else:
+                result += 8
+    return result
+
+class QueryProbe:
+    """
+    Accounts one execution of a query.  Costs are added to the collector as they are
+    incurred, so that a cursor which is never exhausted is still accounted for.
+    """
+    def __init__( self, collector, name, retries=0, connect=0.0 ):
+        self.collector = collector
+        self.name      = name
+        self.wall      = 0.0
+        self.retries   = retries
+        self.connect   = connect
+        collector.record( name, calls=1, retries=retries, connect=connect )
+
+    def attempt( self, retries, connect ):
+        """
+        Sets the retries and connect time of the call to those of its latest attempt, so
+        that a call retried by the caller is accounted once.
+        """
+        self.collector.record( self.name, retries=retries-self.retries, connect=connect-self.connect )
+        self.retries = retries
+        self.connect = connect
+
+    def executed( self, seconds ):
+        self.wall += seconds
+        self.collector.record( self.name, wall=seconds, maxwall=self.wall )
+
+    def fetched( self, rows, seconds ):
+        self.wall += seconds
+        self.collector.record( self.name, wall=seconds, maxwall=self.wall, rows=len(rows), bytes=rowbytes( rows ) )
+
+class QueryStats:
+    """
+    Collects the per query statistics.
+    """
+    def __init__( self ):
+        self._stats = {}
+        self._lock  = threading.Lock()
+
+    def probe( self, name, retries=0, connect=0.0 ):
+        return QueryProbe( self, name, retries, connect )
+
+    def record( self, name, calls=0, wall=0.0, maxwall=0.0, rows=0, bytes=0, retries=0, connect=0.0 ):
+        with self._lock:
+            s = self._stats.get( name, None )
+            if s is None:
+                s = self._stats[name] = SPhnxQueryStats()
+            s.calls   += calls
+            s.rows    += rows
+            s.bytes   += bytes
+            s.retries += retries
+            s.wall    += wall
+            s.connect += connect
+            if maxwall > s.maxwall:
+                s.maxwall = maxwall
+
+    def stats( self ):
+        """
+        Returns a dictionary of the query counters keyed on query name.
+        """
+        with self._lock:
+            return { k: s.dict() for k, s in self._stats.items() }
+
+    def clear( self ):
+        with self._lock:
+            self._stats = {}
+
+    def report( self, log=INFO ):
+        """
+        Logs a summary table, slowest queries first.
+        """
+        stats = sorted( self.stats().items(), key=lambda kv: kv[1]['wall'], reverse=True )
+        if not stats:
+            return
+        width = max( [ len(k) for k, s in stats ] + [ 5 ] )
+        log( f"{'query':<{width}} {'calls':>6} {'wall[s]':>9} {'max[s]':>8} {'connect[s]':>10} {'rows':>9} {'bytes':>11} {'retries':>7}" )
+        for k, s in stats:
+            log( f"{k:<{width}} {s['calls']:>6} {s['wall']:>9.3f} {s['maxwall']:>8.3f} {s['connect']:>10.3f} {s['rows']:>9} {s['bytes']:>11} {s['retries']:>7}" )
+
+    def dump( self, filename, **meta ):
+        """
+        Appends the statistics for this run to filename as a single line of JSON.
+        Additional keyword arguments are stored with the run metadata (e.g. the rule
+        name or the build).
+        """
+        run = {
+            'timestamp' : str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) ),
+            'host'      : platform.node(),
+            'argv'      : sys.argv,
+        }
+        run.update( meta )
+        with open( filename, 'a' ) as f:
+            f.write( json.dumps( { 'run' : run, 'queries' : self.stats() }, default=str ) + '\n' )
+
+class InstrumentedCursor:
+    """
+    Wraps a plain pyodbc cursor (e.g. ramenya2's statusdbr) so that each execute is
+    accounted against the given name, or else the name of the calling function.
+    Behaves as the underlying cursor.
+    """
+    def __init__( self, curs, collector=None ):
+        self._curs      = curs
+        self._collector = collector or stats
+        self._probe     = None
+
+    def __getattr__( self, name ):
+        return getattr( self._curs, name )
+
+    def execute( self, *args, name=None ):
+        self._probe = self._collector.probe( name or sys._getframe(1).f_code.co_name )
+        start = time.monotonic()
+        self._curs.execute( *args )
+        self._probe.executed( time.monotonic() - start )
+        return self
+
+    def _fetched( self, rows, start ):
+        if self._probe is not None:
+            self._probe.fetched( rows, time.monotonic() - start )
+        return rows
+
+    def fetchone( self ):
+        start = time.monotonic()
+        row = self._curs.fetchone()
+        self._fetched( [ row ] if row is not None else [], start )
+        return row
+
+    def fetchmany( self, size ):
+        start = time.monotonic()
+        return self._fetched( self._curs.fetchmany( size ), start )
+
+    def fetchall( self ):
+        start = time.monotonic()
+        return self._fetched( self._curs.fetchall(), start )
+
+    def __iter__( self ):
+        while True:
+            start = time.monotonic()
+            rows = self._fetched( self._curs.fetchmany( FETCHBATCH ), start )
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def commit( self ):
+        start = time.monotonic()
+        self._curs.commit()
+        if self._probe is not None:
+            self._probe.executed( time.monotonic() - start )
+
+# The collector shared by the database layer
+stats = QueryStats()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Indexed directory scanner for the direct_path inputs.
+
+A rule with a direct_path (e.g. /sphenix/lustre01/sphnxpro/{mode}/*/physics/) takes
+its input files from every file in the directories matched by the path.  Listing a
+large lustre tree on every cycle puts a heavy load on the metadata server, so the
+listings are kept in a local sqlite database (.slurp/dirindex.db) together with the
+mtime of each directory.
+
+The wildcards of the path are expanded one component at a time, and each directory
+needed (those holding a wildcard component and the matched leaf directories) is
+stat'ed.  If its mtime is unchanged since the listing was taken the cached listing
+is used (a hit), otherwise the directory is listed again with os.scandir (a miss).
+Creating, removing or renaming a file changes the mtime of its directory, so only
+the directories which gained or lost files are listed again.  A listing taken within
+RACY seconds of the directory mtime is not trusted, as later changes within the
+mtime resolution would go unnoticed.  The directories of a level are stat'ed and
+listed in parallel over THREADS threads.
+
+As with glob, names starting with a dot are not matched by wildcards.
+"""
+
+import os
+import time
+import sqlite3
+import fnmatch
+import pathlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from glob import has_magic
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+INDEXFILE = '.slurp/dirindex.db'
+
+# Number of directories stat'ed / listed concurrently
+THREADS   = 16
+
+# Seconds between a directory modification and a listing which may be trusted
+RACY      = 2.0
+
+_schema = """
+create table if not exists dirs ( path text primary key, mtime int not null, scanned real not null, entries text not null ) without rowid;
+"""
+
+@dataclass
+class SPhnxDirIndexStats:
+    """
+    Counters accumulated by the directory index.
+    """
+    hits:    int   = 0    # directories served from the index
+    misses:  int   = 0    # directories listed with scandir
+    entries: int   = 0    # entries read by scandir
+    stat:    float = 0.0  # seconds spent in stat (summed over threads)
+    scan:    float = 0.0  # seconds spent in scandir (summed over threads)
+    wall:    float = 0.0  # elapsed seconds in expand()
+
+    def dict(self):
+        return asdict(self)
+
+class DirIndex:
+    """
+    Directory listings cached by mtime.  See files().
+    """
+    def __init__( self, path=INDEXFILE, threads=THREADS, racy=RACY ):
+        pathlib.Path( path ).parent.mkdir( parents=True, exist_ok=True )
+        self.path    = path
+        self.threads = threads
+        self.racy    = racy
+        self.db      = sqlite3.connect( path, timeout=120, check_same_thread=False )
+        self.db.execute( 'pragma journal_mode=wal' )
+        self.db.executescript( _schema )
+        self._lock   = threading.Lock()
+        self._stats  = SPhnxDirIndexStats()
+
+    def _listing( self, directory ):
+        """
+        Returns the entries of the directory as a list of (name, isdir), or None if
+        it is not a directory.
+        """
+        start = time.monotonic()
+        try:
+            mtime = os.stat( directory or '.' ).st_mtime_ns
+        except OSError:
+            return None
+        stat = time.monotonic() - start
+        with self._lock:
+            self._stats.stat += stat
+            row = self.db.execute( "select mtime, scanned, entries from dirs where path=?", ( directory, ) ).fetchone()
+        if row and row[0] == mtime and row[1] - mtime / 1E9 > self.racy:
+            with self._lock:
+                self._stats.hits += 1
+            return [ ( e[:-1], True ) if e.endswith('/') else ( e, False ) for e in row[2].split('\n') if e ]
+
+        start   = time.monotonic()
+        scanned = time.time()
+        entries = []
+        try:
+            with os.scandir( directory or '.' ) as it:
+                for e in it:
+                    try:
+                        entries.append( ( e.name, e.is_dir() ) )
+                    except OSError:
+                        entries.append( ( e.name, False ) )
+        except OSError:
+            return None
+        text = '\n'.join( [ name + '/' if isdir else name for name, isdir in entries ] )
+        with self._lock:
+            self._stats.misses  += 1
+            self._stats.entries += len(entries)
+            self._stats.scan    += time.monotonic() - start
+            self.db.execute( "insert or replace into dirs (path,mtime,scanned,entries) values (?,?,?,?)", ( directory, mtime, scanned, text ) )
+        return entries
+
+    def _listings( self, pool, directories ):
+        return dict( zip( directories, pool.map( self._listing, directories ) ) )
+
+    def expand( self, pattern ):
+        """
+        Returns the directories matching the pattern (which may hold glob wildcards)
+        and their listings, as a dictionary of directory -> [ (name, isdir) ].
+        """
+        start  = time.monotonic()
+        dirs   = [ '/' if pattern.startswith('/') else '' ]
+        with ThreadPoolExecutor( max_workers=self.threads ) as pool:
+            for part in [ p for p in pattern.split('/') if p ]:
+                if not has_magic( part ):
+                    dirs = [ os.path.join( d, part ) for d in dirs ]
+                    continue
+                listings = self._listings( pool, dirs )
+                dirs = [ os.path.join( d, name ) for d in dirs for name, isdir in ( listings[d] or [] )
+                         if isdir and fnmatch.fnmatchcase( name, part ) and ( part.startswith('.') or not name.startswith('.') ) ]
+            result = { d : l for d, l in self._listings( pool, sorted(dirs) ).items() if l is not None }
+        self.db.commit()
+        with self._lock:
+            self._stats.wall += time.monotonic() - start
+        return result
+
+    def files( self, pattern ):
+        """
+        Returns the paths of all (non hidden) entries of the directories matching
+        the pattern, as glob( pattern + '/*' ) would.
+        """
+        return [ os.path.join( d, name ) for d, listing in self.expand( pattern ).items()
+                 for name, isdir in listing if not name.startswith('.') ]
+
+    def stats( self ):
+        with self._lock:
+            return self._stats.dict()
+
+    def report( self, log=INFO ):
+        s = self.stats()
+        log( f"dirindex: {s['hits']} hits, {s['misses']} misses, {s['entries']} entries scanned in {s['scan']:.3f}s, stat {s['stat']:.3f}s, wall {s['wall']:.3f}s" )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Concurrent dispatch of rules to a pool of worker processes.
+
+ramenya submits the rules of each cycle through a RuleDispatcher.  Each worker is a
+long lived (spawned) process which calls the target (kaedama.run) for one rule at a
+time, so the database connections and parsed configurations held by a worker are
+reused from rule to rule and from cycle to cycle.  Up to width rules run at the same
+time, so a rule with a slow input query no longer holds up the others.
+
+A rule which runs past its timeout has its worker killed (and replaced) and is
+reported as timed out.  A rule marked isolate runs in a worker of its own, which is
+retired once the rule completes.
+
+When a capacity is given (the number of jobs the schedd may still take) each rule
+reserves its maxjobs from the capacity before it starts, and returns the jobs it did
+not submit when it completes (all of them when it reports no jobs, i.e. it exited
+early).  A rule which fails or times out keeps its reservation, as it may have
+submitted part of its jobs.  No rule is started while the capacity is exhausted, so
+the rules running together cannot overshoot it.
+"""
+
+import time
+import signal
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+# Default number of rules run concurrently
+WIDTH = 1
+
+# Seconds given to an idle worker to exit before it is killed
+STOPWAIT = 10.0
+
+@dataclass
+class SPhnxRuleTask:
+    """
+    A rule (or group of rules) to be run by the target.
+    """
+    name:    str
+    args:    tuple = ()       # positional arguments of the target
+    maxjobs: int   = None     # jobs the rule may submit (None or 0: no limit of its own)
+    timeout: float = None     # seconds, overrides the default timeout of dispatch()
+    isolate: bool  = False    # run in a worker of its own
+
+@dataclass
+class SPhnxRuleResult:
+    """
+    Outcome of a rule dispatched in a cycle.
+    """
+    name:   str
+    status: str   = 'pending' # ok, failed, timeout or skipped
+    jobs:   int   = None      # jobs dispatched as reported by the target
+    budget: int   = None      # jobs reserved from the capacity
+    wall:   float = 0.0       # seconds
+    pid:    int   = 0         # worker process
+    error:  str   = None
+
+    def dict(self):
+        return asdict(self)
+
+def _serve( conn, target ):
+    """
+    Worker loop.  Calls target( *args, maxjobs=budget ) for each request until the
+    connection is closed.
+    """
+    signal.signal( signal.SIGINT, signal.SIG_IGN ) # ctrl-c is handled by the parent
+    while True:
+        try:
+            args, budget = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send( ( 'ok', target( *args, maxjobs=budget ), None ) )
+        except Exception:
+            conn.send( ( 'failed', None, traceback.format_exc() ) )
+
+class _Worker:
+    def __init__( self, context, target ):
+        self.conn, child = context.Pipe()
+        self.process = context.Process( target=_serve, args=( child, target ), daemon=True )
+        self.process.start()
+        child.close()
+        self.started  = 0.0
+        self.deadline = None
+
+    def start( self, task, budget, timeout ):
+        self.started  = time.monotonic()
+        self.deadline = self.started + timeout if timeout else None
+        self.conn.send( ( task.args, budget ) )
+
+    def stop( self ):
+        self.conn.close()
+        self.process.join( STOPWAIT )
+        if self.process.is_alive():
+            self.kill()
+
+    def kill( self ):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class RuleDispatcher:
+    """
+    Pool of width worker processes calling target.  See dispatch().
+    """
+    def __init__( self, target, width=WIDTH, context='spawn' ):
+        self.target  = target
+        self.width   = max( 1, int(width) )
+        self.context = multiprocessing.get_context( context )
+        self._idle   = []
+
+    def _worker( self ):
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.kill()
+        return _Worker( self.context, self.target )
+
+    def dispatch( self, tasks, capacity=None, timeout=None ):
+        """
+        Runs the tasks in order, at most width at a time, reserving the jobs of each from
+        the capacity (if given).  Returns the results in the order of the tasks.
+        """
+        results = [ SPhnxRuleResult( t.name ) for t in tasks ]
+        pending = list( zip( tasks, results ) )
+        running = {}  # connection -> ( worker, task, result )
+
+        while pending or running:
+
+            while pending and len(running) < self.width:
+                task, result = pending[0]
+                budget = task.maxjobs or None
+                if capacity is not None:
+                    if capacity <= 0 and running:
+                        break
+                    if capacity <= 0:
+                        pending.pop(0)
+                        result.status = 'skipped'
+                        result.error  = 'no capacity left'
+                        continue
+                    budget    = capacity if budget is None else min( int(budget), capacity )
+                    capacity -= budget
+                pending.pop(0)
+                worker = self._worker()
+                worker.start( task, budget, task.timeout or timeout )
+                result.budget = budget
+                result.pid    = worker.process.pid
+                running[ worker.conn ] = ( worker, task, result )
+
+            if not running:
+                continue
+
+            deadlines = [ w.deadline for w, t, r in running.values() if w.deadline ]
+            wait      = max( 0.0, min(deadlines) - time.monotonic() ) if deadlines else None
+            for conn in multiprocessing.connection.wait( list(running), timeout=wait ):
+                worker, task, result = running.pop( conn )
+                result.wall = time.monotonic() - worker.started
+                try:
+                    result.status, result.jobs, result.error = conn.recv()
+                except ( EOFError, OSError ):
+                    worker.kill()
+                    result.status = 'failed'
+                    result.error  = f"worker {result.pid} exited with {worker.process.exitcode}"
+                    continue
+                if capacity is not None and result.status == 'ok':   # no jobs reported (the rule exited early): none submitted
+                    capacity += result.budget - min( result.jobs or 0, result.budget )
+                if task.isolate:
+                    worker.stop()
+                else:
+                    self._idle.append( worker )
+
+            now = time.monotonic()
+            for conn, ( worker, task, result ) in list( running.items() ):
+                if worker.deadline and now >= worker.deadline:
+                    running.pop( conn )
+                    worker.kill()
+                    result.wall   = now - worker.started
+                    result.status = 'timeout'
+                    result.error  = f"killed after {result.wall:.0f}s"
+
+        return results
+
+    def close( self ):
+        """
+        Stops the idle workers.
+        """
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Cache of the git checks made on the payload directory of a rule.
+
+matches() records the hash and origin of the payload repository in the production
+setup and, in production mode, verifies that the local HEAD is found on the remote.
+fetch_production_setup() then compares the local and remote hashes.  The answers only
+change when the payload repository moves, so they are cached per
+
+    ( payload directory, checked out ref, HEAD hash, packed-refs mtime, loose ref mtimes )
+
+where the checked out ref (the branch named in HEAD) and the hash it points to are
+read from the files under .git (no subprocess), and the loose refs are the remote
+tracking refs of the current branch and of origin/HEAD, FETCH_HEAD and the config
+file, which a fetch, pull or push touches (a commit or checkout moves HEAD).  The index is left out of the key, as git status itself rewrites it, and so are
+edits to the working tree: the cached git status is that of the last miss.  A hit costs
+a few stat() calls.  A miss runs git once per answer, and the containment of HEAD in
+origin/<branch> is a single merge-base --is-ancestor test.
+
+The answers are kept in memory for the life of the process (a ramenya worker) and in
+a local sqlite database (.slurp/gitcache.db) shared between invocations.  Payloads
+which are not in a git repository are not cached.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import pathlib
+
+import sh
+
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+CACHEFILE = '.slurp/gitcache.db'
+
+# Entries not used for this many seconds are dropped from the database
+MAXAGE    = 30 * 24 * 3600.0
+
+_schema = """
+create table if not exists payloads ( key text primary key, info text not null, used real );
+"""
+
+@dataclass
+class SPhnxPayloadInfo:
+    """
+    The answers of git for a payload directory.
+    """
+    hash:      str          # short hash of HEAD
+    fullhash:  str          # full hash of HEAD
+    url:       str          # remote.origin.url
+    branch:    str          # current branch (empty when detached)
+    contained: bool         # HEAD is on origin/<branch>
+    remote:    str          # short hash of origin (origin/HEAD)
+    status:    str          # git status -uno --short
+
+    def dict(self):
+        return asdict(self)
+
+def _read( path ):
+    try:
+        with open( path ) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _mtime( path ):
+    try:
+        return os.stat( path ).st_mtime_ns
+    except OSError:
+        return 0
+
+def _gitdirs( payload ):
+    """
+    Returns the ( gitdir, commondir ) of the repository containing payload, or None.
+    """
+    path = pathlib.Path( payload ).resolve()
+    for top in [ path, *path.parents ]:
+        dotgit = top / '.git'
+        if dotgit.is_dir():
+            gitdir = dotgit
+        elif dotgit.is_file():   # worktree or submodule: "gitdir: <path>"
+            line = _read( dotgit ) or ''
+            if not line.startswith( 'gitdir:' ):
+                return None
+            gitdir = ( top / line[len('gitdir:'):].strip() ).resolve()
+        else:
+            continue
+        common = _read( gitdir / 'commondir' )
+        return gitdir, ( gitdir / common ).resolve() if common else gitdir
+    return None
+
+def _resolve( commondir, ref ):
+    """
+    Returns the hash of a ref from its loose file or from packed-refs.
+    """
+    result = _read( commondir / ref )
+    if result:
+        return result
+    packed = _read( commondir / 'packed-refs' ) or ''
+    for line in packed.split('\n'):
+        if line.endswith( ' ' + ref ):
+            return line.split()[0]
+    return None
+
+def _git( payload, *args, **kwargs ):
+    return str( sh.git( '--no-pager', *args, _cwd=payload, **kwargs ) ).strip()
+
+class GitCache:
+    """
+    Cached SPhnxPayloadInfo of payload directories.  See info().
+    """
+    def __init__( self, path=CACHEFILE, maxage=MAXAGE ):
+        self.path    = path
+        self.maxage  = maxage
+        self.db      = None
+        self._memory = {}
+        self.hits    = 0
+        self.misses  = 0
+
+    def _connect( self ):
+        if self.db is None:
+            pathlib.Path( self.path ).parent.mkdir( parents=True, exist_ok=True )
+            self.db = sqlite3.connect( self.path, timeout=120 )
+            self.db.execute( 'pragma journal_mode=wal' )
+            self.db.executescript( _schema )
+            self.db.execute( "delete from payloads where used<?", ( time.time() - self.maxage, ) )
+            self.db.commit()
+        return self.db
+
+    def key( self, payload ):
+        """
+        The cache key of payload, or None when it is not in a git repository.
+        """
+        dirs = _gitdirs( payload )
+        if dirs is None:
+            return None
+        gitdir, commondir = dirs
+        head = _read( gitdir / 'HEAD' )
+        if head is None:
+            return None
+        branch = ''
+        if head.startswith( 'ref:' ):
+            ref    = head[len('ref:'):].strip()
+            branch = ref[len('refs/heads/'):] if ref.startswith( 'refs/heads/' ) else ref
+            head   = _resolve( commondir, ref )
+            if head is None:   # unborn branch
+                return None
+        mtimes = [ _mtime( commondir / f ) for f in ( 'packed-refs', f'refs/remotes/origin/{branch}', 'refs/remotes/origin/HEAD', 'config' ) ]
+        mtimes.append( _mtime( gitdir / 'FETCH_HEAD' ) )
+        return json.dumps( [ str( pathlib.Path( payload ).resolve() ), branch, head, *mtimes ] )
+
+    def verify( self, payload ):
+        """
+        Asks git.
+        """
+        fullhash = _git( payload, 'rev-parse', 'HEAD' )[:40]
+        branch   = _git( payload, 'branch', '--show-current' )
+        contained= False
+        if branch:
+            try:   # fails when HEAD is not an ancestor, or when there is no origin/<branch>
+                sh.git( '--no-pager', 'merge-base', '--is-ancestor', 'HEAD', f'origin/{branch}', _cwd=payload )
+                contained = True
+            except sh.ErrorReturnCode:
+                pass
+        return SPhnxPayloadInfo( hash      = _git( payload, 'rev-parse', '--short', 'HEAD' ),
+                                 fullhash  = fullhash,
+                                 url       = _git( payload, 'config', '--get', 'remote.origin.url', _ok_code=[0,1] ),
+                                 branch    = branch,
+                                 contained = contained,
+                                 remote    = _git( payload, 'show', 'origin', '--format=%h', '-s', _ok_code=[0,128] ),
+                                 status    = _git( payload, '-c', 'color.status=no', 'status', '-uno', '--short' ) )
+
+    def info( self, payload ):
+        """
+        Returns the SPhnxPayloadInfo of payload, from the cache when the repository has
+        not changed since it was stored.
+        """
+        key = self.key( payload )
+        if key is None:
+            self.misses += 1
+            return self.verify( payload )
+
+        result = self._memory.get( key, None )
+        if result is not None:
+            self.hits += 1
+            return result
+
+        db  = self._connect()
+        row = db.execute( "select info from payloads where key=?", ( key, ) ).fetchone()
+        if row is not None:
+            result = SPhnxPayloadInfo( **json.loads( row[0] ) )
+            db.execute( "update payloads set used=? where key=?", ( time.time(), key ) )
+            self.hits += 1
+        else:
+            result = self.verify( payload )
+            db.execute( "insert or replace into payloads (key,info,used) values (?,?,?)", ( key, json.dumps( result.dict() ), time.time() ) )
+            self.misses += 1
+        db.commit()
+        self._memory[ key ] = result
+        return result
+
+    def report( self, log=INFO ):
+        log( f"payload git checks: {self.hits} cached, {self.misses} verified" )
+
+# The payload checks of this process
+payloads = GitCache()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Creation of the output directories of the submitted jobs.
+
+submit() hands each chunk of jobs the set of directories its jobs write to (the
+outdir, logdir, condor, histdir and calibdir templates expanded for the run groups,
+run types and streams of the chunk).  Directories already created by this submission
+are skipped.  With --knowndirs the directories known to exist are also kept in a
+local sqlite database (.slurp/knowndirs.db), so that later invocations skip them as
+well.  An entry is trusted for MAXAGE seconds, after which the directory is created
+(i.e. checked) again.
+
+On lustre every mkdir is a round trip to the metadata server, so the missing
+directories are created over THREADS threads.
+"""
+
+import time
+import sqlite3
+import pathlib
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+CACHEFILE = '.slurp/knowndirs.db'
+
+# Number of directories created concurrently
+THREADS   = 8
+
+# Seconds for which a directory in the database is trusted to exist
+MAXAGE    = 24 * 3600.0
+
+# Directories looked up in the database per query
+LOOKUPBLOCK = 512
+
+_schema = """
+create table if not exists dirs ( path text primary key, seen real not null ) without rowid;
+"""
+
+@dataclass
+class SPhnxKnownDirsStats:
+    """
+    Counters accumulated by the directory creation.
+    """
+    targets: int   = 0    # distinct directories requested
+    known:   int   = 0    # directories known to exist (this submission or the database)
+    created: int   = 0    # directories created (or found to exist) with mkdir
+    wall:    float = 0.0  # elapsed seconds in materialize()
+
+    def dict(self):
+        return asdict(self)
+
+def _mkdir( path ):
+    pathlib.Path( path ).mkdir( parents=True, exist_ok=True )
+
+class KnownDirs:
+    """
+    Creates directories which are not known to exist.  See materialize().
+    """
+    def __init__( self, path=None, threads=THREADS, maxage=MAXAGE ):
+        self.path    = path
+        self.threads = threads
+        self.maxage  = maxage
+        self.db      = None
+        self._known  = set()
+        self._stats  = SPhnxKnownDirsStats()
+        if path:
+            pathlib.Path( path ).parent.mkdir( parents=True, exist_ok=True )
+            self.db = sqlite3.connect( path, timeout=120 )
+            self.db.execute( 'pragma journal_mode=wal' )
+            self.db.executescript( _schema )
+
+    def _lookup( self, paths ):
+        """
+        Returns the paths recorded in the database within maxage.
+        """
+        result = set()
+        paths  = sorted( paths )
+        since  = time.time() - self.maxage
+        for first in range( 0, len(paths), LOOKUPBLOCK ):
+            block = paths[first:first+LOOKUPBLOCK]
+            marks = ','.join( [ '?' ] * len(block) )
+            result.update( r[0] for r in self.db.execute( f"select path from dirs where seen>? and path in ({marks})", ( since, *block ) ) )
+        return result
+
+    def materialize( self, paths ):
+        """
+        Creates the directories in paths which are not known to exist.  Returns the
+        SPhnxKnownDirsStats of the call.
+        """
+        start   = time.monotonic()
+        paths   = set( paths )
+        missing = paths - self._known
+        if self.db is not None and missing:
+            missing = missing - self._lookup( missing )
+
+        if missing:
+            with ThreadPoolExecutor( max_workers=min( self.threads, len(missing) ) ) as pool:
+                list( pool.map( _mkdir, sorted(missing) ) )
+
+        if self.db is not None and missing:
+            now = time.time()
+            self.db.executemany( "insert or replace into dirs (path,seen) values (?,?)", [ ( p, now ) for p in missing ] )
+            self.db.commit()
+        self._known.update( paths )
+
+        result = SPhnxKnownDirsStats( len(paths), len(paths) - len(missing), len(missing), time.monotonic() - start )
+        self._stats.targets += result.targets
+        self._stats.known   += result.known
+        self._stats.created += result.created
+        self._stats.wall    += result.wall
+        return result
+
+    def stats( self ):
+        return self._stats.dict()
+
+    def report( self, log=INFO ):
+        s = self._stats
+        log( f"output directories: {s.targets} needed, {s.known} known, {s.created} created in {s.wall:.3f}s" )
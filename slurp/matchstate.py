@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Persisted state for incremental matching.
+
+In incremental mode matches() remembers, per rule, the candidate outputs which have
+already been decided: those found in the file catalog (produced) and those blocked by
+their production status.  Neither decision is reversed by a later cycle (an output
+which is produced stays produced, a blocked output stays blocked until its entry is
+removed), so on the next cycle those candidates are dropped as soon as they come out
+of the input query, and the existence, lfn2pfn and production status lookups only
+cover the run range of the new or undecided candidates.
+
+Every RECONCILE seconds the state is rebuilt from a full evaluation, which catches
+anything changed behind slurp's back (e.g. production status entries removed by
+hand).  A full evaluation is also made when blocking states are overridden
+(--unblock-state) or outputs are resubmitted.
+
+The decided outputs of all rules are kept in a local sqlite database
+(.slurp/matchstate.db), indexed on ( rule, run, output ).  A pass reads the decisions
+of the runs of its candidates (once per run, as the input query is ordered by run) and
+inserts the outputs it decides, so its cost does not grow with the history of the
+rule.  The decisions of a pass are written when it is saved, in a single transaction
+(which also drops the previous decisions of the rule after a full pass).
+"""
+
+import time
+import sqlite3
+import pathlib
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+STATEFILE = '.slurp/matchstate.db'
+
+# Seconds between full reconciliations
+RECONCILE = 6 * 3600.0
+
+_schema = """
+create table if not exists rules   ( key text primary key, reconciled real not null );
+create table if not exists decided ( key text not null, run int not null, output text not null, reason text not null,
+                                     primary key (key, run, output) ) without rowid;
+"""
+
+class MatchState:
+    """
+    Decided candidate outputs of a single rule.
+    """
+    def __init__( self, key, path=STATEFILE, reconcile=RECONCILE ):
+        pathlib.Path( path ).parent.mkdir( parents=True, exist_ok=True )
+        self.key        = key
+        self.path       = path
+        self.reconcile  = float( reconcile )
+        self.db         = sqlite3.connect( path, timeout=120 )
+        self.db.execute( 'pragma journal_mode=wal' )
+        self.db.executescript( _schema )
+        self.decisions  = []      # ( run, output, reason ) decided on this pass
+        self._runs      = {}      # run -> outputs decided on previous passes
+        self.full       = True    # this pass evaluates every candidate
+        self.skipped    = 0
+        row = self.db.execute( "select reconciled from rules where key=?", ( key, ) ).fetchone()
+        self.reconciled = row[0] if row else 0.0   # time of the last full evaluation
+
+    def begin( self, full=False ):
+        """
+        Starts a pass.  The pass is a full evaluation if requested, if there is no
+        prior state, or if the reconciliation period has elapsed.
+        """
+        self.full      = full or self.reconciled == 0.0 or time.time() - self.reconciled >= self.reconcile
+        self.skipped   = 0
+        self.decisions = []
+        self._runs     = {}
+        return self
+
+    def skip( self, output, run ):
+        """
+        True if the candidate output (of the given run) was decided on a previous pass.
+        """
+        if self.full:
+            return False
+        outputs = self._runs.get( int(run), None )
+        if outputs is None:
+            outputs = self._runs[ int(run) ] = { r[0] for r in self.db.execute( "select output from decided where key=? and run=?", ( self.key, int(run) ) ) }
+        if output not in outputs:
+            return False
+        self.skipped += 1
+        return True
+
+    def decide( self, output, reason, run ):
+        self.decisions.append( ( int(run), output, reason ) )
+
+    def save( self ):
+        with self.db:
+            if self.full:
+                self.reconciled = time.time()
+                self.db.execute( "delete from decided where key=?", ( self.key, ) )
+                self.db.execute( "insert or replace into rules (key,reconciled) values (?,?)", ( self.key, self.reconciled ) )
+            self.db.executemany( "insert or replace into decided (key,run,output,reason) values (?,?,?,?)",
+                                 ( ( self.key, run, output, reason ) for run, output, reason in self.decisions ) )
+        self.decisions = []
+        self._runs     = {}
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of the lfn -> pfn map built by matches() from the file catalog.
+
+The map is cached per (dataset, dsttype, block of RUNBLOCK runs) in a local sqlite
+database (.slurp/lfn2pfn.db).  For each block we keep a watermark: the time of the
+file catalog server when the block was last fetched, less LAG seconds.  The file
+stamps are not used, as cups registers files with time='now', i.e. the start of its
+transaction, which may commit after a fetch with a later stamp.  A lookup over a run
+window fetches in full the blocks which are not cached (or were filled more than
+MAXAGE seconds ago, so that deleted or moved files are eventually dropped), and for
+the cached blocks only the files with time >= watermark.  Both are requested from the
+file catalog in a single query.  Blocks without any file are cached as well.
+
+Directories are stored once and the file name is only stored when it differs from
+the lfn, which keeps the cache compact.  When the cache holds more than MAXROWS
+files, the least recently used blocks are evicted.
+"""
+
+import time
+import sqlite3
+import datetime
+import pathlib
+import itertools
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+CACHEFILE = '.slurp/lfn2pfn.db'
+
+# Number of runs in a cached block (the run groups of the production directory layout)
+RUNBLOCK  = 100
+
+# Maximum number of files in the cache
+MAXROWS   = 5000000
+
+# Seconds after which a block is fetched again in full
+MAXAGE    = 24 * 3600.0
+
+# Seconds subtracted from the server time of a fetch to make the watermark, which covers
+# the files registered by transactions still open at the time of the fetch
+LAG       = 3600.0
+
+# Server time, without time zone as the files.time column
+_servertime = "select now()::timestamp as now"
+
+_schema = """
+create table if not exists blocks ( id integer primary key, dataset text not null, dsttype text not null, block int not null,
+                                    watermark text, filled real, used real, nrows int default 0,
+                                    unique (dataset, dsttype, block) );
+create table if not exists dirs   ( id integer primary key, path text not null unique );
+create table if not exists pfns   ( keyid int not null, lfn text not null, dirid int not null, name text,
+                                    primary key (keyid, lfn) ) without rowid;
+"""
+
+class PfnCache:
+    """
+    Persistent lfn -> pfn map.  See lookup().
+    """
+    def __init__( self, path=CACHEFILE, maxrows=MAXROWS, maxage=MAXAGE, runblock=RUNBLOCK, lag=LAG ):
+        pathlib.Path( path ).parent.mkdir( parents=True, exist_ok=True )
+        self.path     = path
+        self.maxrows  = maxrows
+        self.maxage   = maxage
+        self.runblock = runblock
+        self.lag      = lag
+        self.db       = sqlite3.connect( path, timeout=120 )
+        self.db.execute( 'pragma journal_mode=wal' )
+        self.db.executescript( _schema )
+        self._dirs    = {}
+
+    def _dir( self, path ):
+        result = self._dirs.get( path, None )
+        if result is None:
+            self.db.execute( "insert or ignore into dirs (path) values (?)", ( path, ) )
+            result = self._dirs[path] = self.db.execute( "select id from dirs where path=?", ( path, ) ).fetchone()[0]
+        return result
+
+    def _key( self, dataset, dsttype, block ):
+        self.db.execute( "insert or ignore into blocks (dataset,dsttype,block) values (?,?,?)", ( dataset, dsttype, block ) )
+        return self.db.execute( "select id,watermark,filled from blocks where dataset=? and dsttype=? and block=?", ( dataset, dsttype, block ) ).fetchone()
+
+    def _ranges( self, blocks ):
+        """
+        Merges consecutive blocks into inclusive run ranges.
+        """
+        for _, group in itertools.groupby( enumerate( sorted(blocks) ), lambda ib: ib[1] - ib[0] ):
+            group = [ b for _, b in group ]
+            yield group[0] * self.runblock, ( group[-1] + 1 ) * self.runblock - 1
+
+    def lookup( self, fetch, datasets, runMin, runMax ):
+        """
+        Returns the lfn -> pfn map of the given (dataset, dsttype) pairs over the run
+        window.  fetch(query) executes a query against the file catalog and returns
+        rows of (runnumber, dataset, dsttype, lfn, pfn).
+        """
+        now    = time.time()
+        keys   = {}   # (dataset, dsttype, block) -> key id
+        terms  = []
+        nfull  = 0
+        ndelta = 0
+        first, last = int(runMin) // self.runblock, int(runMax) // self.runblock
+        for dataset, dsttype in sorted( set( datasets ) ):
+            full  = []
+            delta = {}   # watermark -> blocks
+            for block in range( first, last + 1 ):
+                keyid, watermark, filled = self._key( dataset, dsttype, block )
+                keys[ (dataset, dsttype, block) ] = keyid
+                if watermark is None or filled is None or now - filled > self.maxage:
+                    self.db.execute( "delete from pfns where keyid=?", ( keyid, ) )
+                    self.db.execute( "update blocks set watermark=null,filled=?,nrows=0 where id=?", ( now, keyid ) )
+                    full.append( block )
+                else:
+                    delta.setdefault( watermark, [] ).append( block )
+            select = f"dataset='{dataset}' and dsttype='{dsttype}'"
+            for lo, hi in self._ranges( full ):
+                terms.append( f"({select} and runnumber>={lo} and runnumber<={hi})" )
+            for watermark, blocks in delta.items():
+                for lo, hi in self._ranges( blocks ):
+                    terms.append( f"({select} and runnumber>={lo} and runnumber<={hi} and files.time>='{watermark}')" )
+            nfull  += len(full)
+            ndelta += sum( [ len(b) for b in delta.values() ] )
+
+        nrows = 0
+        if terms:
+            watermark = self.watermark( fetch )
+            query = f"""
+            select runnumber, dataset, dsttype, lfn, full_file_path as pfn
+            from datasets join files on datasets.filename=files.lfn
+            where {' or '.join( terms )}
+            """
+            for r in fetch( query ):
+                keyid = keys[ ( r[1], r[2], int(r[0]) // self.runblock ) ]
+                directory, _, name = r[4].rpartition( '/' )
+                self.db.execute( "insert or replace into pfns (keyid,lfn,dirid,name) values (?,?,?,?)",
+                                 ( keyid, r[3], self._dir( directory ), None if name == r[3] else name ) )
+                nrows += 1
+            # every block of the window was fetched (in full or since its watermark), empty or not
+            for keyid in keys.values():
+                self.db.execute( "update blocks set watermark=?,nrows=(select count(*) from pfns where keyid=?) where id=?", ( watermark, keyid, keyid ) )
+
+        ids = list( keys.values() )
+        result = {}
+        for i in range( 0, len(ids), 500 ):
+            block = ids[i:i+500]
+            marks_ = ','.join( [ '?' ] * len(block) )
+            self.db.execute( f"update blocks set used=? where id in ({marks_})", ( now, *block ) )
+            for lfn, directory, name in self.db.execute( f"select lfn, path, name from pfns join dirs on pfns.dirid=dirs.id where keyid in ({marks_})", block ):
+                result[ lfn ] = f"{directory}/{name or lfn}"
+
+        self.evict( keep=set(ids) )
+        self.db.commit()
+        INFO(f"lfn2pfn cache: {nfull} blocks fetched in full, {ndelta} refreshed, {nrows} rows transferred, {len(result)} pfns")
+        return result
+
+    def watermark( self, fetch ):
+        """
+        Returns the server time less lag, formatted as a files.time literal.
+        """
+        now = list( fetch( _servertime ) )[0][0]
+        if not isinstance( now, datetime.datetime ):
+            now = datetime.datetime.fromisoformat( str(now) )
+        return ( now - datetime.timedelta( seconds=self.lag ) ).strftime( '%Y-%m-%d %H:%M:%S' )
+
+    def evict( self, keep=() ):
+        """
+        Drops the least recently used blocks until at most maxrows files are cached.
+        Blocks in keep are only evicted once no other block is left.
+        """
+        total = self.db.execute( "select coalesce(sum(nrows),0) from blocks" ).fetchone()[0]
+        if total <= self.maxrows:
+            return
+        blocks = self.db.execute( "select id, nrows, used from blocks" ).fetchall()
+        for keyid, nrows, used in sorted( blocks, key=lambda b: ( b[0] in keep, b[2] or 0 ) ):
+            if total <= self.maxrows:
+                break
+            self.db.execute( "delete from pfns where keyid=?", ( keyid, ) )
+            self.db.execute( "delete from blocks where id=?", ( keyid, ) )
+            total -= nrows
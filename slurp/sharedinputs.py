@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Shared evaluation of the inputs of several rules.
+
+Several rules of a yaml file often read the same inputs (e.g. the same daq filelist or
+file catalog query with a different output name).  When kaedama runs such rules in a
+single invocation (kaedama.py --rules A B C) the input query of each group of rules
+with the same normalized query (whitespace collapsed) on the same database is executed
+once, and the lfn -> pfn map built from the input datasets (or from the direct path)
+is built once for the whole group.  Each rule then applies its own output naming,
+existence and production status checks to the shared rows (see MatchPipeline).
+
+The shared results live for a single invocation (one cycle).  They are only used
+while shared.active is set.
+
+The rows of a shared query are held in memory until the end of the invocation (and the
+lfn -> pfn map covers every file they request), rather than streamed through the
+pipeline batch by batch.  Queries returning more than SHAREROWS rows are therefore not
+shared: each rule streams its own execution of the query, as without --rules.  The rows
+held are counted in report().
+"""
+
+import re
+import itertools
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+# Largest number of input query rows held in memory to be shared between rules
+SHAREROWS = 250000
+
+def normalize( query ):
+    """
+    Collapses the whitespace of a query and drops a trailing semicolon.
+    """
+    return re.sub( r'\s+', ' ', query or '' ).strip().rstrip(';').strip()
+
+class SharedInput:
+    """
+    The rows returned by an input query, and the lfn -> pfn maps built for them.
+    """
+    def __init__( self, rows ):
+        self.rows   = rows
+        self.runMin = min( [ r.runnumber for r in rows ], default=0 )
+        self.runMax = max( [ r.runnumber for r in rows ], default=0 )
+        self._pfns  = {}
+
+    def lfns( self ):
+        """
+        The set of all input files requested by the rows.
+        """
+        return set( itertools.chain.from_iterable( r.files.split() for r in self.rows ) )
+
+    def lfn2pfn( self, key, build ):
+        """
+        Returns the lfn -> pfn map stored under key, building it with build() once.
+        """
+        result = self._pfns.get( key, None )
+        if result is None:
+            result = self._pfns[ key ] = build()
+            shared.misses += 1
+        else:
+            shared.hits += 1
+        return result
+
+class SharedInputs:
+    """
+    Input query results shared between the rules of an invocation.
+    """
+    def __init__( self, maxrows=SHAREROWS ):
+        self.active  = False
+        self.maxrows = maxrows
+        self._inputs = {}
+        self._direct = {}
+        self._large  = set() # keys of the queries returning more than maxrows rows
+        self.rules   = {}    # key -> names of the rules which read the input
+        self.hits    = 0
+        self.misses  = 0
+        self.unshared= 0     # evaluations of queries too large to be shared
+
+    def key( self, rule ):
+        return ( rule.filesdb, normalize( rule.files ) )
+
+    def group( self, rules ):
+        """
+        Groups the rules by input, returning a dictionary of key -> [ rules ].
+        """
+        result = {}
+        for rule in rules:
+            result.setdefault( self.key(rule), [] ).append( rule )
+        return result
+
+    def input( self, rule, fetch ):
+        """
+        Returns the SharedInput of the rule and its rows, executing fetch() (which returns
+        the rows of the input query) for the first rule of the group.  When the query
+        returns more than maxrows rows the SharedInput is None, and the rows are streamed
+        from an execution of the query of the rule's own.
+        """
+        key = self.key( rule )
+        self.rules.setdefault( key, [] ).append( rule.name )
+        if key in self._large:
+            self.unshared += 1
+            return None, fetch()
+        result = self._inputs.get( key, None )
+        if result is None:
+            rows = iter( fetch() )
+            head = list( itertools.islice( rows, self.maxrows + 1 ) )
+            if len(head) > self.maxrows:
+                INFO(f"The input query of {rule.name} returns more than {self.maxrows} rows, it is streamed rather than shared")
+                self._large.add( key )
+                self.unshared += 1
+                return None, itertools.chain( head, rows )
+            result = self._inputs[ key ] = SharedInput( head )
+            self.misses += 1
+        else:
+            INFO(f"Reusing the {len(result.rows)} rows of the input query shared with {', '.join( self.rules[key][:-1] )}")
+            self.hits += 1
+        return result, result.rows
+
+    def direct( self, path, build ):
+        """
+        Returns the lfn -> pfn map of a direct path, building it with build() once.
+        """
+        result = self._direct.get( path, None )
+        if result is None:
+            result = self._direct[ path ] = build()
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def clear( self ):
+        self._inputs = {}
+        self._direct = {}
+        self._large  = set()
+        self.rules   = {}
+        self.hits    = 0
+        self.misses  = 0
+        self.unshared= 0
+
+    def report( self, log=INFO ):
+        shares = [ names for names in self.rules.values() if len(names) > 1 ]
+        log( f"shared inputs: {len(self.rules)} input queries for {sum( [ len(n) for n in self.rules.values() ] )} rules, {self.hits} results reused, {self.misses} evaluated" )
+        log( f"  {sum( [ len(i.rows) for i in self._inputs.values() ] )} rows held in memory, {self.unshared} evaluations of queries over {self.maxrows} rows not shared" )
+        for names in shares:
+            log( f"  shared by {' '.join(names)}" )
+
+# The shared inputs of this invocation
+shared = SharedInputs()
@@ -13,12 +13,15 @@ import argparse
 import datetime
 import time
 import itertools
+import concurrent.futures
 from  glob import glob
 import math
 import platform
 from collections import defaultdict
+from collections.abc import MutableMapping
 import random
 import inspect
+import sys
 
 #from slurp import slurptables
 #from slurp.slurptables import SPhnxProductionSetup
@@ -35,8 +38,23 @@ from slurptables import SPhnxProductionSetup
 from slurptables import SPhnxProductionStatusMap
 from slurptables import SPhnxInvalidRunList
 
+import dbbackend
 
-from dataclasses import dataclass, asdict, field
+from dbpool import pool as dbpool, FETCHBATCH
+from dbstats import stats as dbstats
+from stagetimer import stages
+from matchstate import MatchState, RECONCILE
+from pfncache import PfnCache
+from dirindex import DirIndex
+from sharedinputs import shared
+from gitcache import payloads
+import knowndirs
+from knowndirs import KnownDirs
+from condorschedd import Schedd
+from dbroute import ReadRouter
+from dbstatements import statements, insert_production_status_sql, insert_blocks, values_sql, value_blocks, bulk_blocks, STAGEROWS
+
+from dataclasses import dataclass, asdict, field, fields
 
 from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
 
@@ -52,7 +70,8 @@ with open('.slurp/slurppath.sh', 'w' ) as sp:
 MAXDSTNAMES = 100
 
 # List of states which block the job
-blocking = ["submitting","submitted","started","running","held","evicted","failed","finished"]
+BLOCKING = ["submitting","submitted","started","running","held","evicted","failed","finished"]
+blocking = list( BLOCKING )
 args     = None
 userargs = None
 
@@ -100,12 +119,25 @@ cnxn_string_map = {
     'rawdr'       :  'DSN=RawdataCatalog_read;UID=phnxrc;READONLY=True',
 }
 
+# Reads addressed to the write DSN are sent to the read replica when it has caught up
+dbrouter = ReadRouter( dbpool, { cnxn_string_map['statusw'] : cnxn_string_map['status'] } )
+
 if 0:
     pprint.pprint( cnxn_string_map )
     for k,v in cnxn_string_map.items():
         printDbInfo( pyodbc.connect(v), k )
 
-def dbQuery( cnxn_string, query, ntries=10 ):
+def dbQuery( cnxn_string, query, ntries=10, stream=False, batchsize=FETCHBATCH, name=None ):
+    """
+    Executes the query and returns the cursor.  If stream is set, returns an iterator over
+    the result which fetches batchsize rows at a time (through a server-side cursor where
+    the backend supports one).  n.b. only the execution of the query is retried, errors
+    raised while iterating over a stream are not.
+
+    The query is accounted in dbstats under the given name, or else under the name of the
+    calling function.  Raw queries are never sent to a read replica, and a raw query against
+    a primary pins subsequent reads to it (see dbroute).
+    """
 
     # A guard rail ... or maybe not ...
     #assert( 'delete' not in query.lower() )    
@@ -113,20 +145,32 @@ def dbQuery( cnxn_string, query, ntries=10 ):
     #assert( 'update' not in query.lower() )    
     #assert( 'select'     in query.lower() )
 
+    if name is None:
+        name = sys._getframe(1).f_code.co_name
+
+    cnxn_string = dbrouter.route( cnxn_string, read=False )
+
     lastException = None
+    probe = dbstats.probe( name )   # one call, however many attempts it takes
     
-    # Attempt to connect up to ntries
+    # Attempt to execute up to ntries, drawing connections from the pool
     for itry in range(0,ntries):
+        curs = None
         try:
-            conn = pyodbc.connect( cnxn_string )
-
-            if itry>0: printDbInfo( conn, f"Connected {cnxn_string} attempt {itry}" )
-            curs = conn.cursor()
+            start = time.monotonic()
+            curs = dbpool.cursor( cnxn_string )
+            probe.attempt( itry, time.monotonic() - start )
+            curs.instrument( probe )
+
+            if itry>0: printDbInfo( curs.connection, f"Connected {cnxn_string} attempt {itry}" )
+            if stream:
+                return curs.stream( query, batchsize )
             curs.execute( query )
             return curs
                 
         except Exception as E:
             lastException = E
+            if curs: curs.discard() # connection may be broken, do not return it to the pool
             delay = (itry + 1 ) * random.random()
             time.sleep(delay)
 
@@ -134,6 +178,84 @@ def dbQuery( cnxn_string, query, ntries=10 ):
     print(query)
     print(lastException)
     exit(0)
+
+def dbStatement( cnxn_string, name, params=(), many=False, ntries=10, pinned=False, **identifiers ):
+    """
+    Executes the named statement (see dbstatements) binding the given parameters.  If
+    many is set, params is a list of parameter tuples executed against the same prepared
+    statement.  Identifiers (e.g. table names) are formatted into the statement text.
+    The statement is accounted in dbstats under its name.
+
+    Selects addressed to a primary are routed to its read replica (see dbroute) unless
+    pinned is set.
+    """
+    sql = statements[name]
+    if identifiers:
+        sql = sql.format( **identifiers )
+
+    read = sql.lstrip()[:6].lower() == 'select'
+    cnxn_string = dbrouter.route( cnxn_string, read, pinned )
+
+    lastException = None
+    probe = dbstats.probe( name )   # one call, however many attempts it takes
+
+    for itry in range(0,ntries):
+        curs = None
+        try:
+            start = time.monotonic()
+            curs = dbpool.cursor( cnxn_string ).prepare( sql )
+            probe.attempt( itry, time.monotonic() - start )
+            curs.instrument( probe )
+            if many:
+                curs.executemany( sql, params )
+            else:
+                curs.execute( sql, params )
+            return curs
+
+        except Exception as E:
+            lastException = E
+            if curs: curs.discard()
+            delay = (itry + 1 ) * random.random()
+            time.sleep(delay)
+
+    print(cnxn_string)
+    print(sql)
+    print(lastException)
+    exit(0)
+
+def dbBulkUpdate( cnxn_string, name, rows, ntries=10 ):
+    """
+    Executes the named bulk update (see dbstatements) for the given rows of parameters:
+    a single set-based update, joined against a VALUES list, per block of rows.  All
+    blocks are executed in the same transaction.  Returns the cursor, which the caller
+    commits.  The update is accounted in dbstats under its name.
+    """
+    cnxn_string = dbrouter.route( cnxn_string, False, True )
+
+    lastException = None
+    probe = dbstats.probe( name )   # one call, however many attempts it takes
+
+    for itry in range(0,ntries):
+        curs = None
+        try:
+            start = time.monotonic()
+            curs = dbpool.cursor( cnxn_string )
+            probe.attempt( itry, time.monotonic() - start )
+            curs.instrument( probe )
+            for sql, params in bulk_blocks( name, rows ):
+                curs.prepare( sql ).execute( sql, params )
+            return curs
+
+        except Exception as E:
+            lastException = E
+            if curs: curs.discard()
+            delay = (itry + 1 ) * random.random()
+            time.sleep(delay)
+
+    print(cnxn_string)
+    print(name)
+    print(lastException)
+    exit(0)
             
 
     
@@ -279,12 +401,181 @@ class SPhnxMatch:
         b = self.build
         b = b.replace(".","")
         object.__setattr__(self, 'build', b)                
-        run = int(self.run)
-        object.__setattr__(self, 'rungroup', f'{100*math.floor(run/100):08d}_{100*math.ceil((run+1)/100):08d}')
+        object.__setattr__(self, 'rungroup', rungroup( self.run ) )
 
     def dict(self):
         return { k: str(v) for k, v in asdict(self).items() if v is not None }
 
+def rungroup( run ):
+    """
+    Returns the block of 100 runs holding the run, e.g. 00053800_00053900 for run 53877.
+    """
+    first = int(run) // 100 * 100
+    return f'{first:08d}_{first+100:08d}'
+
+MATCHFIELDS = tuple( f.name for f in fields( SPhnxMatch ) )
+_matchfields = frozenset( MATCHFIELDS )
+
+def _str( v ):
+    return None if v is None else str(v)
+
+class SPhnxMatchRecord( MutableMapping ):
+    """
+    Compact match built by the match pipeline, in place of SPhnxMatch(...).dict().  It
+    reads as that dictionary updated with the kwargs of the rule: values are strings and
+    fields which are None are absent.  The fields are held in slots, the kwargs (shared)
+    are one dictionary for all matches of the rule, and any other key set on the match
+    goes to a small dictionary (extra) of its own.
+
+    The runtype and cupsid of the job are set by submit, and are not part of the mapping.
+    """
+    __slots__ = MATCHFIELDS + ( 'shared', 'extra', 'runtype', 'cupsid' )
+
+    def __init__( self, shared, name, script, lfn, dst, run, seg, build, tag, mem, disk, payload,
+                  inputs=None, ranges=None, firstevent=None, lastevent=None, runs_last_event=None,
+                  neventsper=None, streamname=None, streamfile=None, version=None ):
+        self.shared     = shared
+        self.extra      = None
+        self.runtype    = None
+        self.cupsid     = None
+        self.name       = _str( name )
+        self.script     = _str( script )
+        self.lfn        = _str( lfn )
+        self.dst        = _str( dst )
+        self.run        = _str( run )
+        self.seg        = _str( seg )
+        self.build      = build.replace(".","")
+        self.buildarg   = build
+        self.tag        = _str( tag )
+        self.mem        = _str( mem )
+        self.disk       = _str( disk )
+        self.payload    = _str( payload )
+        self.stdout     = None
+        self.stderr     = None
+        self.condor     = None
+        self.inputs     = _str( inputs )
+        self.ranges     = _str( ranges )
+        self.rungroup   = rungroup( run )
+        self.firstevent = _str( firstevent )
+        self.lastevent  = _str( lastevent )
+        self.runs_last_event = _str( runs_last_event )
+        self.neventsper = _str( neventsper )
+        self.streamname = _str( streamname )
+        self.streamfile = _str( streamfile )
+        self.version    = _str( version )
+
+    def __getitem__( self, key ):
+        if self.extra and key in self.extra:
+            return self.extra[ key ]
+        if key in self.shared:
+            return self.shared[ key ]
+        if key in _matchfields:
+            value = getattr( self, key )
+            if value is not None:
+                return value
+        raise KeyError( key )
+
+    def __setitem__( self, key, value ):
+        if key in _matchfields and key not in self.shared and not ( self.extra and key in self.extra ):
+            setattr( self, key, value )
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[ key ] = value
+
+    def __delitem__( self, key ):
+        if self.extra and key in self.extra:
+            del self.extra[ key ]
+        elif key in _matchfields and key not in self.shared and getattr( self, key ) is not None:
+            setattr( self, key, None )
+        else:
+            raise KeyError( key )
+
+    def __iter__( self ):
+        extra = self.extra or {}
+        for k in MATCHFIELDS:
+            if k not in self.shared and k not in extra and getattr( self, k ) is not None:
+                yield k
+        for k in self.shared:
+            if k not in extra:
+                yield k
+        yield from extra
+
+    def __len__( self ):
+        return sum( 1 for k in self )
+
+    def __repr__( self ):
+        return repr( dict( self ) )
+
+class SPhnxItemData:
+    """
+    View of the matches as the itemdata dictionaries passed to schedd.submit.  Each
+    dictionary holds the classads of the job and the match values named in the submit
+    description, and is built as the schedd consumes the view rather than kept next to
+    the matches.  The runtype and cupsid of each match must be set beforehand.
+    """
+    def __init__( self, matching, rule, submit_job, classads={}, dbinput=False ):
+        self.matching = matching
+        self.rule     = rule
+        self.text     = str( submit_job )
+        self.classads = classads     # fixed classads added to every job
+        self.dbinput  = dbinput
+        self.dataset  = '"'+str(rule.build)+"_"+str(rule.tag)+"_"+str(rule.version)+'"'
+        self._named   = {}           # key -> named in the submit description
+        self._fields  = [ k for k in MATCHFIELDS if self._submitted( k ) ]
+        self._shared  = ( None, {} ) # kwargs of the rule, and those named in the submit description
+
+    def _submitted( self, key ):
+        named = self._named.get( key, None )
+        if named is None:
+            named = self._named[ key ] = key in self.text or key=='streamname'  # b/c it may not be declared in the arglist
+        return named
+
+    def __len__( self ):
+        return len( self.matching )
+
+    def __iter__( self ):
+        for m in self.matching:
+            yield self.item( m )
+
+    def item( self, m ):
+        d = {}
+        d['runtype']=m.runtype
+        d['runname']=self.rule.runname
+        # Add DSTTYPE, RUNNUMBER and SEGMENT to the classad for each job.  The value passed in is a
+        # string.  Condor will then deduce the type from that string.  So... passing in integers as
+        # they are... wrapping the DSTTYPE in '"' so it is interpreted as a string rather than an expression.
+        name = m['name']
+        if '$(streamname)' in name:
+            name = name.replace("$(streamname)",m.get( 'streamname', None ))
+        d['+sPHENIX_DSTTYPE']  ='"'+ name +'"'
+        d['+sPHENIX_DATASET']  =self.dataset
+        d['+sPHENIX_RUNNUMBER']=str(m['run'])
+        d['+sPHENIX_SEGMENT']  =str(m['seg'])
+        d.update( self.classads )
+
+        # The values of the match named in the submit description: fields, overriden by the
+        # kwargs of the rule, overriden by the keys set on the match.
+        for k in self._fields:
+            v = getattr( m, k )
+            if v is not None:
+                d[k] = v
+        if m.shared is not self._shared[0]:
+            self._shared = ( m.shared, { k: v for k, v in m.shared.items() if self._submitted( k ) } )
+        d.update( self._shared[1] )
+        if m.extra:
+            for k,v in m.extra.items():
+                if self._submitted( k ):
+                    d[k] = v
+
+        if self.dbinput:
+            d['inputs']= 'dbinput'
+            d['ranges']= 'dbranges'
+
+        d['cupsid']=str(m.cupsid)
+        d['+sPHENIX_SLURP_CUPSID']=str(m.cupsid)
+        return d
+
 
 #def table_exists( tablename ):
 #    """
@@ -302,15 +593,10 @@ def fetch_production_status( setup, runmn=0, runmx=-1 ):
     """
     result = [] # of SPhnxProductionStatus
 
-    query = f"select id,dstfile,status from production_status where true"
     if ( runmn>runmx ): 
-        query = query + f" and run>={runmn}"
+        dbresult = dbStatement( cnxn_string_map['statusw'], 'status.fetch.from', ( runmn, ) )
     else              : 
-        query = query + f" and run>={runmn} and run<={runmx}"
-
-    query=query+";"
-
-    dbresult = dbQuery( cnxn_string_map['statusw'], query )
+        dbresult = dbStatement( cnxn_string_map['statusw'], 'status.fetch', ( runmn, runmx ) )
 
     # Transform the list of tuples from the db query to a list of prouction status dataclass objects
     result = [ SPhnxProductionStatusMap( *db ) for db in dbresult ]
@@ -340,29 +626,23 @@ def fetch_production_status( setup, runmn=0, runmx=-1 ):
 #               statusdbr.execute( query ).fetchall() 
 #    ]
 
-def getLatestId( tablename, dstname, run, seg ):
+def getLatestId( tablename, dstname, run, seg, pinned=False ):
 
     cache="cups.cache"
     
     # We are limiting to the list of all productions for a given run,segment pair.
 
     result  = 0
-    query=f"""
-    select id,dstname from {tablename} where run={run} and segment={seg} order by id desc limit {MAXDSTNAMES};
-    """
-    # Find the most recent ID with the given dstname
 
-    for r in dbQuery( cnxn_string_map[ 'statusw' ], query ):
+    # Find the most recent ID with the given dstname
+    for r in dbStatement( cnxn_string_map[ 'statusw' ], 'status.latest', ( run, seg, MAXDSTNAMES ), pinned=pinned, table=tablename ):
         if r.dstname == dstname:
             result = r.id
             break
 
     # Widen the search if needed...
     if result==0:
-        query=f"""
-        select id,dstname from {tablename} where run={run} and segment={seg} order by id desc limit {MAXDSTNAMES*10};
-        """
-        for r in dbQuery( cnxn_string_map[ 'statusw' ], query ):
+        for r in dbStatement( cnxn_string_map[ 'statusw' ], 'status.latest', ( run, seg, MAXDSTNAMES*10 ), pinned=pinned, table=tablename ):
             if r.dstname == dstname:
                 result = r.id
                 break
@@ -380,12 +660,7 @@ def set_production_cursor( dsttype, build, tag, version, torun, schedd_query ):
     if isinstance(version,str):
         version=int( version.replace('v','') )
 
-    query=f"""
-    update production_cursor
-    set lastrun={torun}
-    where dsttype='{dsttype}' and build='{build}' and tag='{tag}' and version={version}
-    """
-    result=dbQuery( cnxn_string_map[ 'statusw' ], query )
+    result=dbStatement( cnxn_string_map[ 'statusw' ], 'cursor.set', ( torun, dsttype, build, tag, version ) )
     result.commit()
     return
 
@@ -394,15 +669,7 @@ def get_production_cursor( name_, build, tag, version=None ):
     if '$(streamname)' in name:
         name = name.replace('$(streamname)','_X_')
 
-    query=f"""
-    select lastrun from production_cursor where
-    dsttype   = '{name}' and
-    build  like '{build}'  and
-    tag    like '{tag}'      and
-    version={version} 
-    order by id desc;
-    """
-    array = [ int(r.lastrun) for r in dbQuery( cnxn_string_map[ 'status' ], query ) ]
+    array = [ int(r.lastrun) for r in dbStatement( cnxn_string_map[ 'status' ], 'cursor.get', ( name, build, tag, version ) ) ]
 
     result = 0
     
@@ -416,14 +683,7 @@ def get_production_cursor( name_, build, tag, version=None ):
         result= array[0]
 
     if result==-1: # get the list of run curosrs and accept the most recent
-        query=f"""
-        select lastrun,tag from production_cursor where
-        dsttype   = '{name}' and
-        build  like '{build}'  and
-        version={version} 
-        order by id desc;
-        """
-        array = [ (int(r.lastrun),r.tag) for r in dbQuery( cnxn_string_map[ 'status' ], query ) ]
+        array = [ (int(r.lastrun),r.tag) for r in dbStatement( cnxn_string_map[ 'status' ], 'cursor.get.anytag', ( name, build, version ) ) ]
 
         if len(array)>0:
             INFO(f"Using lastrun={array[0][0]} from tag={array[0][1]}")
@@ -491,31 +751,83 @@ def update_production_status( matching, setup, condor, state ):
             ERROR("Assuming this is an issue with condor, setting cluster=0, process=0 and trying to continue...")
             cluster=0
             process=0
-            id_=getLatestId( 'production_status', dstname, run, segment ) # revert to slow method
+            id_=getLatestId( 'production_status', dstname, run, segment, pinned=True ) # revert to slow method
         
 
         # 1s time resolution
         timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
         #id_ = getLatestId( 'production_status', dstname, run, segment )
 
-        update=f"""
-        update  production_status
-        set     status='{state}',{state}='{timestamp}',cluster={cluster},process={process}
-        where id={id_} and status<'started';
-        """
-        updates.append( update )
+        updates.append( ( timestamp, cluster, process, id_ ) )
 
     INFO("... executing the DB update ..." )
-    curs = dbQuery( cnxn_string_map[ 'statusw' ], ';'.join(updates)  )
+    curs = dbBulkUpdate( cnxn_string_map[ 'statusw' ], f'status.{state}', updates )
     curs.commit()
     INFO("... done with update ... ")
 
-def insert_production_status( matching, setup, cursor ):
+def update_submitted_status( matching, submit_result, state ):
+    """
+    Records the cluster and process IDs assigned by condor to the jobs of a submission,
+    the i-th match being process first_proc()+i of the cluster.
+    """
+    cluster = submit_result.cluster()
+    first   = submit_result.first_proc()
+
+    # 1s time resolution
+    timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+    updates = [ ( timestamp, cluster, first + i, int(m.cupsid) ) for i, m in enumerate(matching) ]
+
+    INFO("... executing the DB update ..." )
+    dbBulkUpdate( cnxn_string_map[ 'statusw' ], f'status.{state}', updates ).commit()
+    INFO("... done with update ... ")
+
+def load_production_status( rows, cursor ):
+    """
+    Bulk loads the production status rows on the connection of cursor.  The rows are
+    array bound into a temporary staging table in a single executemany, and moved into
+    the production status table with one insert ... select.  (COPY is not available
+    through ODBC.)  Returns the ids in the order of the rows.
+    """
+    for name in [ 'status.stage.create', 'status.stage.clear' ]:
+        cursor.prepare( statements[name] ).execute( statements[name] )
+
+    load = statements['status.stage.load']
+    cursor.prepare( load ).executemany( load, [ ( seq, *row ) for seq, row in enumerate(rows) ], fast=True )
+
+    # The order of the returned rows is not defined.  Ids are assigned in the order of the select, so the
+    # ids returned for a dstfile are handed out in ascending order to its rows.
+    insert = statements['status.stage.insert']
+    ids = defaultdict( list )
+    for r in cursor.prepare( insert ).execute( insert ):
+        ids[ r.dstfile ].append( int(r.id) )
+    for v in ids.values():
+        v.sort( reverse=True )
+
+    clear = statements['status.stage.clear']
+    cursor.prepare( clear ).execute( clear )
+
+    return [ ids[ row[2] ].pop() for row in rows ]
+
+def production_status_rows( matching, setup ):
+    """
+    Returns the parameters of the production status row of each match.
+    """
 
     state='submitting'
 
+    # The same for every row: the dstname suffix, the production id, the submission time (1s
+    # resolution) and host.  Cluster and process are unset at this point.
+    suffix    = '_'+setup.build.replace(".","")+'_'+setup.dbtag
+    prod_id   = setup.id
+    cluster   = 0
+    process   = 0
+    timestamp = str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+
+    # TODO: Handle conflict
+    node=platform.node().split('.')[0]
+
     # Prepare the insert for all matches that we are submitting to condor
-    values = []
+    rows = []
     for m in matching:
         run     = int(m['run'])
         segment = int(m['seg'])
@@ -532,64 +844,160 @@ def insert_production_status( matching, setup, cursor ):
 
         dstranges = m.get('ranges','unset')
 
+        # The dst names are built from the name with the stream substituted, only the inputs may still refer to it
+        if streamname:
+            if '$(streamname)' in dstfileinput:
+                dstfileinput = dstfileinput.replace( '$(streamname)', streamname )
+            if isinstance( dstranges, str ) and '$(streamname)' in dstranges:
+                dstranges = dstranges.replace( '$(streamname)', streamname )
+
         # TODO: version ???
-        # TODO: is dstfile and key redundant ???
         version = m.get('version',None)
         dsttype = name_
-        dstname = dsttype +'_'+setup.build.replace(".","")+'_'+setup.dbtag
+        dstname = dsttype + suffix
         if version:
             dstname = dstname + "_" + version  
         dstfile = ( dstname + '-' + RUNFMT + '-' + SEGFMT ) % (run,segment)        
 
-        # TODO: version???
-        key = sphenix_base_filename( setup.name, setup.build, setup.dbtag, run, segment, version )
-        
-        prod_id = setup.id
+        # n.b. status is fixed to 'submitting' in the statement text
+        rows.append( [ dsttype, dstname, dstfile, run, segment, dstfileinput, dstranges, prod_id, cluster, process, timestamp, node ] )
 
-        # Cluster and process are unset during at this pint
-        cluster = 0
-        process = 0
+    return rows
 
-        status  = state        
+def insert_production_status( matching, setup, cursor, stagerows=None ):
 
-        timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+    rows = production_status_rows( matching, setup )
 
-        # TODO: Handle conflict
-        node=platform.node().split('.')[0]
+    # Submissions of at least stagerows jobs are bulk loaded through the staging table (--bulkload)
+    if stagerows is not None and len(rows) >= stagerows:
+        return load_production_status( rows, cursor )
 
-        value = f"('{dsttype}','{dstname}','{dstfile}',{run},{segment},0,'{dstfileinput}','{dstranges}',{prod_id},{cluster},{process},'{status}', '{timestamp}', 0, '{node}' )" 
+    # Inserts the production status lines for each match, returning the list of IDs associated with each match.
+    # Rows are sent in fixed size blocks so that the insert statements can be prepared once per connection.
+    result = []
+    first  = 0
+    for nrows in insert_blocks( len(rows) ):
+        insert = insert_production_status_sql( nrows )
+        params = [ x for row in rows[first:first+nrows] for x in row ]
+        try:
+            cursor.prepare( insert ).execute( insert, params )    # commit is deferred until the update succeeds
+        except Exception as E:
+            print(insert)
+            raise(E)
+        result.extend( [ int(x.id) for x in cursor ] )
+        first = first + nrows
 
-        if streamname:
-            value = value.replace( '$(streamname)', streamname )
+    return result
+    
 
-        values.append( value )
-       
-    insvals = ','.join(values)    
+        
 
-    # Inserts the production status lines for each match, returning the list of IDs associated with each match.
-    insert = f"""
-    insert into production_status
-           (dsttype, dstname, dstfile, run, segment, nsegments, inputs, ranges, prod_id, cluster, process, status, submitting, nevents, submission_host )
-    values 
-           {insvals}
 
-    returning id
+# The rule macros expanded in the output directory templates
+DIRMACROS = ( 'build', 'tag', 'name', 'version', 'runname' )
+
+def output_directories( templates, rule, matching ):
+    """
+    Returns the set of directories the jobs in matching write to, i.e. the directory
+    templates (outdir, logdir, ...) expanded for each distinct rungroup, runtype and
+    streamname of the matches.  The runtype of each match must be set beforehand.
     """
+    leafdir = rule.name.replace( f'_{rule.runname}', "" )
+    fixed   = []
+    for template in templates:
+        if template is None: continue
+        template = template.replace('file:/','').replace('//','/')
+        template = template.replace( '{leafdir}', leafdir )
+        for macro in DIRMACROS:
+            template = template.replace( f'$({macro})', str( getattr( rule, macro ) ) )
+        fixed.append( template )
+
+    result = set()
+    for group, runtype, streamname in { ( rungroup( m['run'] ), m.runtype, m.get( 'streamname', None ) ) for m in matching }:
+        for template in fixed:
+            targetdir = template.replace( '$(rungroup)', group ).replace( '$(runtype)', str(runtype) )
+            if streamname is not None:
+                targetdir = targetdir.replace( '$(streamname)', streamname )
+            if '$(streamname)' in targetdir:
+                continue    # not a directory of these jobs
+            result.add( targetdir )
+    return result
 
-    # TODO: standardized query
+def submit_chunk( schedd, submit_job, itemdata, matching, setup, cursorips ):
+    """
+    Submits one chunk of jobs (a cluster) to condor and commits the production status rows
+    inserted for it on cursorips, then records the cluster and process IDs of the jobs.  If
+    condor does not accept the jobs, the insert of the chunk is rolled back.  Returns the
+    cluster ID (None if the jobs could not be queried back).
+    """
+    laps = stages.laps( 'submit' )
     try:
-        cursor.execute(insert)    # commit is deferred until the update succeeds
-    except Exception as E:
-        print(insert)
-        raise(E)
-
-    result=[ int(x.id) for x in cursor ]
-
+        # submits the job to condor
+        INFO("... submitting to condor")
+
+        submit_result = schedd.submit(submit_job, itemdata=iter(itemdata))  # submit one job for each item in the itemdata
+        if submit_result.cluster()==0:
+            WARN("Submit result returned with cluster=0")
+        #pprint.pprint(submit_result)
+
+        # commits the insert done above
+        cursorips.commit()
+        laps.lap( 'condor' )
+
+    except:
+        # if condor did not accept the jobs, rollback to the previous state and
+        cursorips.rollback()
+        raise
+
+    finally:
+        cursorips.close()
+
+    # Condor assigns the processes of the cluster in the order of the itemdata, so the
+    # i-th match is process first_proc()+i.  The schedd is only queried back to verify
+    # this (--verify-submit), or if the submission does not account for every match.
+    cluster  = submit_result.cluster()
+    assigned = cluster > 0 and submit_result.num_procs() == len(matching)
+    if not assigned:
+        WARN(f"Submit result {submit_result} does not match the {len(matching)} jobs submitted, querying the schedd")
+
+    schedd_query = None
+    if not assigned or getattr( args, 'verify_submit', False ):
+        INFO("Getting back the cluster and process IDs")
+        schedd_query = schedd.query(
+            constraint=f"ClusterId == {cluster}",
+            projection=["ClusterId", "ProcId", "Out", "UserLog", "Args", "sPHENIX_PRODUCTION", "sPHENIX_RUNNUMBER", "sPHENIX_SEGMENT", "sPHENIX_SLURP_CUPSID" ]
+            #projection=["ClusterId", "ProcId", "Out", "UserLog", "Args"]
+        )
+        laps.lap( 'requery' )
+
+    if assigned and schedd_query is not None:
+        first    = submit_result.first_proc()
+        expected = { int(m.cupsid) : first + i for i, m in enumerate(matching) }
+        queried  = { int(ad['sPHENIX_SLURP_CUPSID']) : int(ad['ProcId']) for ad in schedd_query }
+        if queried != expected:
+            WARN(f"The processes of cluster {cluster} are not in the itemdata order, using the schedd query")
+            assigned = False
+
+    # Update DB IFF we have a valid submission
+    result = None
+    INFO("Insert and update the production_status")
+    if assigned:
+        INFO("... update")
+        update_submitted_status( matching, submit_result, state="submitted" )
+        result = cluster
+
+    elif ( schedd_query ):
+
+        # Get the result from submitting the jobs
+        INFO("... result")
+        result = cluster
+
+        # Update the production status table
+        INFO("... update")
+        update_production_status( matching, setup, schedd_query, state="submitted" )
+
+    laps.lap( 'update' )
     return result
-    
-
-        
-
 
 def submit( rule, maxjobs, **kwargs ):
 
@@ -605,8 +1013,21 @@ def submit( rule, maxjobs, **kwargs ):
     if args:
         kwargs['resubmit'] = args.resubmit
 
+    #
+    # Matches are streamed from the matching pipeline and submitted in chunks of --chunk jobs, so that
+    # the first jobs reach condor while later candidates are still being evaluated.  By default all
+    # matches are built before anything is submitted (a single chunk).
+    #
+    chunksize = getattr( args, 'chunk', None ) if args else None
+    pipeline  = MatchPipeline( rule, kwargs, chunk=chunksize )
+    chunks    = pipeline.chunks( chunksize, maxjobs and int(maxjobs) )
+
     # Build list of LFNs which match the input
-    matching, setup, runlist, unblocked = matches( rule, kwargs )
+    matching = next( chunks, [] )
+    setup    = pipeline.setup
+
+    # Time spent in each phase of the submission is accounted in stagetimer as submit.<phase>
+    laps = stages.laps( 'submit' )
 
     nmatches = len(matching)
     if len(matching)==0:
@@ -623,7 +1044,7 @@ def submit( rule, maxjobs, **kwargs ):
             reply = input("Warning: resubmit option may overwrite previous production.  Continue (y/N)?")
         if reply in ['n','N','No','no','NO']:
             return result
- 
+
     #
     # An unclean setup is also cause for manual intervention.  It will hold up any data production.
     #    (but we will allow override with the batch flag)
@@ -637,7 +1058,7 @@ def submit( rule, maxjobs, **kwargs ):
             reply = "N"
             reply = input("Continue (y/N)?")
         if reply in ['n','N','No','no','NO']:
-            return result        
+            return result
 
 
     INFO("Get the job dictionary")
@@ -663,31 +1084,29 @@ def submit( rule, maxjobs, **kwargs ):
     submit_job = htcondor.Submit( jobd )
     if verbose>0:
         INFO(submit_job)
-        if verbose>10:
-            for m in matching:
-                pprint.pprint(m)
 
     submit_job[ "+sPHENIX_PRODUCTION" ] = f"{rule.name}_{rule.build}_{rule.tag}_{rule.version}"
-    
+
     dispatched_runs = []
     last_run = -1
     db_hold_query = None
 
+    # Failed jobs which were unblocked have their production status entries removed after the submission
+    unblock = True
 
     #
-    # At this point in the code, matching jobs are storred in the array 'matching'.
-    # All jobs in this array are ripe for submission.  If maxjobs is defined, this
-    # is the point where we can truncate the matches...
+    # At this point in the code, matching jobs are streamed from the pipeline.
+    # All jobs are ripe for submission.  If maxjobs is defined, the pipeline
+    # has truncated the matches...
     #
     if maxjobs:
-        INFO(f"Truncating the number of jobs to maxjobs={maxjobs}")        
-        matching  = matching[:int(maxjobs)]
-        if len(unblocked)>0:
+        INFO(f"Truncating the number of jobs to maxjobs={maxjobs}")
+        if len(pipeline.unblocked_ids)>0 or ( chunksize and args.unblock ):
             ERROR("Unblocking failed jobs and truncating the maximum number of submitted jobs can lead.")
             ERROR("to inconsistent production status.  So this is disallowed.  You should cleanup the")
             ERROR("production DB by hand, and probably the filecatalog and DSTs as well before resubmitting.")
             exit(0)
-        unblocked = []
+        unblock = False
 
 
     __earliest_matching_run=9E9
@@ -695,157 +1114,147 @@ def submit( rule, maxjobs, **kwargs ):
     if dump==False:
         if verbose==-10:
             INFO(submit_job)
-        
-        schedd = htcondor.Schedd()    
-
-        runtypes = {}
-        streams  = {}
-        # Strip out unused $(...) condor macros
-        INFO("Converting matches to list of dictionaries for schedd...")
-        mymatching = []
-        for m in iter(matching):
-            d = {}
-
-            # TODO:  This should be accessed from the run table / daqdb
-            runtype='none'
-            d['runtype']='unset'
-            d['runname']=rule.runname
-            # Add DSTTYPE, RUNNUMBER and SEGMENT to the classad for each job.  The value passed in is a
-            # string.  Condor will then deduce the type from that string.  So... passing in integers as
-            # they are... wrapping the DSTTYPE in '"' so it is interpreted as a string rather than an expression.
-            streamname = m.get( 'streamname', None )
-            name = m['name']
-            if '$(streamname)' in name:
-                name = name.replace("$(streamname)",streamname)
-            d['+sPHENIX_DSTTYPE']  ='"'+ name +'"'
-            d['+sPHENIX_DATASET']  ='"'+str(rule.build)+"_"+str(rule.tag)+"_"+str(rule.version)+'"'
-            d['+sPHENIX_RUNNUMBER']=str(m['run'])
-            d['+sPHENIX_SEGMENT']  =str(m['seg'])
-            if args.resubmit:
-                timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )                
-                d['+sPHENIX_SLURP_RESUBMIT']=f'"True"'
-                d['+sPHENIX_SLURP_RESUBMIT_TIMESTAMP']=f'"{timestamp}"'                
-            if args.unblock:
-                timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )                                
-                ublocks=','.join(args.unblock)
-                d['+sPHENIX_SLURP_UNBLOCK']=f'"{ublocks}"'
-                d['+sPHENIX_SLURP_UNBLOCK_TIMESTAMP']=f'"{timestamp}"'                
-
-            if int(m['run'])<__earliest_matching_run:
-                __earliest_matching_run=int(m['run'])
-
-            if int(m['run'])>=__last_submitted_run:
-                __last_submitted_run=int(m['run'])
-
-            leafdir=m["name"].replace(f"_{rule.runname}","")
-
-            # massage the inputs from space to comma separated
-            if m.get('inputs',None): 
-                m['inputs']= ','.join( m['inputs'].split() )
-                if '/physics/' in m['inputs']: # physics can appear twice by mistake...
-                    runtype = 'physics'
-                    d['runtype']=runtype
-                if '/beam/' in m['inputs']: # beam supercedes...
-                    runtype = 'beam'
-                    d['runtype']=runtype
-                if '/cosmics/' in m['inputs']: # beam supercedes...
-                    runtype = 'cosmics'
-                    d['runtype']=runtype
-                if '/calib/' in m['inputs']: # beam supercedes...
-                    runtype = 'calib'
-                    d['runtype']=runtype
-
-                
-            runtypes[runtype]=1 # register the runtype for directory creation below
-
-            if m.get('ranges',None):
-                m['ranges']= ','.join( m['ranges'].split() )
-
-            for k,v in m.items():
 
-                if k in ['outdir','logdir','histdir','condor']:
-                    m[k] = v.format( **locals() )
+        schedd = Schedd()
 
-                if k in str(submit_job) or k=='streamname': # b/c it may not be declared in the arglist
-                    d[k] = m[k]
-                    if k=='streamname': streams[ m[k] ] = 1
-               
-                if args.dbinput: 
-                    d['inputs']= 'dbinput'            
-                    d['ranges']= 'dbranges'
+        # Output directories created by the previous chunks (and previous passes with --knowndirs) are skipped
+        dirs = KnownDirs( knowndirs.CACHEFILE if args.knowndirs else None )
 
+        # Each chunk is submitted to condor (and committed) by the submitter thread while the main
+        # thread inserts the next one.  At most one chunk is in condor's hands at a time.
+        submitter = concurrent.futures.ThreadPoolExecutor( max_workers=1, thread_name_prefix='submit' )
+        pending   = None
+        overlap   = dbbackend.concurrent_writes()
 
-            mymatching.append(d)
-
-            run_ = d['run']
-            dispatched_runs.append( (run_,d['seg']) )
-
-            if int(run_) > last_run:
-                last_run = int(run_)
-                
-        run_submit_loop=30
-        schedd_query = None
-
-        # Insert jobs into the production status table and add the ID to the dictionary
-        INFO("... insert")
-
-        # Grab a cursor
-        cursorips = dbQuery( cnxn_string_map['statusw'], 'select id from production_status where false;' )
-
-        # Perform the insert
-        cupsids = insert_production_status( matching, setup, cursor=cursorips ) 
-        for i,m in zip(cupsids,mymatching):
-            m['cupsid']=str(i)
-            m['+sPHENIX_SLURP_CUPSID']=str(i)
-
-        
-        INFO("Preparing to submit the jobs to condor")
         try:
+            with submitter:
+                for matching in itertools.chain( [ matching ], chunks ):
+
+                    # The time spent waiting on the pipeline is accounted under matches.<phase>
+                    laps.skip()
+
+                    if verbose>10:
+                        for m in matching:
+                            pprint.pprint(m)
+
+                    # Strip out unused $(...) condor macros
+                    INFO(f"Preparing {len(matching)} matches for the schedd...")
+                    classads = {}
+                    if args.resubmit:
+                        timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+                        classads['+sPHENIX_SLURP_RESUBMIT']=f'"True"'
+                        classads['+sPHENIX_SLURP_RESUBMIT_TIMESTAMP']=f'"{timestamp}"'
+                    if args.unblock:
+                        timestamp=str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)  )
+                        ublocks=','.join(args.unblock)
+                        classads['+sPHENIX_SLURP_UNBLOCK']=f'"{ublocks}"'
+                        classads['+sPHENIX_SLURP_UNBLOCK_TIMESTAMP']=f'"{timestamp}"'
+
+                    # The itemdata dictionaries are built from the matches as the schedd reads them
+                    itemdata = SPhnxItemData( matching, rule, submit_job, classads, args.dbinput )
+
+                    for m in iter(matching):
+
+                        # TODO:  This should be accessed from the run table / daqdb
+                        runtype='none'
+                        m.runtype='unset'
+                        streamname = m.get( 'streamname', None )
+                        name = m['name']
+                        if '$(streamname)' in name:
+                            name = name.replace("$(streamname)",streamname)
+
+                        if int(m['run'])<__earliest_matching_run:
+                            __earliest_matching_run=int(m['run'])
+
+                        if int(m['run'])>=__last_submitted_run:
+                            __last_submitted_run=int(m['run'])
+
+                        leafdir=m["name"].replace(f"_{rule.runname}","")
+
+                        # massage the inputs from space to comma separated
+                        if m.get('inputs',None):
+                            m['inputs']= ','.join( m['inputs'].split() )
+                            if '/physics/' in m['inputs']: # physics can appear twice by mistake...
+                                runtype = 'physics'
+                                m.runtype=runtype
+                            if '/beam/' in m['inputs']: # beam supercedes...
+                                runtype = 'beam'
+                                m.runtype=runtype
+                            if '/cosmics/' in m['inputs']: # beam supercedes...
+                                runtype = 'cosmics'
+                                m.runtype=runtype
+                            if '/calib/' in m['inputs']: # beam supercedes...
+                                runtype = 'calib'
+                                m.runtype=runtype
+
+
+                        if m.get('ranges',None):
+                            m['ranges']= ','.join( m['ranges'].split() )
+
+                        for k in [ 'outdir','logdir','histdir','condor' ]:
+                            v = m.get( k, None )
+                            if v is not None:
+                                m[k] = v.format( **locals() )
+
+                        run_ = m['run']
+                        dispatched_runs.append( (run_,m['seg']) )
+
+                        if int(run_) > last_run:
+                            last_run = int(run_)
+
+                    laps.lap( 'itemdata' )
+
+                    # Without concurrent writers (sqlite) the previous chunk completes before this one is inserted
+                    if pending is not None and not overlap:
+                        result = pending.result() or result
+                        pending = None
+                        laps.lap( 'wait' )
+
+                    # Insert jobs into the production status table and add the ID to the dictionary
+                    INFO("... insert")
+
+                    # Grab a cursor.  n.b. each chunk holds a connection (and its transaction) of its own.
+                    cursorips = dbQuery( cnxn_string_map['statusw'], 'select id from production_status where false;', name='status.insert' )
+
+                    # Perform the insert
+                    cupsids = insert_production_status( matching, setup, cursor=cursorips, stagerows=STAGEROWS if args.bulkload else None )
+                    for i,m in zip(cupsids,matching):
+                        m.cupsid=i
+
+                    laps.lap( 'insert' )
+
+                    INFO("Preparing to submit the jobs to condor")
+                    try:
+
+                        INFO("... creating directories if they do not exist")
+                        made = dirs.materialize( output_directories( [ kwargs.get( k, None ) for k in [ 'outdir', 'logdir', 'condor', 'histdir', 'calibdir' ] ], rule, matching ) )
+                        INFO(f"... {made.targets} directories, {made.known} known, {made.created} created in {made.wall:.3f}s")
+
+                        laps.lap( 'mkdir' )
+
+                        # The previous chunk must be in condor before this one is handed over
+                        if pending is not None:
+                            result = pending.result() or result
+                            pending = None
+                            laps.lap( 'wait' )
+
+                    except:
+                        # nothing of this chunk was submitted, rollback its insert
+                        cursorips.rollback()
+                        raise
+
+                    # submits the job to condor while the next chunk is prepared
+                    pending = submitter.submit( submit_chunk, schedd, submit_job, itemdata, matching, setup, cursorips )
+
+                if pending is not None:
+                    result = pending.result() or result
+                    laps.lap( 'wait' )
 
-            INFO("... creating directories if they do not exist")
-            for outname in [ 'outdir', 'logdir', 'condor', 'histdir', 'calibdir' ]:
-
-                outdir=kwargs.get(outname,None)
-                if outdir==None: continue
-
-                outdir = outdir.replace('file:/','')
-                outdir = outdir.replace('//','/')
-
-                outdir = outdir.replace( '$(rungroup)', '{rungroup}')
-                outdir = outdir.replace( '$(build)',    '{rule.build}' )
-                outdir = outdir.replace( '$(tag)',      '{rule.tag}' )
-                outdir = outdir.replace( '$(name)',     '{rule.name}' )
-                outdir = outdir.replace( '$(version)',  '{rule.version}' )
-                outdir = outdir.replace( '$(runname)',  '{rule.runname}' )
-                outdir = outdir.replace( '$(runtype)',  '{runtype}' )
-
-                outdir = f'f"{outdir}"'
-
-                rungroups = {}
-                madedir = {}
-                for run in runlist:
-                    mnrun = 100 * ( math.floor(run/100) )
-                    mxrun = mnrun+100
-                    rungroup=f'{mnrun:08d}_{mxrun:08d}'                
-
-                    for runtype in runtypes.keys():  # runtype is a possible KW in the yaml file that can be substituted
-                        targetdir = eval(outdir)
-
-                        if '$(streamname)' in targetdir: # ... 
-                            
-                            for mystreamname in streams.keys():
-                                
-                                if madedir.get( targetdir, False )==False:
-                                    td =  targetdir.replace('$(streamname)',mystreamname )
-                                    pathlib.Path( td ).mkdir( parents=True, exist_ok=True )
-                                    madedir[ td ]=True                                
-                                
-                        else:
-
-                            if madedir.get( targetdir, False )==False:
-                                pathlib.Path( eval(outdir) ).mkdir( parents=True, exist_ok=True )            
-                                madedir[targetdir]=True
+            dirs.report()
 
+        finally:
+            # The held jobs are marked and the run cursor advanced (as they were before the
+            # submission) even when a chunk fails to be submitted.
             __constraints = []
             for dsttype,dataset in input_datasets.keys():
                 __constraints.append( f'(sPHENIX_DSTTYPE=="{dsttype}" && sPHENIX_DATASET=="{dataset}")' )
@@ -858,17 +1267,17 @@ def submit( rule, maxjobs, **kwargs ):
             __earliest_run_in_parent = 9E9;
             for ad in production_status_query:
                 #print(ad['clusterid'])
-                try:                
+                try:
                     run=int(ad['sPHENIX_RUNNUMBER'])
                     if run<__earliest_run_in_parent and 2==int(ad['JobStatus']):
-                        __earliest_run_in_parent=run                    
+                        __earliest_run_in_parent=run
                 except KeyError:
                     # If there's a job in there w/out the run number... don't try to adjust
                     pass
 
             INFO(f"Earliest run in the feeding jobs: {__earliest_run_in_parent}")
             INFO(f"Earliest run that matched: {__earliest_matching_run}")
-                
+
             earliest_run_number = min( __earliest_run_in_parent, __earliest_matching_run )
 
             #
@@ -876,14 +1285,16 @@ def submit( rule, maxjobs, **kwargs ):
             #   Mark held jobs as held in the production status table.
             #   Advance the run cursor in the production cursor table.
             #
+            # (The jobs submitted above are idle, so they are not picked up by this query.)
+            #
             # $$$ earliest_run_number = 9E9 #  signals no update b/c nothing is running
             __subsys="[A-Z0-9_]+"
             __replname = rule.name.replace('$(streamname)',__subsys)
-            INFO(f"... querying condor for production {rule.name} --> {__replname}")            
+            INFO(f"... querying condor for production {rule.name} --> {__replname}")
             __constraint = f'regexp("{__replname}",sphenix_dsttype,"i") && (JobStatus==2 || JobStatus==5)'
             INFO(__constraint)
             production_status_query = schedd.query(
-                constraint=__constraint,                
+                constraint=__constraint,
                 projection=["ClusterId", "ProcId", "JobStatus", "HoldReason", "EnteredCurrentStatus", "sPHENIX_DSTTYPE", "sPHENIX_RUNNUMBER", "sPHENIX_SEGMENT", "sPHENIX_SLURP_CUPSID" ]
             )
             hold_query = []
@@ -891,22 +1302,21 @@ def submit( rule, maxjobs, **kwargs ):
                 ad_run  = int(ad['sPHENIX_RUNNUMBER'])
                 ad_cups = int(ad['sPHENIX_SLURP_CUPSID'])
                 ad_stat = int(ad['JobStatus'])
-                                
+
                 # $$$ if ad_run < earliest_run_number and ad_stat==2:
                     # $$$ earliest_run_number = ad_run
 
                 if args.mark_held_jobs and ad_stat==5:
-                    __reason = str(ad['HoldReason']).replace("'",'"')
+                    __reason = str(ad['HoldReason'])
                     __when = int(ad['EnteredCurrentStatus'])
-                    hold_query.append(f"update production_status set status='held', message='{__reason}', ended=to_timestamp( {__when} ) where id={ad_cups};")
+                    hold_query.append( ( __reason, __when, ad_cups ) )
 
                 if args.clear_held_jobs and ad_stat==5:
                     __reason = f"[cleared] {__reason}"
 
             if len(hold_query) > 0:
                 INFO(f"Marking {len(hold_query)} jobs as held.")
-                db_hold_query = ' '.join(hold_query)
-                dbQuery( cnxn_string_map['statusw'], db_hold_query ).commit();
+                dbBulkUpdate( cnxn_string_map['statusw'], 'status.held', hold_query ).commit();
 
             if earliest_run_number < 9E9 and args.advance_cursor==True:
                 INFO(f"Advancing the run cursor to {earliest_run_number}")
@@ -914,60 +1324,26 @@ def submit( rule, maxjobs, **kwargs ):
 
             if __last_submitted_run > 0 and args.ratchet_cursor==True:
                 INFO(f"Advancing the run cursor to {__last_submitted_run}")
-                set_production_cursor( setup.name, setup.build, setup.dbtag, rule.version, __last_submitted_run, production_status_query )                
+                set_production_cursor( setup.name, setup.build, setup.dbtag, rule.version, __last_submitted_run, production_status_query )
 
             if args.clear_held_jobs:
                 __constraint = f'regexp("{__replname}",sphenix_dsttype,"i") && (JobStatus==5)'
                 schedd.act( htcondor.JobAction.Remove, __constraint, 'Removed by kaedama' )
 
-
-            # submits the job to condor
-            INFO("... submitting to condor")
-
-            submit_result = schedd.submit(submit_job, itemdata=iter(mymatching))  # submit one job for each item in the itemdata
-            if submit_result.cluster()==0:
-                WARN("Submit result returned with cluster=0")
-            #pprint.pprint(submit_result)
-            
-            # commits the insert done above
-            cursorips.commit()
-
-        except:
-            # if condor did not accept the jobs, rollback to the previous state and 
-            cursorips.rollback()
-            raise
-            
-        INFO("Getting back the cluster and process IDs")
-        schedd_query = schedd.query(
-            constraint=f"ClusterId == {submit_result.cluster()}",
-            projection=["ClusterId", "ProcId", "Out", "UserLog", "Args", "sPHENIX_PRODUCTION", "sPHENIX_RUNNUMBER", "sPHENIX_SEGMENT", "sPHENIX_SLURP_CUPSID" ]
-            #projection=["ClusterId", "ProcId", "Out", "UserLog", "Args"]            
-        )
-
-        # Update DB IFF we have a valid submission
-        INFO("Insert and update the production_status")
-        if ( schedd_query ):
-            
-            # Get the result from submitting the jobs
-            INFO("... result")
-            result = submit_result.cluster()            
-
-            # Update the production status table
-            INFO("... update")
-            update_production_status( matching, setup, schedd_query, state="submitted" )
-
+            laps.lap( 'query' )
 
         # Finally, if we have a list of unblocked IDs we will remove them from the DB
+        unblocked = pipeline.unblocked_ids if unblock else []
         if len(unblocked)>0:
-            unblockedids = [ str(i) for i in unblocked ]
+            unblockedids = [ ( int(i), ) for i in unblocked ]
+            ################################### DANGER ###############################################
+            dbStatement( cnxn_string_map['statusw'], 'status.unblock', unblockedids, many=True ).commit() #
             ################################### DANGER ###############################################
-            unblockquery = f"delete from production_status where id in ({','.join(unblockedids)});"  #
-            dbQuery( cnxn_string_map['statusw'], unblockquery ).commit()                             #
-            ################################### DANGER ###############################################            
 
+        laps.lap( 'update' )
 
     else:
-        order=["script","name","nevents","run","seg","lfn","indir","dst","outdir","buildarg","tag","stdout","stderr","condor","mem"]           
+        order=["script","name","nevents","run","seg","lfn","indir","dst","outdir","buildarg","tag","stdout","stderr","condor","mem"]
         with open( "submit.job", "w" ) as f:
             f.write( str(submit_job) )
             line = "queue ";
@@ -975,14 +1351,15 @@ def submit( rule, maxjobs, **kwargs ):
                 line += str(k) + ", "
             line += "from submit.in\n"
             f.write(line)
-            
+
         with open( "submit.in", "w" ) as f:
-            for m in matching:
-                line = []
-                for k in order:                    
-                    line.append( str(m[k]) )
-                line = ','.join(line)                
-                f.write(line+"\n")
+            for matching in itertools.chain( [ matching ], chunks ):
+                for m in matching:
+                    line = []
+                    for k in order:
+                        line.append( str(m[k]) )
+                    line = ','.join(line)
+                    f.write(line+"\n")
 
     return dispatched_runs
 
@@ -1006,55 +1383,32 @@ def fetch_production_setup( name_, build, dbtag, repo, dir_, hash_, version=None
 
     result = None # SPhnxProductionSetup
 
-    query = ""
     if version is None:
-        query="""
-        select id,hash from production_setup 
-               where name='%s'  and 
-                   build='%s' and 
-                   dbtag='%s' and 
-                   hash='%s'
-                   limit 1;
-        """%( name, build, dbtag, hash_ )
+        array = [ x for x in dbStatement( cnxn_string_map['statusw'], 'setup.fetch', ( name, build, dbtag, hash_ ) ) ]
     else:        
-        query="""
-        select id,hash from production_setup 
-               where name='%s'  and 
-                   build='%s' and 
-                   dbtag='%s' and 
-                   hash='%s'  and
-                   revision=%i        
-                   limit 1;
-        """%( name, build, dbtag, hash_, version_ )        
-    
-    array = [ x for x in dbQuery( cnxn_string_map['statusw'], query ) ]
+        array = [ x for x in dbStatement( cnxn_string_map['statusw'], 'setup.fetch.revision', ( name, build, dbtag, hash_, version_ ) ) ]
     assert( len(array)<2 )
 
     if   len(array)==0:
-        insert=""
         if version is None:
-            insert="""
-            insert into production_setup(name,build,dbtag,repo,dir,hash)
-                   values('%s','%s','%s','%s','%s','%s');
-            """%(name,build,dbtag,repo,dir_,hash_)
+            curs = dbStatement( cnxn_string_map['statusw'], 'setup.insert', ( name, build, dbtag, repo, dir_, hash_ ) )
         else:
-            insert="""
-            insert into production_setup(name,build,dbtag,repo,dir,hash,revision)
-                   values('%s','%s','%s','%s','%s','%s',%i);
-            """%(name,build,dbtag,repo,dir_,hash_,version_)
-
-        curs = dbQuery( cnxn_string_map['statusw'], insert )
+            curs = dbStatement( cnxn_string_map['statusw'], 'setup.insert.revision', ( name, build, dbtag, repo, dir_, hash_, version_ ) )
         curs.commit()
 
+        # n.b. the insert above pins this lookup to the primary (read-your-writes)
         result = fetch_production_setup(name, build, dbtag, repo, dir_, hash_, version)
 
     elif len(array)==1:
 
-        # Check to see if the payload has any local modifications
-        is_clean = len( sh.git("-c","color.status=no","status","-uno","--short",_cwd=dir_).strip().split('\n') ) == 0;
+        # Check to see if the payload has any local modifications.  n.b. the answers are cached
+        # (see gitcache) and edits to the working tree do not invalidate them, so the status is
+        # that of the last commit, checkout or fetch of the payload and may be stale.
+        payload  = payloads.info( dir_ )
+        is_clean = len( payload.status.strip().split('\n') ) == 0;
 
         # git show origin/main --format=%h -s
-        remote_hash = sh.git("show","origin","--format=%h","-s", _cwd=dir_).strip()
+        remote_hash = payload.remote
         is_current = (hash_ == remote_hash)
 
         id_ = int( array[0][0] )
@@ -1093,61 +1447,149 @@ def sphenix_base_filename( dsttype, build, dbtag, run, segment, version=None ):
     return result
     
 
-def matches( rule, kwargs={} ):
+class _MatchBatch:
     """
-    
-    Apply rule... extract files from DB according to the specified query
-    and build the matches.  Return list of matches.  Return the production
-    setup from the DB.
-    
+    A batch of candidates passed between the stages of the MatchPipeline, together
+    with the lookups made for them.
     """
-    global args
-
-    result = []
+    def __init__( self ):
+        self.fc_result = []   # rows of the input query
+        self.outputs   = []   # candidate output for each row (WARNING: len(outputs) and len(fc_result) must be equal)
+        self.lfn_lists = {}   # LFN lists per run requested in the input query
+        self.pfn_lists = {}   # PFN lists per run existing on disk
+        self.rng_lists = {}   # LFN:firstevent:lastevent
+        self.dstnames  = {}
+        self.exists    = {}   # candidate outputs registered in the file catalog
+        self.survivors = []   # ( row, output, exists ) for the candidates which are neither blocked nor produced
+        self.runMin    = 999999
+        self.runMax    = 0
+
+class MatchPipeline:
+    """
+    Matches a rule against its input query as a chain of generator stages
 
-    name      = kwargs.get('name',      rule.name)       # Can we handle multiple names (eg DST_STREAMING_EVENT_TPCnn_run2pp) in a single submission?
-    build     = kwargs.get('build',     rule.build)      # TODO... correct handling from submit.  build=ana.xyz --> build=anaxyz buildarg=ana.xyz
-    buildarg  = kwargs.get('buildarg',  rule.buildarg)
-    tag       = kwargs.get('tag',       rule.tag)
-    script    = kwargs.get('script',    rule.script)
-    resubmit  = kwargs.get('resubmit',  rule.resubmit)
-    payload   = kwargs.get('payload',   rule.payload)
-    update    = kwargs.get('update',    True ) # update the DB
+        candidates -> existing outputs -> production status -> pfn resolution -> matches
 
-    version  = rule.version
+    Each stage passes on batches of at most chunk candidates (the whole input query
+    if chunk is None), and the lookups of each stage are restricted to the runs of the
+    batch.  Iterating over the pipeline yields the match dictionaries, so the matches
+    of the first batch may be submitted while the input query is still being read,
+    and memory is bounded by the chunk size rather than by the backlog.
 
-    outputs = []
+    The production setup is fetched when the first batch reaches the status stage.
+    setup, list_of_runs and unblocked_ids are filled in as the pipeline is consumed.
+    """
+    def __init__( self, rule, kwargs={}, chunk=None ):
+        self.rule      = rule
+        self.kwargs    = kwargs
+        self.shared    = { k: str(v) for k, v in kwargs.items() }   # coerce any ints to string
+        self.chunk     = chunk
+
+        self.name      = kwargs.get('name',      rule.name)       # Can we handle multiple names (eg DST_STREAMING_EVENT_TPCnn_run2pp) in a single submission?
+        self.build     = kwargs.get('build',     rule.build)      # TODO... correct handling from submit.  build=ana.xyz --> build=anaxyz buildarg=ana.xyz
+        self.buildarg  = kwargs.get('buildarg',  rule.buildarg)
+        self.tag       = kwargs.get('tag',       rule.tag)
+        self.script    = kwargs.get('script',    rule.script)
+        self.resubmit  = kwargs.get('resubmit',  rule.resubmit)
+        self.payload   = kwargs.get('payload',   rule.payload)
+        self.version   = rule.version
+
+        self.setup         = None
+        self.list_of_runs  = []
+        self.unblocked_ids = []
+        self.nmatched      = 0
+
+        # With the anti-join strategy the candidate outputs are shipped to the servers, which return
+        # only the candidates that survive (i.e. are not registered in the file catalog, and are not
+        # blocked by the production status).  Otherwise every output in the run range is pulled and
+        # matched on the client.
+        self.antijoin  = args and getattr( args, 'antijoin', False )
+
+        self.direct    = None   # lfn2pfn map of the direct path, built once
+        self.input     = None   # input query rows shared with other rules (see sharedinputs)
+
+        # The input datasets (used by the lfn2pfn map and the condor queries in submit) are those of this rule
+        input_datasets.clear()
+
+        # In incremental mode candidates decided on a previous pass are dropped from the input
+        self.state = None
+        if args and getattr( args, 'incremental', False ):
+            self.state = MatchState( f"{self.name}_{self.build}_{self.tag}_{self.version}", reconcile=args.reconcile )
+            self.state.begin( full = self.resubmit or bool( args.unblock ) )
+            INFO(f"Incremental matching ({'full reconciliation' if self.state.full else 'new candidates only'}) state in {self.state.path}")
+
+    def __iter__( self ):
+        INFO("Building candidate inputs")
+        batches = self._candidates()
+        batches = self._existing( batches )
+        batches = self._unblocked( batches )
+        batches = self._resolved( batches )
+        try:
+            for batch in batches:
+                for match in self._matches( batch ):
+                    yield match
+                    self.nmatched += 1
+                    #
+                    # Terminate the loop if we exceed the maximum number of matches
+                    #
+                    if self.rule.limit and self.nmatched >= self.rule.limit:
+                        return
+        finally:
+            INFO(f"Matched {self.nmatched} jobs to the rule")
+            if self.state:
+                INFO(f"... {self.state.skipped} candidates decided on a previous pass")
+                self.state.save()
+
+    def chunks( self, size=None, limit=None ):
+        """
+        Yields the matches in lists of at most size matches, stopping after limit
+        matches.  If size is None every candidate is evaluated before a single list
+        (truncated to limit) is returned.
+        """
+        if size is None:
+            matches = list( self )[:limit]
+            if matches:
+                yield matches
+            return
+        pipeline = iter( self )
+        matches  = itertools.islice( pipeline, limit )
+        try:
+            while True:
+                chunk = list( itertools.islice( matches, size ) )
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            pipeline.close()
 
+    #
     # Build list of possible outputs from filelist query... (requires run,sequence as 2nd and 3rd
     # elements in the query result)
-    fc_result  = []
-
-    rl_result = None
-    rl_map    = None
-
-    lfn_lists  = {}  # LFN lists per run requested in the input query
-    pfn_lists  = {}  # PFN lists per run existing on disk
-    rng_lists  = {}  # LFN:firstevent:lastevent
-
-    runMin=999999
-    runMax=0
-    INFO("Building candidate inputs")
-
-    dstnames = {}
-
-    if rule.files:
-        # curs      = cursors[ rule.filesdb ]
-
-        inputquery = dbQuery( cnxn_string_map[ rule.filesdb ], rule.files )
-
-        outputs = [] # WARNING: len(outputs) and len(fc_result) must be equal
+    #
+    def _candidates( self ):
+        if not self.rule.files:
+            return
+        fetch = lambda: dbQuery( cnxn_string_map[ self.rule.filesdb ], self.rule.files, stream=True, name='matches.inputs' )
+        if shared.active:
+            # Rules reading the same input query share its rows
+            with stages.stage( 'matches.candidates' ):
+                self.input, rows = shared.input( self.rule, fetch )
+            inputquery = iter( rows )
+        else:
+            inputquery = iter( fetch() )
+        while True:
+            with stages.stage( 'matches.candidates' ):
+                batch = self._batch( inputquery )
+            if len(batch.lfn_lists)==0:
+                return   # Early exit if nothing (more) to be done
+            INFO(f"... {len(batch.outputs)} candidates in runs {batch.runMin} to {batch.runMax}")
+            yield batch
+
+    def _batch( self, inputquery ):
+        name, build, tag, version = self.name, self.build, self.tag, self.version
+        batch = _MatchBatch()
 
-        # Matches the dsttype runtype 
-        regex_dset = re.compile( '(DST_[A-Z0-9_]+_[a-z0-9]+)_([a-z0-9]+_(\d\d\d\dp\d\d\d|nocdbtag))_*(v\d\d\d)*' )
-        
-        INFO(f"... {len(fc_result)} inputs")
         for f in inputquery:
-            fc_result.append(f) # cache the query
             run     = f.runnumber
             segment = f.segment
             runsegkey = f"{run}-{segment}"
@@ -1159,28 +1601,33 @@ def matches( rule, kwargs={} ):
                 runsegkey = f"{run}-{segment}-{streamname}"
 
 
-            # This is where the candidate output filename is built...  
+            # This is where the candidate output filename is built...
             output_ = DSTFMT %(name_,build,tag,int(run),int(segment))
 
             if version:
                 output_ = DSTFMTv %(name_,build,tag,str(version),int(run),int(segment))
 
-            outputs.append( output_ )
+            if self.state:
+                if self.state.skip( output_, run ):
+                    continue
+
+            batch.fc_result.append(f) # cache the query
+            batch.outputs.append( output_ )
 
-            dstnames[ f"{name_}_{build}_{tag}" ] = (f'{name_}',f'{build}_{tag}')
+            batch.dstnames[ f"{name_}_{build}_{tag}" ] = (f'{name_}',f'{build}_{tag}')
 
 
-            if run>runMax: runMax=run
-            if run<runMin: runMin=run
+            if run>batch.runMax: batch.runMax=run
+            if run<batch.runMin: batch.runMin=run
 
-            if lfn_lists.get(run,None) == None:
-                lfn_lists[ runsegkey ] = f.files.split()
-                rng_lists[ runsegkey ] = getattr( f, 'fileranges', '' ).split()
+            if batch.lfn_lists.get(run,None) == None:
+                batch.lfn_lists[ runsegkey ] = f.files.split()
+                batch.rng_lists[ runsegkey ] = getattr( f, 'fileranges', '' ).split()
             else:
                 # If we hit this result, then the db query has resulted in two rows with identical
                 # run numbers.  Violating the implicit submission schema.
                 ERROR(f"Run number {runsegkey} reached twice in this query...")
-                ERROR(rule.files)
+                ERROR(self.rule.files)
                 exit(1)
 
             #
@@ -1198,42 +1645,211 @@ def matches( rule, kwargs={} ):
             # and we reprocess.
             #
             # ... but we don't need to build this if we are using direct lookup
-            if rule.direct==None:            
-
-                for fn in f.files.split():
-                    base1 = fn.split('-')[0]
-                    rematch = regex_dset.match( base1 )
-                    dset = rematch.group(1)
-                    dtype = rematch.group(2)
-                    vnum = rematch.group(4)
-                    if vnum:
-                        dtype = dtype + '_' + vnum
-                    input_datasets[ ( dset, dtype ) ] = 1
-                        
-    
-    if len(lfn_lists)==0:
-        return [], None, [], []  # Early exit if nothing to be done
+            if self.rule.direct==None:
+                self._datasets( f.files )
+
+            if self.chunk and len(batch.outputs) >= self.chunk:
+                break
+
+        return batch
+
+    def _datasets( self, files ):
+        """
+        Registers the input datasets of the files.
+        """
+        # Matches the dsttype runtype
+        regex_dset = re.compile( '(DST_[A-Z0-9_]+_[a-z0-9]+)_([a-z0-9]+_(\d\d\d\dp\d\d\d|nocdbtag))_*(v\d\d\d)*' )
+
+        for fn in files.split():
+            base1 = fn.split('-')[0]
+            rematch = regex_dset.match( base1 )
+            dset = rematch.group(1)
+            dtype = rematch.group(2)
+            vnum = rematch.group(4)
+            if vnum:
+                dtype = dtype + '_' + vnum
+            input_datasets[ ( dset, dtype ) ] = 1
 
     #
     # Build dictionary of DSTs existing in the datasets table of the file catalog.  For every DST that is in this list,
     # we know that we do not have to produce it if it appears w/in the outputs list.
     #
-    dsttype="%s_%s_%s"%(name,build,tag)  # dsttype aka name above
-    
-    exists = {}
-    INFO(f"Building list of existing outputs: # dstnames={len(dstnames.items())}")
-
-    for buildnametag, tuple_ in dstnames.items():
-        dt, ds = tuple_
-        exists.update( 
-            { 
-                c.filename : ( c.runnumber, c.segment ) for c in 
-                dbQuery( cnxn_string_map['fccro'], f"select filename, runnumber, segment from datasets where runnumber>={runMin} and runnumber<={runMax} and dsttype='{dt}' and dataset='{ds}'" )
-            }
-        )
-    INFO(f"... {len(exists.keys())} existing outputs")
+    def _existing( self, batches ):
+        for batch in batches:
+            with stages.stage( 'matches.exists' ):
+                INFO(f"Building list of existing outputs: # dstnames={len(batch.dstnames.items())}")
+                outputs = batch.outputs
+
+                if self.antijoin:
+                    unproduced = set()
+                    for block in value_blocks( outputs ):
+                        unproduced.update( r.filename for r in dbStatement( cnxn_string_map['fccro'], 'datasets.unproduced', block, values=values_sql( len(block) ) ) )
+                    batch.exists = { output_ : True for output_ in outputs if output_ not in unproduced }
+                    del unproduced
+
+                else:
+
+                    # Only outputs which we propose to produce are retained
+                    candidates = set( outputs )
+
+                    # A single query over every (dsttype, dataset) pair, e.g. one per stream
+                    requirement = ' or '.join( [ f"(dsttype='{dt}' and dataset='{ds}')" for dt, ds in batch.dstnames.values() ] )
+                    batch.exists = {
+                        c.filename : True for c in
+                        dbQuery( cnxn_string_map['fccro'], f"select filename from datasets where runnumber>={batch.runMin} and runnumber<={batch.runMax} and ( {requirement} )", stream=True, name='matches.exists' )
+                        if c.filename in candidates
+                    }
+                    del candidates
+
+                INFO(f"... {len(batch.exists.keys())} existing outputs")
+            yield batch
+
+    #
+    # The production setup will be unique based on (1) the specified analysis build, (2) the specified DB tag,
+    # and (3) the hash of the local github repository where the payload scripts/macros are found.
+    #
+    def _production_setup( self ):
+        payload, build = self.payload, self.build
+        with stages.stage( 'matches.git' ):
+            # git answers are cached until the payload repository changes (see gitcache)
+            repo      = payloads.info( payload )
+            repo_dir  = payload
+            repo_hash = repo.hash
+            repo_url  = repo.url  # TODO: fix hardcoded directory
+
+
+            if PRODUCTION_MODE:
+                # HEAD is an ancestor of (or is) origin/<current branch>
+                localhash = repo.fullhash
+
+                if repo.contained:
+                    INFO( f"Local and remote hash match in the payload directory {localhash}.  You may proceed." )
+                elif build=='new':
+                    INFO( f"Local hash not found in remote {localhash} ... we are running under new, so go for it!" )
+                elif args.doit:
+                    WARN("The darkside is a pathway to many abilities that some consider unnatural...")
+                else:
+                    WARN( f"""
+
+                    YOU ARE IN A PRODUCTION ENVIRONMENT.
 
+                    Local hash DOES NOT match any hash on the remote for the payload directory.
+
+                    {localhash}
+
+                    In order to ensure reproducibility of results we require that the payload area is under
+                    version control (git), and that the local hash is found in the remote repo.
+
+                    If you need to test a small change, you should place them on a branch.  (Do a git stash,
+                    create the new branch, do a git stash pop and add your codes to the branch.  Push to
+                    the remote and run your jobs).
+
+                    If you are making a physics-analysis-meaningful change that needs to be tracked, consider
+                    also incrementing the version number of the production and reproducing the data sample.
+
+                    """ )
+                    exit(0)
+
+            else:
+
+                WARN("You are running in testbed mode... so no consistency with the remote is required.")
+
+        # Question is whether the production setup can / should have name replacement with the input stream.
+        # Perhaps a placeholder substitution in the fetch / update / create methods.
+        #
+        # Version???
+        #
+        with stages.stage( 'matches.setup' ):
+            INFO("Fetching production setup")
+            return fetch_production_setup( self.name, self.buildarg, self.tag, repo_url, repo_dir, repo_hash, self.version )
 
+    #
+    # Map the production status table onto the output filename.  We use this map to determine whether
+    # the proposed candidate output DST in the outputs list is currently being produced by a condor job, or
+    # has failed and needs expert attention.  Blocked and produced candidates are dropped.
+    #
+    def _unblocked( self, batches ):
+        for batch in batches:
+            if self.setup is None:
+                self.setup = self._production_setup()
+
+            with stages.stage( 'matches.status' ):
+                runMin, runMax = batch.runMin, batch.runMax
+                if runMin>runMax:
+                    runMax=999999
+                    runMin=0
+
+                prod_status_map = {}
+                prod_id_map = {}
+                blocked = set()   # candidates blocked by a status which the anti-join did not return
+
+                if self.antijoin:
+                    INFO("Fetching unblocked candidates from the production status")
+                    unblocked_ = set()
+                    dstfiles = [ output_.replace(".root","").strip() for output_ in batch.outputs ]
+                    for block in value_blocks( dstfiles ):
+                        for r in dbStatement( cnxn_string_map['statusw'], 'status.unblocked', block, values=values_sql( len(block) ), blocking=','.join( [ f"'{b}'" for b in blocking ] ) or "''" ):
+                            unblocked_.add( r.dstfile )
+                            if r.id is not None:
+                                prod_status_map[r.dstfile] = r.status
+                                prod_id_map[r.dstfile]     = r.id
+                    blocked = set( dstfiles ) - unblocked_
+                    del unblocked_, dstfiles
+
+                else:
+                    INFO("Fetching production status")
+                    prod_status = fetch_production_status ( self.setup, runMin, runMax )  # between run min and run max inclusive
+
+                    INFO("Building production status map")
+                    for stat in prod_status:
+                        prod_status_map[stat.dstfile] = stat.status
+                        prod_id_map[stat.dstfile]     = stat.id
+                    # note: prod_status is only used to build the map above.  It only requires the status flag.
+
+                assert( len(batch.fc_result)==len(batch.outputs) )
+                for (fc,dst) in zip(batch.fc_result,batch.outputs):
+
+                    #
+                    # Get the production status from the proposed output name
+                    #
+                    # TODO: Shouldn't we replace all suffixes here?
+                    #
+                    x    = dst.replace(".root","").strip()
+                    stat = prod_status_map.get( x, None )
+                    blockid = prod_id_map.get( x, None )
+
+                    #
+                    # There is a master list of states which result in a DST producion job being blocked.  By default
+                    # this is (or ought to be) the total list of job states.  Jobs can end up failed, so there exist
+                    # options to ignore the a blocking state... which will remove it from the blocking list.
+                    #
+                    if stat in blocking or x in blocked:
+                        stat = stat or 'blocked'
+                        if args.batch==False:           WARN("%s is blocked by production status=%s, skipping."%( dst, stat ))
+                        if self.state: self.state.decide( dst, stat, fc.runnumber )
+                        continue
+
+                    # If we have unblocked we add to the list
+                    if blockid:
+                        self.unblocked_ids.append(blockid)
+
+
+                    #
+                    # Next we check to see if the job has alread been produced (i.e. it is registered w/in the file catalog).
+                    # If it exists, we will not reproduce the DST.  Unless the resubmit option overrides.
+                    #
+                    test=batch.exists.get( dst, None )
+                    if test and not self.resubmit:
+                        if args.batch==False:           WARN("%s has already been produced, skipping."%dst)
+                        if self.state: self.state.decide( dst, 'produced', fc.runnumber )
+                        continue
+
+                    batch.survivors.append( ( fc, dst, test ) )
+
+                # The rows of the decided candidates are no longer needed
+                batch.fc_result = batch.outputs = None
+                INFO(f"... {len(batch.survivors)} candidates neither blocked nor produced")
+            yield batch
 
     #
     # lfn2pfn provides a mapping between physical files on disk and the corresponding lfn
@@ -1243,7 +1859,7 @@ def matches( rule, kwargs={} ):
     # pfn... in which case we can omit building the lfn2pfn mapping and pass down just the
     # logical filenames.  (Note that this requires that there can only be a 1:1 mapping
     # between LFN and PFN)...
-    #    
+    #
     # A few notes.  This mapping will not be constrained to the set of input files provided
     # by the query.  It will either be all files in the direct search path specified in the
     # yaml file, OR it will be all files contained in the input data set(s).
@@ -1251,55 +1867,81 @@ def matches( rule, kwargs={} ):
     # When running from the direct path there is the risk of duplicate entries... ymmv.
     #
     # When running from the file catalog... this will pull in all lfn/pfns from the
-    # datasets which appear in the input datasets.  We could extend this to use a
+    # datasets which appear in the input datasets, keeping only the lfns which were
+    # requested by the surviving candidates.  We could extend this to use a
     # tuple as the key, where the tuple is the dataset, dsttype pair.
     #
-    lfn2pfn = {}
-    if rule.direct:
+    def _resolved( self, batches ):
+        rule = self.rule
+        for batch in batches:
+            if not batch.survivors:
+                continue
+
+            with stages.stage( 'matches.lfn2pfn' ):
+                keys = [ self._runsegkey( fc ) for fc, dst, test in batch.survivors ]
+                runs = [ fc.runnumber for fc, dst, test in batch.survivors ]
+                runMin, runMax = min(runs), max(runs)
+
+                if rule.direct:
+                    if self.direct is None:
+                        self.direct = shared.direct( rule.direct, self._direct ) if shared.active else self._direct()
+                    lfn2pfn = self.direct
+
+                elif self.input is not None:
+                    # The map is built once over the run range of the shared input, for every file it requests
+                    def build():
+                        for r in self.input.rows:
+                            self._datasets( r.files )
+                        return self._lfn2pfn( self.input.runMin, self.input.runMax, self.input.lfns() )
+                    lfn2pfn = self.input.lfn2pfn( rule.lfn2pfn, build )
+
+                else:
+                    # The query sweeps up every file in the input datasets over the run range.  Only
+                    # the LFNs requested by the surviving candidates are retained.
+                    requested = set( itertools.chain.from_iterable( batch.lfn_lists[k] for k in keys ) )
+                    lfn2pfn   = self._lfn2pfn( runMin, runMax, requested )
+                    del requested
+
+            # Build lists of PFNs available for each run
+            with stages.stage( 'matches.pfnlists' ):
+                INFO(f"Building PFN lists {len(keys)}")
+                for runseg in keys:
+                    lfns = batch.lfn_lists[ runseg ]
+
+                    # Build list of PFNs via direct lookup and append the results
+                    try:
+                        batch.pfn_lists[runseg] = [lfn2pfn[lfn] for lfn in lfns]
+
+                    except KeyError:
+                        print( "No PFN for all LFNs in the input query.")
+                        print(f"direct_path: {str(rule.direct)}")
+                        print( "    ... if it is None, you should specify the directory paths where input files can be found")
+                        print( "        in the input query.")
+                        print( "    ... if it specifies one or more directories, then your list is incomplete, or there are missing input files.")
+                        raise KeyError
+
+                INFO(f"... {len(batch.pfn_lists.keys())} pfn lists")
+            yield batch
+
+    def _direct( self ):
+        rule = self.rule
         INFO(f"Building lfn2pfn map from filesystem {rule.direct}")
-        lfn2pfn = { pfn.split("/")[-1] : pfn for pfn in glob(rule.direct+'/*') }
-        INFO(f"done {len(lfn2pfn)}")
-
-    elif 0:
-
-        INFO("Building lfn2pfn map from filecatalog")
-        
-        for mydatasettuple in input_datasets.keys():
-
-            mydataset=mydatasettuple[1]
-            mydsttype=mydatasettuple[0]
-
-            INFO( f'lfn map query for {mydataset} {mydsttype}' )
-
-            fcquery=f"""
-
-            with lfnlist as (
-   
-            select filename from datasets where 
-
-            runnumber>={runMin}   and 
-            runnumber<={runMax}   and 
-            dataset='{mydataset}' and 
-            dsttype='{mydsttype}'
-
-            )
-
-            select lfn,full_file_path as pfn from 
-
-            lfnlist join files
-
-            on lfnlist.filename=files.lfn;        
-            """
+        if args and getattr( args, 'dirindex', False ):
+            # Only the directories modified since the last pass are listed again
+            index  = DirIndex()
+            result = { pfn.split("/")[-1] : pfn for pfn in index.files( rule.direct ) }
+            index.report()
+        else:
+            result = { pfn.split("/")[-1] : pfn for pfn in glob(rule.direct+'/*') }
+        INFO(f"done {len(result)}")
+        return result
 
-            if rule.lfn2pfn=="lfn2pfn":
-                lfn2pfn.update( { r.lfn : r.pfn for r in dbQuery( cnxn_string_map['fccro'],fcquery ) } )
-            elif rule.lfn2pfn=="lfn2lfn":
-                lfn2pfn.update( { r.lfn : r.lfn } )
-
-    else:
+    def _lfn2pfn( self, runMin, runMax, requested ):
+        rule    = self.rule
+        lfn2pfn = {}
 
         requirements = []
-        INFO( f'TEST lfn map query for {input_datasets.keys()}' )                        
+        INFO( f'TEST lfn map query for {input_datasets.keys()}' )
         for mydatasettuple in input_datasets.keys():
 
             mydataset=mydatasettuple[1]
@@ -1311,309 +1953,173 @@ def matches( rule, kwargs={} ):
 
 
         fcquery=f"""
-        
-        with lfnlist as (
-        
-        select filename from datasets where 
-        
-        runnumber>={runMin}   and 
-        runnumber<={runMax}   and 
-        
-        {requirement}
-        
-        )
-
-        select lfn,full_file_path as pfn from 
-
-        lfnlist join files
-        
-        on lfnlist.filename=files.lfn;        
-        """
 
+        with lfnlist as (
 
-        if rule.lfn2pfn=="lfn2pfn":
-            lfn2pfn.update( { r.lfn : r.pfn for r in dbQuery( cnxn_string_map['fccro'],fcquery ) } )
-        elif rule.lfn2pfn=="lfn2lfn":
-            lfn2pfn.update( { r.lfn : r.lfn } )        
-        
-
-                    
-    # Build lists of PFNs available for each run
-    INFO(f"Building PFN lists {len(lfn_lists)}")
-    for runseg,lfns in lfn_lists.items():
-
-        lfns_ = [ f"'{x}'" for x in lfns ]
-        list_of_lfns = ','.join(lfns_)
-
-        # Add a new entry in the pfn_lists lookup table
-        if pfn_lists.get(runseg,None)==None:
-            pfn_lists[runseg]=[]
-
-        # Build list of PFNs via direct lookup and append the results
-        try:
-            pfn_lists[runseg] = [lfn2pfn[lfn] for lfn in lfns] 
-
-        except KeyError:
-            print( "No PFN for all LFNs in the input query.")
-            print(f"direct_path: {str(rule.direct)}")
-            print( "    ... if it is None, you should specify the directory paths where input files can be found")
-            print( "        in the input query.")
-            print( "    ... if it specifies one or more directories, then your list is incomplete, or there are missing input files.")
-            raise KeyError
-
-    INFO(f"... {len(pfn_lists.keys())} pfn lists")
-
-    # 
-    # The production setup will be unique based on (1) the specified analysis build, (2) the specified DB tag,
-    # and (3) the hash of the local github repository where the payload scripts/macros are found.
-    #
-    repo_dir  = payload 
-    repo_hash = sh.git('rev-parse','--short','HEAD',_cwd=payload).rstrip()
-    repo_url  = sh.git('config','--get','remote.origin.url',_cwd=payload ).rstrip()  # TODO: fix hardcoded directory
-
-
-    if PRODUCTION_MODE:
-        # git branch --show-current
-        localbranch = sh.git( 'branch', '--show-current', _cwd=payload ).strip()
-
-        #localhash = sh.git('show','--format=%H','-s','--no-abbrev-commit',_cwd=payload).strip()[:40]
-        localhash    = sh.git('rev-parse','HEAD', _cwd=payload).strip()[:40]
-        remotehashes = [ f[:40] for f in sh.git('rev-list','--all',f'origin/{localbranch}', _cwd=payload).split('\n') ]
-
-        if localhash.strip() in remotehashes:
-            INFO( f"Local and remote hash match in the payload directory {localhash}.  You may proceed." )
-        elif build=='new': 
-            INFO( f"Local hash not found in remote {localhash} ... we are running under new, so go for it!" )
-        elif args.doit:
-            WARN("The darkside is a pathway to many abilities that some consider unnatural...")
-        else:
-            WARN( f"""
-
-            YOU ARE IN A PRODUCTION ENVIRONMENT.
-
-            Local hash DOES NOT match any hash on the remote for the payload directory.
-
-            {localhash}
-            
-            In order to ensure reproducibility of results we require that the payload area is under 
-            version control (git), and that the local hash is found in the remote repo.
-            
-            If you need to test a small change, you should place them on a branch.  (Do a git stash, 
-            create the new branch, do a git stash pop and add your codes to the branch.  Push to
-            the remote and run your jobs).
-
-            If you are making a physics-analysis-meaningful change that needs to be tracked, consider 
-            also incrementing the version number of the production and reproducing the data sample.
-                        
-            """ )
-            exit(0)
-
-    else:
-
-        WARN("You are running in testbed mode... so no consistency with the remote is required.")
-
+        select filename from datasets where
 
-    
+        runnumber>={runMin}   and
+        runnumber<={runMax}   and
 
-    # Question is whether the production setup can / should have name replacement with the input stream.  
-    # Perhaps a placeholder substitution in the fetch / update / create methods.
-    #
-    # Version???
-    #
-    INFO("Fetching production setup")
-    setup = fetch_production_setup( name, buildarg, tag, repo_url, repo_dir, repo_hash, version )
-    
-    #
-    # Returns the production status table from the database
-    #
-    if runMin>runMax:
-        runMax=999999
-        runMin=0
-
-    INFO("Fetching production status")
-    prod_status = fetch_production_status ( setup, runMin, runMax )  # between run min and run max inclusive
+        {requirement}
 
-    #
-    # Map the production status table onto the output filename.  We use this map later on to determine whether
-    # the proposed candidate output DST in the outputs list is currently being produced by a condor job, or
-    # has failed and needs expert attention.
-    #
-    prod_status_map = {}
-    prod_id_map = {}
-    INFO("Building production status map")    
-    for stat in prod_status:
-        prod_status_map[stat.dstfile] = stat.status
-        prod_id_map[stat.dstfile]     = stat.id
-    # note: prod_status is only used to build the map above.  It only requires the status flag.
+        )
 
-    INFO("Production status map")
+        select lfn,full_file_path as pfn from
 
-    #
-    # Build the list of matches.  We iterate over the fc_result zipped with the set of proposed outputs
-    # which derives from it.  Keep a list of all runs we are about to submit.
-    #
-    list_of_runs = []
-    INFO("Building matches")
+        lfnlist join files
 
-    unblocked_ids = []
+        on lfnlist.filename=files.lfn;
+        """
 
-    assert( len(fc_result)==len(outputs) ) 
-    for (fc,dst) in zip(fc_result,outputs):
+        if rule.lfn2pfn=="lfn2pfn" and args and getattr( args, 'lfn2pfn_cache', False ):
+            # Only the files changed since the last pass are fetched for the cached run blocks
+            fetch = lambda query: dbQuery( cnxn_string_map['fccro'], query, stream=True, name='matches.lfn2pfn.cache' )
+            cached = PfnCache().lookup( fetch, [ ( mydatasettuple[1], mydatasettuple[0] ) for mydatasettuple in input_datasets.keys() ], runMin, runMax )
+            lfn2pfn.update( { lfn : pfn for lfn, pfn in cached.items() if lfn in requested } )
+            del cached
+        elif rule.lfn2pfn=="lfn2pfn":
+            lfn2pfn.update( { r.lfn : r.pfn for r in dbQuery( cnxn_string_map['fccro'],fcquery,stream=True,name='matches.lfn2pfn' ) if r.lfn in requested } )
+        elif rule.lfn2pfn=="lfn2lfn":
+            lfn2pfn.update( { r.lfn : r.lfn for r in dbQuery( cnxn_string_map['fccro'],fcquery,stream=True,name='matches.lfn2pfn' ) if r.lfn in requested } )
 
+        return lfn2pfn
 
-        lfn = fc.source
-        run = fc.runnumber
-        seg = fc.segment
-        firstevent = getattr(fc,'firstevent',None)
-        lastevent  = getattr(fc,'lastevent',None)
-        runs_last_event = getattr(fc,'runs_last_event',None)
+    def _runsegkey( self, fc ):
         streamname = getattr(fc,'streamname',None)
-        streamfile = getattr(fc,'streamfile',None)
-
-        if firstevent: firstevent=str(firstevent)
-        if lastevent: lastevent=str(lastevent)
-        if runs_last_event: runs_last_event=str(runs_last_event)
-        if streamname: streamname=str(streamname)
-        if streamfile: streamfile=str(streamfile)
-
-        neventsper = getattr(fc,'neventsper',None)
-
-        runsegkey = f"{run}-{seg}"
         if streamname:
-            runsegkey = f"{run}-{seg}-{streamname}"
-                
-        #
-        # Get the production status from the proposed output name
-        #
-        # TODO: Shouldn't we replace all suffixes here?
-        #
-        x    = dst.replace(".root","").strip()
-        stat = prod_status_map.get( x, None )
-        blockid = prod_id_map.get( x, None )
-
-        #
-        # There is a master list of states which result in a DST producion job being blocked.  By default
-        # this is (or ought to be) the total list of job states.  Jobs can end up failed, so there exist
-        # options to ignore the a blocking state... which will remove it from the blocking list.
-        #
-        if stat in blocking:
-            if args.batch==False:           WARN("%s is blocked by production status=%s, skipping."%( dst, stat ))
-            continue
-
-        # If we have unblocked we add to the list 
-        if blockid:
-            unblocked_ids.append(blockid)
-
-        
-        #
-        # Next we check to see if the job has alread been produced (i.e. it is registered w/in the file catalog).
-        # If it exists, we will not reproduce the DST.  Unless the resubmit option overrides.
-        #
-        test=exists.get( dst, None )
-        if test and not resubmit:
-            if args.batch==False:           WARN("%s has already been produced, skipping."%dst)
-            continue
-
-        #
-        # Check consistentcy between the LFN list (from input query) and PFN list (from file catalog query) 
-        # for the current run.  Verify that the two lists are consistent.
-        #
-        num_lfn = len( lfn_lists[ runsegkey ] )
-        num_pfn = len( pfn_lists[ runsegkey ] )
-        sanity = True
-        pfn_check = [ x.split('/')[-1] for x in pfn_lists[runsegkey] ]
-        for x in pfn_check:
-            if x not in lfn_lists[ runsegkey ]:
-                sanity = False
-                break
-
-        #
-        # If there are more LFNs requested than exist on disk, OR if the lfn list does
-        # not match the pfn list, then reject.
-        #
-        if num_lfn > num_pfn or sanity==False:
-            WARN(f"LFN list and PFN list are different.  Skipping this run {runsegkey}")
-            WARN( f"{num_lfn} {num_pfn} {sanity}" )
-            for i in itertools.zip_longest( lfn_lists[runsegkey], pfn_lists[runsegkey] ):
-                print(i)
-            continue
-
-
-        inputs_ = pfn_lists[ runsegkey ]
-        ranges_ = rng_lists[ runsegkey ]
-        
-
-        #
-        # If the DST has been produced (and we make it to this point) we issue a warning that
-        # it will be overwritten.
-        #
-        if test and resubmit:
-            WARN("%s exists and will be overwritten"%dst)
+            return f"{fc.runnumber}-{fc.segment}-{streamname}"
+        return f"{fc.runnumber}-{fc.segment}"
 
-        if True:
-
-            if verbose>10:
-                INFO (lfn, run, seg, dst, "\n");
-
-            myinputs = None
-            myranges = None
-
-            if inputs_:
-                myinputs = ' '.join(inputs_) ### ??????
-
-            if ranges_:
-                myranges = ' '.join(ranges_)
-
-            
-            # 
-            # Build the rule-match data structure and immediately convert it to a dictionary.
-            #    
-
-            match = SPhnxMatch(
-                name,                   # name of the DST, e.g. DST_CALO
-                script,                 # script which will be run on the worker node
-                lfn,                    # lfn of the input file
-                dst,                    # name of the DST output file
-                str(run),               # run number
-                str(seg),               # segment number
-                buildarg,               # sPHENIX software build (preserve the "." when building the match)
-                tag,                    # database tag.
-                "4096MB",               # default memory requirement
-                "10GB",                 # default disk space requirement
-                payload,                # payload directory
-                inputs=myinputs,        # space-separated list of input files
-                ranges=myranges,        # space-separated list of input files with first and last event separated by :
-                firstevent=firstevent,
-                lastevent=lastevent,
-                runs_last_event=runs_last_event,
-                neventsper=neventsper,
-                streamname=streamname,
-                streamfile=streamfile,
-                version=version
-                )
-
-            match = match.dict()
-
-            #
-            # Add / override with kwargs.  This is where (for instance) the memory and disk requirements
-            # can be adjusted.
-            #
-            for k,v in kwargs.items():
-                match[k]=str(v)              # coerce any ints to string
-            
-            result.append(match)
+    #
+    # Build the list of matches.  We iterate over the surviving candidates of the batch.  Keep a list
+    # of all runs we are about to submit.
+    #
+    def _matches( self, batch ):
+        with stages.stage( 'matches.loop' ):
+            INFO("Building matches")
+            result = []
+            for (fc,dst,test) in batch.survivors:
+
+                lfn = fc.source
+                run = fc.runnumber
+                seg = fc.segment
+                firstevent = getattr(fc,'firstevent',None)
+                lastevent  = getattr(fc,'lastevent',None)
+                runs_last_event = getattr(fc,'runs_last_event',None)
+                streamname = getattr(fc,'streamname',None)
+                streamfile = getattr(fc,'streamfile',None)
+
+                if firstevent: firstevent=str(firstevent)
+                if lastevent: lastevent=str(lastevent)
+                if runs_last_event: runs_last_event=str(runs_last_event)
+                if streamname: streamname=str(streamname)
+                if streamfile: streamfile=str(streamfile)
+
+                neventsper = getattr(fc,'neventsper',None)
+
+                runsegkey = self._runsegkey( fc )
+
+                #
+                # Check consistentcy between the LFN list (from input query) and PFN list (from file catalog query)
+                # for the current run.  Verify that the two lists are consistent.
+                #
+                num_lfn = len( batch.lfn_lists[ runsegkey ] )
+                num_pfn = len( batch.pfn_lists[ runsegkey ] )
+                sanity = True
+                pfn_check = [ x.split('/')[-1] for x in batch.pfn_lists[runsegkey] ]
+                for x in pfn_check:
+                    if x not in batch.lfn_lists[ runsegkey ]:
+                        sanity = False
+                        break
+
+                #
+                # If there are more LFNs requested than exist on disk, OR if the lfn list does
+                # not match the pfn list, then reject.
+                #
+                if num_lfn > num_pfn or sanity==False:
+                    WARN(f"LFN list and PFN list are different.  Skipping this run {runsegkey}")
+                    WARN( f"{num_lfn} {num_pfn} {sanity}" )
+                    for i in itertools.zip_longest( batch.lfn_lists[runsegkey], batch.pfn_lists[runsegkey] ):
+                        print(i)
+                    continue
+
+
+                inputs_ = batch.pfn_lists[ runsegkey ]
+                ranges_ = batch.rng_lists[ runsegkey ]
+
+
+                #
+                # If the DST has been produced (and we make it to this point) we issue a warning that
+                # it will be overwritten.
+                #
+                if test and self.resubmit:
+                    WARN("%s exists and will be overwritten"%dst)
+
+                if verbose>10:
+                    INFO (lfn, run, seg, dst, "\n");
+
+                myinputs = None
+                myranges = None
+
+                if inputs_:
+                    myinputs = ' '.join(inputs_) ### ??????
+
+                if ranges_:
+                    myranges = ' '.join(ranges_)
+
+
+                #
+                # Build the rule-match record.  It reads as the dictionary of the SPhnxMatch with the
+                # kwargs of the rule (shared by all records) added / overriding its fields.  This is
+                # where (for instance) the memory and disk requirements can be adjusted.
+                #
+
+                match = SPhnxMatchRecord(
+                    self.shared,            # kwargs of the rule
+                    self.name,              # name of the DST, e.g. DST_CALO
+                    self.script,            # script which will be run on the worker node
+                    lfn,                    # lfn of the input file
+                    dst,                    # name of the DST output file
+                    str(run),               # run number
+                    str(seg),               # segment number
+                    self.buildarg,          # sPHENIX software build (preserve the "." when building the match)
+                    self.tag,               # database tag.
+                    "4096MB",               # default memory requirement
+                    "10GB",                 # default disk space requirement
+                    self.payload,           # payload directory
+                    inputs=myinputs,        # space-separated list of input files
+                    ranges=myranges,        # space-separated list of input files with first and last event separated by :
+                    firstevent=firstevent,
+                    lastevent=lastevent,
+                    runs_last_event=runs_last_event,
+                    neventsper=neventsper,
+                    streamname=streamname,
+                    streamfile=streamfile,
+                    version=self.version
+                    )
+
+                result.append(match)
+
+                if int(run) not in self.list_of_runs: self.list_of_runs.append(run)
+
+                # No more matches are needed than the limit allows
+                if self.rule.limit and self.nmatched + len(result) >= self.rule.limit:
+                    break
 
-            if int(run) not in list_of_runs: list_of_runs.append(run)
+        return result
 
-            #
-            # Terminate the loop if we exceed the maximum number of matches
-            #
-            if rule.limit and len(result)>= rule.limit:
-                break    
+def matches( rule, kwargs={} ):
+    """
 
-    INFO(f"Matched {len(result)} jobs to the rule")
+    Apply rule... extract files from DB according to the specified query
+    and build the matches.  Return list of matches.  Return the production
+    setup from the DB.  (See MatchPipeline for the streaming interface.)
 
-    return result, setup, list_of_runs, unblocked_ids
+    """
+    pipeline = MatchPipeline( rule, kwargs )
+    result   = list( pipeline )
+    return result, pipeline.setup, pipeline.list_of_runs, pipeline.unblocked_ids
 
 #__________________________________________________________________________________________________
 #
@@ -1630,18 +2136,33 @@ arg_parser.add_argument( "--batch-name", dest="batch_name", default=None ) #defa
 arg_parser.add_argument( "--doit", dest="doit", action="store_true", default=False )
 arg_parser.add_argument( "--mark-held-jobs", dest="mark_held_jobs", action="store_true", default=False )
 arg_parser.add_argument( "--clear-held-jobs", dest="clear_held_jobs", action="store_true", default=False )
+arg_parser.add_argument( "--incremental", dest="incremental", action="store_true", default=False, help="Skips candidates found produced or blocked on a previous pass (state kept in .slurp/matchstate.db)" )
+arg_parser.add_argument( "--antijoin", dest="antijoin", action="store_true", default=False, help="Ships the candidate outputs to the file catalog and production status servers, which return only the surviving candidates" )
+arg_parser.add_argument( "--chunk", dest="chunk", type=int, default=None, help="Streams the matches and submits them in chunks of at most this many jobs, each committed with its own cluster (default: all at once)" )
+arg_parser.add_argument( "--bulkload", dest="bulkload", default=False, action="store_true", help="Bulk loads the production status rows of large submissions through a staging table" )
+arg_parser.add_argument( "--verify-submit", dest="verify_submit", default=False, action="store_true", help="Queries the schedd after each submission to verify the process IDs derived from the submit result" )
+arg_parser.add_argument( "--knowndirs", dest="knowndirs", action="store_true", default=False, help="Keeps the output directories known to exist in .slurp/knowndirs.db and only creates the missing ones" )
+arg_parser.add_argument( "--dirindex", dest="dirindex", action="store_true", default=False, help="Keeps the listings of the direct_path directories in .slurp/dirindex.db and only lists again the directories which changed" )
+arg_parser.add_argument( "--lfn2pfn-cache", dest="lfn2pfn_cache", action="store_true", default=False, help="Keeps the lfn to pfn map in .slurp/lfn2pfn.db and only fetches the files changed since the last pass" )
+arg_parser.add_argument( "--reconcile", dest="reconcile", default=RECONCILE, type=float, help="Seconds between full evaluations in incremental mode" )
 
 def warn_options( args, userargs ):
     if args.dbinput==False:
         WARN("Option --no-dbinput has been deprecated and we now retire it. Resetting args.dbinput=True.")
         args.dbinput=True
 
-def parse_command_line():
+def parse_command_line( argv=None ):
+    """
+    Parses the given arguments (defaults to sys.argv).  May be called again in the same
+    process (e.g. by ramenya running rules in process), each call starting from the
+    default blocking states.
+    """
     global blocking
     global args
     global userargs
 
-    args, userargs = arg_parser.parse_known_args()
+    args, userargs = arg_parser.parse_known_args( argv )
+    blocking = list( BLOCKING )
     #blocking_ = ["submitting","submitted","started","running","evicted","failed","finished"]
 
     warn_options( args, userargs )
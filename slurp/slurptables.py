@@ -54,6 +54,7 @@ CREATE TYPE prodstate as ENUM
        'submitted',        -- job is submitted (set by slurp)
        'started',          -- job has started on the worker node (set by cups)
        'running',          -- job is running (set by cups periodically)
+       'held',             -- job is held by condor (set by slurp/ramenya)
        'evicted',          -- job has recieved a bad signal (set by cups)
        'failed',           -- job ended with nonzero status code (set by cups)
        'finished'          -- job has finished (set by cups)
@@ -77,6 +78,7 @@ CREATE TABLE if not exists PRODUCTION_CURSOR
 
 );       
     """
+    return result
 
 def sphnx_production_status_table_def( dsttype=None, build=None, dbtag=None ):
     result="""
@@ -90,6 +92,7 @@ CREATE TABLE if not exists PRODUCTION_STATUS
        segment   int             not null,   -- segment number
        nsegments int             not null,   -- number of produced segments
        inputs    text            not null,   -- array of input files (possibly null)
+       ranges    text                    ,   -- array of input files with first and last event (lfn:first:last)
        prod_id   int             not null,   -- production id
 
        cluster   int             not null,   -- condor cluster
@@ -120,6 +123,9 @@ CREATE TABLE if not exists PRODUCTION_STATUS
        primary key (id,run,segment,prod_id)         
 
 );    
+
+-- candidates are looked up by output file (see the status.unblocked anti-join)
+CREATE INDEX if not exists production_status_dstfile ON PRODUCTION_STATUS (dstfile);
 """   
     return result
 
@@ -235,6 +241,57 @@ class SPhnxDatasetStatus:
     blame: str
 
 
+#_____________________________________
+def sphnx_filecatalog_files_table_def():
+    """
+    Files table of the file catalog (maps lfn to pfn)
+    """
+    return """
+    CREATE TABLE if not exists FILES (
+       lfn            text        not null   -- logical filename
+    ,  full_host_name text                   -- host / filesystem
+    ,  full_file_path text        not null   -- physical filename
+    ,  time           timestamp
+    ,  size           bigint
+    ,  md5            text
+    ,  primary key(lfn)
+    );
+    """
+
+def sphnx_filecatalog_datasets_table_def():
+    """
+    Datasets table of the file catalog (one row per produced file)
+    """
+    return """
+    CREATE TABLE if not exists DATASETS (
+       filename       text        not null   -- logical filename
+    ,  runnumber      int         not null
+    ,  segment        int         not null
+    ,  size           bigint
+    ,  dataset        text                   -- eg ana437_2024p007_v001
+    ,  dsttype        text                   -- eg DST_TRIGGERED_EVENT_run2pp
+    ,  events         int
+    ,  primary key(filename)
+    );
+    """
+
+def sphnx_daq_filelist_table_def():
+    """
+    Filelist table of the DAQ database (one row per raw data file)
+    """
+    return """
+    CREATE TABLE if not exists FILELIST (
+       filename            text   not null   -- full path on the buffer box
+    ,  runnumber           int    not null
+    ,  segment             int    not null
+    ,  firstevent          int
+    ,  lastevent           int
+    ,  events              int
+    ,  transferred_to_sdcc bool   default false
+    ,  primary key(filename)
+    );
+    """
+
 #_____________________________________
 def sphnx_invalid_run_list():
     
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Named stage timers for profiling slurp.
+
+A stage is timed either as a block
+
+    with stages.stage( 'matches.setup' ):
+        ...
+
+or as a sequence of laps, where each call to lap() closes the interval started by
+the previous one (or by the creation of the Laps) and accounts it under the name
+given
+
+    laps = stages.laps( 'matches' )
+    ...
+    laps.lap( 'candidates' )    # accounted as matches.candidates
+    ...
+    laps.lap( 'exists' )        # accounted as matches.exists
+
+For each name we accumulate the number of calls and the wall time.  While tracemalloc
+is tracing, the peak traced memory reached during the stage and the traced memory
+retained when the stage ends are recorded as well.  Stages may nest.
+
+The accumulated statistics are printed as a table by report() (in the order in which
+the stages were first entered) and appended as a line of JSON by dump().
+"""
+
+import sys
+import time
+import json
+import weakref
+import datetime
+import platform
+import threading
+import tracemalloc
+
+from dataclasses import dataclass, asdict
+
+from simpleLogger import DEBUG, INFO, WARN, ERROR, CRITICAL
+
+@dataclass
+class SPhnxStageStats:
+    """
+    Counters accumulated for a single named stage.
+    """
+    calls:   int   = 0    # number of times the stage was entered
+    wall:    float = 0.0  # seconds spent in the stage
+    maxwall: float = 0.0  # longest single pass through the stage
+    peak:    int   = 0    # peak traced memory (bytes) reached in the stage
+    growth:  int   = 0    # traced memory (bytes) retained at the end of the stage
+
+    def dict(self):
+        return asdict(self)
+
+class _Interval:
+    """
+    An open stage.  Keeps the highest traced memory seen while it is open.
+    """
+    def __init__( self ):
+        self.start   = time.monotonic()
+        self.memory  = 0
+        self.peak    = 0
+        if tracemalloc.is_tracing():
+            self.memory, self.peak = tracemalloc.get_traced_memory()
+
+class Laps:
+    """
+    Times consecutive intervals, each accounted under prefix.name.
+    """
+    def __init__( self, timer, prefix ):
+        self.timer    = timer
+        self.prefix   = prefix
+        self.interval = timer._open()
+
+    def lap( self, name ):
+        self.timer._close( self.interval, f"{self.prefix}.{name}" if self.prefix else name )
+        self.interval = self.timer._open()
+
+    def skip( self ):
+        """
+        Restarts the current interval without accounting it.
+        """
+        self.timer._discard( self.interval )
+        self.interval = self.timer._open()
+
+class StageTimer:
+    """
+    Collects the per stage statistics.
+    """
+    def __init__( self ):
+        self._stats = {}
+        self._open_ = weakref.WeakSet()   # intervals open in any thread
+        self._lock  = threading.Lock()
+
+    def _open( self ):
+        interval = _Interval()
+        if tracemalloc.is_tracing():
+            # Fold the peak so far into the enclosing stages before starting a new one
+            peak = tracemalloc.get_traced_memory()[1]
+            with self._lock:
+                for other in self._open_:
+                    if peak > other.peak: other.peak = peak
+            tracemalloc.reset_peak()
+            interval.peak = interval.memory
+        with self._lock:
+            self._open_.add( interval )
+        return interval
+
+    def _discard( self, interval ):
+        with self._lock:
+            self._open_.discard( interval )
+
+    def _close( self, interval, name ):
+        wall = time.monotonic() - interval.start
+        peak = growth = 0
+        if tracemalloc.is_tracing():
+            memory, peak = tracemalloc.get_traced_memory()
+            peak   = max( peak, interval.peak )
+            growth = memory - interval.memory
+        self._discard( interval )
+        self.record( name, calls=1, wall=wall, peak=peak, growth=growth )
+
+    def record( self, name, calls=0, wall=0.0, peak=0, growth=0 ):
+        with self._lock:
+            s = self._stats.get( name, None )
+            if s is None:
+                s = self._stats[name] = SPhnxStageStats()
+            s.calls  += calls
+            s.wall   += wall
+            s.growth += growth
+            if wall > s.maxwall: s.maxwall = wall
+            if peak > s.peak:    s.peak    = peak
+
+    def stage( self, name ):
+        return _Stage( self, name )
+
+    def laps( self, prefix='' ):
+        return Laps( self, prefix )
+
+    def stats( self ):
+        """
+        Returns a dictionary of the stage counters keyed on stage name.
+        """
+        with self._lock:
+            return { k: s.dict() for k, s in self._stats.items() }
+
+    def clear( self ):
+        with self._lock:
+            self._stats = {}
+
+    def report( self, log=INFO ):
+        """
+        Logs a summary table in the order in which the stages were first entered.
+        """
+        stats = list( self.stats().items() )
+        if not stats:
+            return
+        width = max( [ len(k) for k, s in stats ] + [ 5 ] )
+        log( f"{'stage':<{width}} {'calls':>6} {'wall[s]':>9} {'max[s]':>8} {'peak[MB]':>9} {'growth[MB]':>10}" )
+        for k, s in stats:
+            log( f"{k:<{width}} {s['calls']:>6} {s['wall']:>9.3f} {s['maxwall']:>8.3f} {s['peak']/1E6:>9.1f} {s['growth']/1E6:>10.1f}" )
+
+    def dump( self, filename, **meta ):
+        """
+        Appends the statistics for this run to filename as a single line of JSON.
+        Additional keyword arguments are stored with the run metadata.
+        """
+        run = {
+            'timestamp'   : str( datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) ),
+            'host'        : platform.node(),
+            'argv'        : sys.argv,
+            'tracemalloc' : tracemalloc.is_tracing(),
+        }
+        run.update( meta )
+        with open( filename, 'a' ) as f:
+            f.write( json.dumps( { 'run' : run, 'stages' : self.stats() }, default=str ) + '\n' )
+
+class _Stage:
+    def __init__( self, timer, name ):
+        self.timer = timer
+        self.name  = name
+
+    def __enter__( self ):
+        self.interval = self.timer._open()
+        return self
+
+    def __exit__( self, *exc ):
+        self.timer._close( self.interval, self.name )
+        return False
+
+# The timer shared by slurp and its drivers
+stages = StageTimer()
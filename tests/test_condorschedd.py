@@ -0,0 +1,70 @@
+import multiprocessing
+
+import htcondor
+
+from condorschedd import FakeSchedd
+
+def test_fake_schedd_submit_and_query():
+    schedd = FakeSchedd()
+    submit = htcondor.Submit( { 'executable' : 'run.sh', 'arguments' : '$(run) $(cupsid)', 'output' : 'out-$INT(run,%08d).log' } )
+    submit[ '+sPHENIX_PRODUCTION' ] = '"DST_X_ana.1_2024p1_v001"'
+    items = [ { 'run' : str(run), 'cupsid' : str(100+run), '+sPHENIX_DSTTYPE' : '"DST_X_run2pp"', '+sPHENIX_RUNNUMBER' : str(run), '+sPHENIX_SLURP_CUPSID' : str(100+run) } for run in range(5) ]
+
+    result = schedd.submit( submit, itemdata=iter(items) )
+    assert result.num_procs() == 5
+
+    ads = schedd.query( constraint=f"ClusterId == {result.cluster()}", projection=[ 'ProcId', 'Args', 'Out', 'sPHENIX_SLURP_CUPSID' ] )
+    assert [ ( ad['ProcId'], ad['Args'], ad['Out'], ad['sPHENIX_SLURP_CUPSID'] ) for ad in ads ][1] == ( 1, '1 101', 'out-00000001.log', 101 )
+
+    # the constraints used by slurp.submit
+    schedd.act( htcondor.JobAction.Hold, 'sPHENIX_RUNNUMBER>=3', 'test' )
+    held = schedd.query( constraint='regexp("DST_X_[A-Z0-9_]+",sphenix_dsttype,"i") && (JobStatus==2 || JobStatus==5)' )
+    assert sorted( ad['sPHENIX_RUNNUMBER'] for ad in held ) == [ 3, 4 ]
+
+    schedd.act( htcondor.JobAction.Remove, 'JobStatus==5', 'test' )
+    assert len( schedd.query() ) == 3
+
+def test_fake_schedd_journal( tmp_path ):
+    state  = str( tmp_path / 'fakeschedd.ads' )
+    schedd = FakeSchedd( state=state )
+    submit = htcondor.Submit( { 'executable' : 'run.sh', 'arguments' : '$(run)' } )
+    for i in range(3):
+        schedd.submit( submit, itemdata=iter( [ { 'run' : str(run) } for run in range(4) ] ) )
+    schedd.act( htcondor.JobAction.Hold, 'ClusterId==2', 'test' )
+    schedd.act( htcondor.JobAction.Remove, 'ClusterId==3', 'test' )
+    schedd.edit( 'ClusterId==1 && ProcId==0', 'JobStatus', '2' )
+
+    # the calls are appended to the journal, and replayed (and compacted) on load
+    again = FakeSchedd( state=state )
+    assert again.cluster == 3 and sorted( again.jobs ) == sorted( schedd.jobs )
+    assert [ ad['JobStatus'] for ad in again.query( 'ClusterId<=2', projection=[ 'JobStatus' ] ) ] == [ 2, 1, 1, 1, 5, 5, 5, 5 ]
+    assert FakeSchedd( state=state ).jobs.keys() == again.jobs.keys()
+
+def _submit_clusters( state, n ):
+    schedd = FakeSchedd( state=state )
+    submit = htcondor.Submit( { 'executable' : 'run.sh' } )
+    return [ schedd.submit( submit, itemdata=iter( [ {} ] * 2 ) ).cluster() for i in range(n) ]
+
+def test_fake_schedd_shared_state( tmp_path ):
+    state  = str( tmp_path / 'fakeschedd.ads' )
+    first  = FakeSchedd( state=state )
+    second = FakeSchedd( state=state )
+    submit = htcondor.Submit( { 'executable' : 'run.sh' } )
+
+    # each instance sees the jobs of the other, and clusters are allocated from the shared state
+    assert [ s.submit( submit, count=2 ).cluster() for s in ( first, second, first ) ] == [ 1, 2, 3 ]
+    assert len( first.query() ) == len( second.query() ) == 6
+    second.act( htcondor.JobAction.Remove, 'ClusterId==1' )
+    first.edit( 'ClusterId==2', 'JobStatus', '2' )
+    assert [ ad['JobStatus'] for ad in second.query( projection=[ 'JobStatus' ] ) ] == [ 2, 2, 1, 1 ]
+
+    # a compaction by a new instance is picked up as well
+    assert FakeSchedd( state=state ).submit( submit ).cluster() == 4
+    assert first.submit( submit ).cluster() == 5 and len( second.query() ) == 6
+
+def test_fake_schedd_shared_between_processes( tmp_path ):
+    state = str( tmp_path / 'fakeschedd.ads' )
+    with multiprocessing.get_context( 'fork' ).Pool( 4 ) as pool:
+        clusters = sum( pool.starmap( _submit_clusters, [ ( state, 10 ) ] * 4 ), [] )
+    assert sorted( clusters ) == list( range( 1, 41 ) )
+    assert len( FakeSchedd( state=state ).query() ) == 80
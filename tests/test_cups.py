@@ -0,0 +1,13 @@
+import importlib
+
+def test_dbquery_on_sqlite_backend( tmp_path, monkeypatch ):
+    monkeypatch.setenv( 'SLURP_DB_BACKEND', f'sqlite:{tmp_path}' )
+    import cups
+    cups = importlib.reload( cups )   # the backend is selected on import
+
+    curs, ntries, start, finish, exception, name, serv = cups.dbQuery( cups.cnxn_string_map['statw'], 'select 1 as x', tag='probe' )
+    assert exception == 'noexception' and ntries == 1
+    assert curs.fetchone().x == 1
+    assert name == 'ProductionStatusWrite'
+    stats = cups.querystats[-1]
+    assert stats['query'] == 'probe' and stats['error'] is None and stats['connect'] > 0
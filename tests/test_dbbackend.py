@@ -0,0 +1,53 @@
+import dbbackend
+
+def test_translate_postgres_dialect():
+    sql = dbbackend.translate( "update t set ended=cast(? as timestamp),message=firstevent::text where id=?" )
+    assert sql == "update t set ended=?,message=firstevent where id=?"
+
+def test_sqlite_backend( tmp_path ):
+    conn = dbbackend.sqlite_connect( 'DSN=ProductionStatusWrite', str(tmp_path) )
+    curs = conn.cursor()
+    curs.execute( "insert into production_setup (name,build,dbtag,repo,dir,hash) values (?,?,?,?,?,?)", ( 'DST_X', 'ana.1', '2024p1', 'repo', '.', 'abcd' ) )
+    for state in [ 'finished', 'submitted', 'running' ]:
+        curs.execute( "insert into production_status (dsttype,dstname,dstfile,run,segment,nsegments,inputs,prod_id,cluster,process,status) values ('X','X','X',1,0,0,'',1,0,0,?) returning id", state )
+
+    # rows have attribute access, and the status column compares in prodstate order
+    rows = curs.execute( "select id,status from production_status where status<'started' or status>'failed' order by status" ).fetchall()
+    assert [ r.status for r in rows ] == [ 'submitted', 'finished' ]
+
+    assert curs.execute( "select split_part('/a/b/c.prdf','/',-1) as lfn" ).fetchone().lfn == 'c.prdf'
+
+def test_antijoin_statements( tmp_path ):
+    from dbstatements import statements, values_sql, value_blocks
+    conn = dbbackend.sqlite_connect( 'DSN=ProductionStatusWrite', str(tmp_path) )
+    curs = conn.cursor()
+    for dstfile, state in [ ( 'a', 'finished' ), ( 'b', 'failed' ), ( 'c', 'failed' ), ( 'c', 'running' ) ]:
+        curs.execute( "insert into production_status (dsttype,dstname,dstfile,run,segment,nsegments,inputs,prod_id,cluster,process,status) values ('X','X',?,1,0,0,'',1,0,0,?)", dstfile, state )
+
+    assert [ len(b) for b in value_blocks( list( range(1500) ) ) ] == [ 1024, 256, 128, 64, 16, 8, 4 ]
+
+    # failed is not blocking: b survives with its entry, c is blocked by the running entry
+    sql  = statements['status.unblocked'].format( values=values_sql( 4 ), blocking="'finished','running'" )
+    rows = curs.execute( sql, ( 'a', 'b', 'c', 'd' ) ).fetchall()
+    assert sorted( ( r.dstfile, r.status ) for r in rows ) == [ ( 'b', 'failed' ), ( 'd', None ) ]
+
+def test_bulk_updates( tmp_path ):
+    from dbstatements import bulk_blocks
+    conn = dbbackend.sqlite_connect( 'DSN=ProductionStatusWrite', str(tmp_path) )
+    curs = conn.cursor()
+    ids  = [ curs.execute( "insert into production_status (dsttype,dstname,dstfile,run,segment,nsegments,inputs,prod_id,cluster,process,status) values ('X','X','X',1,?,0,'',1,0,0,?) returning id", seg, state ).fetchone()[0]
+             for seg, state in enumerate( [ 'submitting' ] * 6 + [ 'running' ] ) ]
+
+    # the running job is not sent back to submitted
+    updates = [ ( '2026-01-01 00:00:00', 100, p, i ) for p, i in enumerate( ids ) ]
+    blocks  = list( bulk_blocks( 'status.submitted', updates, blocksize=4 ) )
+    assert [ len(params) for sql, params in blocks ] == [ 16, 8, 4 ]
+    for sql, params in blocks:
+        curs.execute( sql, params )
+    rows = curs.execute( "select status,cluster,process,submitted from production_status order by id" ).fetchall()
+    assert [ ( r.status, r.cluster, r.process ) for r in rows ] == [ ( 'submitted', 100, p ) for p in range(6) ] + [ ( 'running', 0, 0 ) ]
+    assert rows[0].submitted == '2026-01-01 00:00:00'
+
+    for sql, params in bulk_blocks( 'status.held', [ ( 'out of memory', 1767225600, ids[0] ) ] ):
+        curs.execute( sql, params )
+    assert curs.execute( "select status,message from production_status where id=?", ids[0] ).fetchone() == ( 'held', 'out of memory' )
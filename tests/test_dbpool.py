@@ -0,0 +1,93 @@
+import sqlite3
+import pytest
+
+from dbpool import ConnectionPool
+
+def test_pool_reuses_connections():
+    opened = []
+    def connect( key ):
+        opened.append( key )
+        return sqlite3.connect( ':memory:' )
+
+    pool = ConnectionPool( connect=connect, poolsize=2 )
+
+    for i in range(0,5):
+        rows = [ r for r in pool.cursor( 'DSN=test' ).execute( 'select 1' ) ]
+        assert rows == [ (1,) ]
+
+    stats = pool.stats()['DSN=test']
+    assert len(opened)     == 1
+    assert stats['misses'] == 1
+    assert stats['hits']   == 4
+
+def test_pool_overflow_and_discard():
+    pool = ConnectionPool( connect=lambda key: sqlite3.connect( ':memory:' ), poolsize=1, waitmax=0.01 )
+
+    a = pool.cursor( 'DSN=test' )
+    b = pool.cursor( 'DSN=test' )   # pool exhausted, overflow after waiting
+    stats = pool.stats()['DSN=test']
+    assert stats['waits']     == 1
+    assert stats['overflows'] == 1
+
+    a.discard()
+    b.close()
+    assert pool.stats()['DSN=test']['discards'] == 1
+    assert len( pool._idle['DSN=test'] ) == 1
+
+def test_pool_stream_fetches_in_batches():
+    pool = ConnectionPool( connect=lambda key: sqlite3.connect( ':memory:' ), poolsize=1 )
+
+    stream = pool.cursor( 'DSN=test' ).stream( 'with recursive n(i) as (select 1 union all select i+1 from n where i<25) select i from n', batchsize=10 )
+    assert pool._nopen['DSN=test'] == 1
+    assert [ r[0] for r in stream ] == list( range(1,26) )
+
+    # connection is returned to the pool once the stream is exhausted
+    assert len( pool._idle['DSN=test'] ) == 1
+
+def test_router_reads_from_current_replica():
+    from dbroute import ReadRouter
+
+    dbs = { 'DSN=w' : sqlite3.connect( ':memory:', check_same_thread=False ), 'DSN=r' : sqlite3.connect( ':memory:', check_same_thread=False ) }
+    for db in dbs.values():
+        db.execute( 'create table production_status ( id integer )' )
+        db.execute( 'insert into production_status values (1)' )
+        db.commit()
+
+    class Conn:
+        def __init__( self, db ): self.db = db
+        def cursor( self ):       return self.db.cursor()
+        def rollback( self ):     pass
+        def close( self ):        pass
+
+    pool   = ConnectionPool( connect=lambda key: Conn( dbs[key] ) )
+    router = ReadRouter( pool, { 'DSN=w' : 'DSN=r' }, recheck=0, pinwindow=60 )
+
+    assert router.route( 'DSN=w', read=True ) == 'DSN=r'
+
+    # replica falls behind
+    dbs['DSN=w'].execute( 'insert into production_status values (2)' )
+    dbs['DSN=w'].commit()
+    assert router.route( 'DSN=w', read=True ) == 'DSN=w'
+
+    # replica catches up, but reads following a write stay on the primary
+    dbs['DSN=r'].execute( 'insert into production_status values (2)' )
+    dbs['DSN=r'].commit()
+    assert router.route( 'DSN=w', read=False ) == 'DSN=w'
+    assert router.route( 'DSN=w', read=True )  == 'DSN=w'
+    router.pinwindow = 0
+    assert router.route( 'DSN=w', read=True )  == 'DSN=r'
+
+def test_pool_connect_failure_is_raised_once():
+    attempts = []
+    def connect( key ):
+        attempts.append( key )
+        raise RuntimeError( 'database is down' )
+
+    pool = ConnectionPool( connect=connect )
+    with pytest.raises( RuntimeError ):
+        pool.cursor( 'DSN=test' )
+
+    # the retries belong to the caller (dbQuery), and the failed slot is released
+    assert len(attempts) == 1
+    assert pool.stats()['DSN=test']['failures'] == 1
+    assert pool._nopen['DSN=test'] == 0
@@ -0,0 +1,42 @@
+import sqlite3
+
+from dbpool import ConnectionPool
+from dbstats import QueryStats, InstrumentedCursor
+
+def test_pooled_cursor_is_accounted():
+    pool  = ConnectionPool( connect=lambda key: sqlite3.connect( ':memory:' ) )
+    stats = QueryStats()
+
+    curs = pool.cursor( 'DSN=test' ).instrument( stats.probe( 'numbers', retries=2, connect=0.5 ) )
+    rows = [ r for r in curs.execute( "select 'abc',1 union all select 'de',2" ) ]
+    assert len(rows) == 2
+
+    s = stats.stats()['numbers']
+    assert s['calls']   == 1
+    assert s['rows']    == 2
+    assert s['bytes']   == 3 + 8 + 2 + 8
+    assert s['retries'] == 2
+    assert s['connect'] == 0.5
+
+def test_instrumented_cursor_names_caller():
+    stats = QueryStats()
+    curs  = InstrumentedCursor( sqlite3.connect( ':memory:' ).cursor(), stats )
+
+    def lookup():
+        return curs.execute( 'select 1' ).fetchall()
+
+    lookup()
+    lookup()
+    assert stats.stats()['lookup']['calls'] == 2
+    assert stats.stats()['lookup']['rows']  == 2
+
+def test_retried_call_is_accounted_once():
+    stats = QueryStats()
+    probe = stats.probe( 'retried' )
+    for itry, connect in enumerate( [ 0.25, 0.5, 0.125 ] ):   # as dbQuery retries the call
+        probe.attempt( itry, connect )
+
+    s = stats.stats()['retried']
+    assert s['calls']   == 1
+    assert s['retries'] == 2
+    assert s['connect'] == 0.125
@@ -0,0 +1,23 @@
+import os
+import glob
+
+from dirindex import DirIndex
+
+def test_unchanged_directories_are_served_from_the_index( tmp_path ):
+    for mode in ( 'run2pp', 'run2auau' ):
+        for name in ( 'a.root', 'b.root', '.hidden' ):
+            path = tmp_path / mode / 'ana' / 'physics'
+            path.mkdir( parents=True, exist_ok=True )
+            ( path / name ).write_text( '' )
+    pattern = f"{tmp_path}/*/ana/physics/"
+    index   = DirIndex( str(tmp_path/'dirindex.db'), racy=-1E9 )
+    assert sorted( index.files( pattern ) ) == sorted( glob.glob( pattern + '/*' ) )
+    assert index.stats()['misses'] == 3 and index.stats()['hits'] == 0
+
+    # a new file only invalidates its own directory
+    ( tmp_path / 'run2pp' / 'ana' / 'physics' / 'c.root' ).write_text( '' )
+    os.utime( tmp_path / 'run2pp' / 'ana' / 'physics', ns=( 0, 10**9 ) )
+    index = DirIndex( str(tmp_path/'dirindex.db'), racy=-1E9 )
+    files = index.files( pattern )
+    assert f"{tmp_path}/run2pp/ana/physics/c.root" in files and len(files) == 5
+    assert index.stats()['misses'] == 1 and index.stats()['hits'] == 2
@@ -0,0 +1,55 @@
+import os
+import time
+
+from dispatcher import RuleDispatcher, SPhnxRuleTask
+
+def rule( seconds, jobs, maxjobs=None ):
+    if jobs is None:
+        return None   # as kaedama.run when the rule exits early
+    if jobs < 0:
+        raise ValueError( "bad rule" )
+    time.sleep( seconds )
+    return min( jobs, maxjobs ) if maxjobs else jobs
+
+def test_rules_share_the_capacity_and_reuse_workers():
+    dispatcher = RuleDispatcher( rule, width=2 )
+    try:
+        tasks = [ SPhnxRuleTask( 'A', ( 0.0, 3 ), maxjobs=10 ),
+                  SPhnxRuleTask( 'B', ( 0.0, 20 ) ),
+                  SPhnxRuleTask( 'C', ( 0.0, -1 ) ),
+                  SPhnxRuleTask( 'D', ( 0.0, 5 ) ) ]
+        results = dispatcher.dispatch( tasks, capacity=15 )
+        assert [ r.status for r in results ] == [ 'ok', 'ok', 'failed', 'skipped' ]
+        # A reserves 10 and hands back 7, B is capped to the 5 left, C keeps what it reserved
+        assert [ r.budget for r in results ] == [ 10, 5, 7, None ]
+        assert [ r.jobs   for r in results ] == [ 3, 5, None, None ]
+        assert 'ValueError' in results[2].error
+        assert len( { r.pid for r in results[:3] } ) <= 2
+
+        again = dispatcher.dispatch( [ SPhnxRuleTask( 'A', ( 0.0, 1 ) ) ] )
+        assert again[0].pid in { r.pid for r in results[:3] }
+    finally:
+        dispatcher.close()
+
+def test_rule_exiting_early_returns_its_reservation():
+    dispatcher = RuleDispatcher( rule, width=1 )
+    try:
+        results = dispatcher.dispatch( [ SPhnxRuleTask( 'E', ( 0.0, None ) ), SPhnxRuleTask( 'F', ( 0.0, 4 ) ) ], capacity=10 )
+        assert [ r.status for r in results ] == [ 'ok', 'ok' ]
+        assert [ r.budget for r in results ] == [ 10, 10 ]
+    finally:
+        dispatcher.close()
+
+def test_slow_and_isolated_rules():
+    dispatcher = RuleDispatcher( rule, width=2 )
+    try:
+        start   = time.monotonic()
+        results = dispatcher.dispatch( [ SPhnxRuleTask( 'slow', ( 60.0, 1 ), timeout=0.5 ),
+                                         SPhnxRuleTask( 'fast', ( 0.0, 1 ), isolate=True ),
+                                         SPhnxRuleTask( 'next', ( 0.0, 1 ) ) ] )
+        assert time.monotonic() - start < 30
+        assert [ r.status for r in results ] == [ 'timeout', 'ok', 'ok' ]
+        assert results[2].pid != results[1].pid
+        assert results[0].wall >= 0.5
+    finally:
+        dispatcher.close()
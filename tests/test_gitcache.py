@@ -0,0 +1,63 @@
+import sh
+import pytest
+
+import gitcache
+
+from gitcache import GitCache
+
+def git( cwd, *args ):
+    return str( sh.git( '-c', 'user.name=test', '-c', 'user.email=test@localhost', *args, _cwd=str(cwd) ) ).strip()
+
+@pytest.fixture
+def payload( tmp_path ):
+    origin = tmp_path / 'origin.git'
+    git( tmp_path, 'init', '--bare', '-b', 'main', str(origin) )
+    local  = tmp_path / 'payload'
+    git( tmp_path, 'clone', str(origin), str(local) )
+    git( local, 'checkout', '-b', 'main' )
+    ( local / 'run.sh' ).write_text( 'echo 1\n' )
+    git( local, 'add', 'run.sh' )
+    git( local, 'commit', '-m', 'first' )
+    git( local, 'push', 'origin', 'main' )
+    git( local, 'remote', 'set-head', 'origin', 'main' )
+    ( local / 'macros' ).mkdir()
+    return local
+
+def test_hits_skip_git_until_the_repository_moves( payload, tmp_path, monkeypatch ):
+    cache = GitCache( path=str( tmp_path / 'gitcache.db' ) )
+    first = cache.info( payload / 'macros' )
+    assert first.contained and first.branch == 'main'
+    assert first.fullhash == git( payload, 'rev-parse', 'HEAD' )
+    assert first.remote == first.hash
+
+    calls = []
+    verify = cache.verify
+    monkeypatch.setattr( cache, 'verify', lambda p: calls.append( p ) or verify( p ) )
+    assert cache.info( payload / 'macros' ) == first
+    assert GitCache( path=cache.path ).info( payload / 'macros' ) == first   # from the database
+    assert calls == [] and cache.hits == 1
+
+    # A local commit is not on the remote until it is pushed
+    ( payload / 'run.sh' ).write_text( 'echo 2\n' )
+    git( payload, 'commit', '-am', 'second' )
+    second = cache.info( payload / 'macros' )
+    assert not second.contained and second.hash != first.hash and second.remote == first.hash
+
+    git( payload, 'push', 'origin', 'main' )
+    assert cache.info( payload / 'macros' ).contained
+    assert len( calls ) == 2
+
+def test_branch_switch_at_the_same_commit_misses( payload, tmp_path ):
+    cache = GitCache( path=str( tmp_path / 'gitcache.db' ) )
+    git( payload, 'checkout', '-q', '-b', 'other' )
+    git( payload, 'pack-refs', '--all' )   # no loose ref files whose mtimes differ
+    other = cache.info( payload )
+    assert other.branch == 'other' and not other.contained
+
+    git( payload, 'checkout', '-q', 'main' )
+    main = cache.info( payload )
+    assert main.branch == 'main' and main.contained and main.fullhash == other.fullhash
+
+def test_payload_outside_git_is_not_cached( tmp_path ):
+    cache = GitCache( path=str( tmp_path / 'gitcache.db' ) )
+    assert cache.key( tmp_path ) is None
@@ -0,0 +1,24 @@
+import knowndirs
+
+from knowndirs import KnownDirs
+
+def test_only_unknown_directories_are_created( tmp_path, monkeypatch ):
+    made = []
+    mkdir = knowndirs._mkdir
+    monkeypatch.setattr( knowndirs, '_mkdir', lambda p: made.append( p ) or mkdir( p ) )
+
+    targets = [ str( tmp_path / 'out' / f'run_{i}' / 'dst' ) for i in range( 4 ) ]
+    dirs    = KnownDirs( path=str( tmp_path / 'knowndirs.db' ) )
+    first   = dirs.materialize( targets + targets[:2] )
+    assert ( first.targets, first.known, first.created ) == ( 4, 0, 4 )
+    assert all( ( tmp_path / 'out' / f'run_{i}' / 'dst' ).is_dir() for i in range( 4 ) )
+
+    # Known to this submission, then to the next one through the database
+    assert dirs.materialize( targets[1:] ).created == 0
+    again = KnownDirs( path=dirs.path ).materialize( targets + [ str( tmp_path / 'out' / 'new' ) ] )
+    assert ( again.targets, again.known, again.created ) == ( 5, 4, 1 )
+    assert sorted( made ) == sorted( targets + [ str( tmp_path / 'out' / 'new' ) ] )
+    assert dirs.stats()['targets'] == 7
+
+    # Expired entries are created (checked) again
+    assert KnownDirs( path=dirs.path, maxage=-1 ).materialize( targets ).created == 4
@@ -0,0 +1,31 @@
+import time
+
+from matchstate import MatchState
+
+def test_decided_candidates_are_skipped_until_reconciliation( tmp_path ):
+    path  = str( tmp_path / 'matchstate.db' )
+    state = MatchState( 'DST_X_$(streamname)_run2pp_ana1_2024p1_v001', path, reconcile=3600 ).begin()
+    assert state.full
+    assert not state.skip( 'a.root', 5 )
+    state.decide( 'a.root', 'produced', 5 )
+    state.save()
+
+    state = MatchState( 'DST_X_$(streamname)_run2pp_ana1_2024p1_v001', path, reconcile=3600 ).begin()
+    assert not state.full
+    assert state.skip( 'a.root', 5 ) and not state.skip( 'b.root', 5 )
+    assert state.skipped == 1
+    assert MatchState( 'DST_Y_run2pp_ana1_2024p1_v001', path ).begin().full   # the state is per rule
+
+    # an incremental pass adds to the decisions, a full pass replaces them
+    state.decide( 'b.root', 'running', 5 )
+    state.save()
+    assert state.skip( 'b.root', 5 )
+    state.begin( full=True ).decide( 'c.root', 'produced', 6 )
+    state.save()
+    state = MatchState( 'DST_X_$(streamname)_run2pp_ana1_2024p1_v001', path, reconcile=3600 ).begin()
+    assert state.skip( 'c.root', 6 ) and not state.skip( 'a.root', 5 )
+
+    # overrides and an elapsed reconciliation period force a full pass
+    assert state.begin( full=True ).full and not state.skip( 'a.root', 5 )
+    state.reconciled = time.time() - 7200
+    assert state.begin().full
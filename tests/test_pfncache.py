@@ -0,0 +1,42 @@
+import sqlite3
+
+import dbbackend
+
+from pfncache import PfnCache
+
+def test_cached_blocks_only_fetch_newer_files( tmp_path ):
+    fc = sqlite3.connect( ':memory:' )
+    fc.executescript( """
+    create table datasets ( filename text, runnumber int, dataset text, dsttype text );
+    create table files    ( lfn text, full_file_path text, time text );
+    """ )
+    def add( lfn, run, age ):
+        fc.execute( "insert into datasets values (?,?,'ana1','DST_X')", ( lfn, run ) )
+        fc.execute( "insert into files values (?,?,datetime('now',?))", ( lfn, f"/lustre/x/{lfn}", f'-{age} seconds' ) )
+    fetched = []
+    def fetch( query ):
+        rows = fc.execute( dbbackend.translate( query ) ).fetchall()
+        if 'datasets' in query:
+            fetched.append( len(rows) )
+        return rows
+
+    add( 'a.root', 5,   7200 )
+    add( 'b.root', 150, 7200 )
+    cache = PfnCache( str(tmp_path/'lfn2pfn.db') )
+    assert cache.lookup( fetch, [ ('ana1','DST_X') ], 0, 299 ) == { 'a.root' : '/lustre/x/a.root', 'b.root' : '/lustre/x/b.root' }
+
+    # only the files registered since the watermark of each block are transferred again,
+    # including a file stamped before the previous fetch (by a transaction still open),
+    # and a block without files (run 200-299) is not fetched in full again
+    add( 'c.root', 160, 0 )
+    add( 'd.root', 170, 600 )
+    add( 'e.root', 250, 600 )
+    result = PfnCache( str(tmp_path/'lfn2pfn.db') ).lookup( fetch, [ ('ana1','DST_X') ], 0, 299 )
+    assert fetched == [ 2, 3 ]
+    assert result['d.root'] == '/lustre/x/d.root' and len(result) == 5
+    assert cache.db.execute( "select count(*) from blocks where watermark is null" ).fetchone()[0] == 0
+
+    # least recently used blocks go first
+    cache = PfnCache( str(tmp_path/'lfn2pfn.db'), maxrows=1 )
+    cache.lookup( fetch, [ ('ana1','DST_X') ], 0, 99 )
+    assert cache.db.execute( "select block from blocks" ).fetchall() == [ (0,) ]
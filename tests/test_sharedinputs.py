@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+from sharedinputs import SharedInputs, normalize
+
+def test_rules_with_the_same_input_query_share_its_rows():
+    shared = SharedInputs()
+    row    = SimpleNamespace( runnumber=5, files='a.root b.root' )
+    calls  = []
+    def fetch():
+        calls.append( 1 )
+        return [ row ]
+
+    a = SimpleNamespace( name='A', filesdb='daqdb', files='select *\n  from filelist;' )
+    b = SimpleNamespace( name='B', filesdb='daqdb', files='select * from filelist' )
+    c = SimpleNamespace( name='C', filesdb='fccro', files='select * from filelist' )
+    assert normalize( a.files ) == normalize( b.files )
+    assert list( shared.group( [ a, b, c ] ).values() ) == [ [ a, b ], [ c ] ]
+
+    assert shared.input( a, fetch )[0] is shared.input( b, fetch )[0]
+    assert shared.input( a, fetch )[0].lfns() == { 'a.root', 'b.root' }
+    shared.input( c, fetch )
+    assert len(calls) == 2 and shared.hits == 2 and shared.misses == 2
+
+    pfns = shared.input( a, fetch )[0].lfn2pfn( 'lfn2pfn', lambda: { 'a.root' : '/x/a.root' } )
+    assert shared.input( b, fetch )[0].lfn2pfn( 'lfn2pfn', lambda: {} ) is pfns
+
+def test_large_input_queries_are_streamed():
+    shared = SharedInputs( maxrows=2 )
+    rows   = [ SimpleNamespace( runnumber=r, files=f'{r}.root' ) for r in range(3) ]
+    calls  = []
+    def fetch():
+        calls.append( 1 )
+        return iter( rows )
+
+    a = SimpleNamespace( name='A', filesdb='daqdb', files='select * from filelist' )
+    b = SimpleNamespace( name='B', filesdb='daqdb', files='select * from filelist' )
+    for rule in [ a, b ]:
+        result, stream = shared.input( rule, fetch )
+        assert result is None and list( stream ) == rows
+    assert len(calls) == 2 and shared.unshared == 2 and shared.misses == 0
@@ -0,0 +1,26 @@
+import tracemalloc
+
+from stagetimer import StageTimer
+
+def test_laps_and_nested_peak():
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        with timer.stage( 'outer' ):
+            laps = timer.laps( 'outer' )
+            block = bytearray( 10**7 )
+            del block
+            laps.lap( 'alloc' )
+            kept = bytearray( 10**6 )
+            laps.lap( 'keep' )
+    finally:
+        tracemalloc.stop()
+
+    stats = timer.stats()
+    assert list( stats ) == [ 'outer.alloc', 'outer.keep', 'outer' ]
+    assert stats['outer.alloc']['peak']   >= 10**7
+    assert stats['outer.alloc']['growth'] <  10**6
+    assert stats['outer.keep']['peak']    <  10**7
+    assert stats['outer.keep']['growth']  >= 0.9 * len( kept )
+    assert stats['outer']['peak']         >= 10**7
+    assert stats['outer']['calls'] == 1